@@ -0,0 +1,137 @@
+# Microbenchmark of message encoding and decoding throughput, compares the original JSON path (full reserialize per
+# send, TextIOWrapper decode, bytes receive buffer) against the current codecs.
+# Run from the repository root: python -m benchmarks.codec_benchmark
+import argparse
+import io
+import json
+import queue
+import struct
+import sys
+import time
+
+from src.NetProtocol.Codec import CODECS
+from src.NetProtocol.ConnectionHandler import ConnectionHandler
+from src.NetProtocol.Message import Message
+from src.NetProtocol.Request import Request, RequestType
+from src.Utility.NetworkUtilities import orjson
+
+
+def metric_request():
+    return Request(RequestType.METRIC, dict(metrics=["hardware_metrics"], period=1))
+
+
+def metric_response(num_rows):
+    rows = [{"AVG(cpu)": 12.5 + i, "AVG(memory)": 104857600.0 + i, "pid": 1000 + i, "process_name": f"component-{i}"}
+            for i in range(num_rows)]
+    return Request(RequestType.METRIC, dict(period=1, metrics=rows, response=True))
+
+
+# The serialization as it was before codecs: body and header JSON encoded on every send
+def legacy_serialize(request: Request, CSeq):
+    content_bytes = json.dumps(request.request, ensure_ascii=False).encode(request.encoding)
+    header = dict(byteorder=sys.byteorder, content_length=len(content_bytes), content_type=request.m_type,
+                  content_encoding=request.encoding, CSeq=CSeq)
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    return struct.pack(">H", len(header_bytes)) + header_bytes + content_bytes
+
+
+def legacy_json_decode(json_bytes, encoding):
+    tiow = io.TextIOWrapper(io.BytesIO(json_bytes), encoding=encoding, newline="")
+    obj = json.load(tiow)
+    tiow.close()
+    return obj
+
+
+# The receive path as it was: bytes buffer grown and sliced per 4096 byte read
+def legacy_decode_stream(stream: bytes, chunk_size):
+    buffer = b""
+    received = 0
+    for i in range(0, len(stream), chunk_size):
+        buffer += stream[i:i + chunk_size]
+        while len(buffer) >= 2:
+            header_len = struct.unpack(">H", buffer[:2])[0]
+            if len(buffer) < 2 + header_len:
+                break
+            header = legacy_json_decode(buffer[2:2 + header_len], "utf-8")
+            end = 2 + header_len + header["content_length"]
+            if len(buffer) < end:
+                break
+            legacy_json_decode(buffer[2 + header_len:end], header["content_encoding"])
+            buffer = buffer[end:]
+            received += 1
+    return received
+
+
+def encode_current(request: Request, codec_name, num_messages):
+    handler = ConnectionHandler(None, None, ("bench", 0), 0, queue.Queue())
+    handler.codec = CODECS[codec_name]
+    message = Message(content=request, handler=handler)
+    frames = []
+    for CSeq in range(num_messages):
+        message.CSeq = CSeq
+        frames.append(message.get_serialized())
+    return frames
+
+
+def decode_current(stream: bytes, chunk_size):
+    receive_queue = queue.Queue()
+    handler = ConnectionHandler(None, None, ("bench", 0), 0, receive_queue)
+    view = memoryview(stream)
+    for i in range(0, len(stream), chunk_size):
+        chunk = view[i:i + chunk_size]
+        handler._get_recv_space()[:len(chunk)] = chunk
+        handler._recv_advance(len(chunk))
+        handler._process_frames()
+    return receive_queue.qsize()
+
+
+def rate(num_messages, fn, *args):
+    start_t = time.perf_counter()
+    fn(*args)
+    return num_messages / (time.perf_counter() - start_t)
+
+
+# Rows must come back as they were sent, including rows with the same keys in a different order
+def check_round_trip():
+    rows = [{"a": 1, "b": 2}, {"b": 20, "a": 10}, {"a": None, "b": "x"}]
+    request = Request(RequestType.METRIC, dict(period=1, metrics=rows, response=True))
+    for codec in ["json", "binary"]:
+        receive_queue = queue.Queue()
+        handler = ConnectionHandler(None, None, ("bench", 0), 0, receive_queue)
+        stream = b"".join(encode_current(request, codec, 1))
+        handler._get_recv_space()[:len(stream)] = stream
+        handler._recv_advance(len(stream))
+        handler._process_frames()
+        received = receive_queue.get_nowait().content.request['metrics']
+        assert received == rows, f"{codec} codec changed the rows: {rows} -> {received}"
+
+
+def run(num_messages, num_rows, chunk_size):
+    check_round_trip()
+    print(f"JSON backend: {'orjson' if orjson is not None else 'json'}, {num_messages} messages, "
+          f"{num_rows} rows per metric response, {chunk_size} byte reads")
+    print(f"{'case':<36}{'legacy msg/s':>14}{'json msg/s':>14}{'binary msg/s':>14}")
+    for name, request in [("encode metric request", metric_request()),
+                          ("encode metric response", metric_response(num_rows))]:
+        legacy = rate(num_messages, lambda: [legacy_serialize(request, c) for c in range(num_messages)])
+        current = [rate(num_messages, encode_current, request, codec, num_messages) for codec in ["json", "binary"]]
+        print(f"{name:<36}{legacy:>14,.0f}{current[0]:>14,.0f}{current[1]:>14,.0f}")
+
+    for name, request in [("decode metric request", metric_request()),
+                          ("decode metric response", metric_response(num_rows))]:
+        legacy_stream = b"".join(legacy_serialize(request, c) for c in range(num_messages))
+        legacy = rate(num_messages, legacy_decode_stream, legacy_stream, chunk_size)
+        current = []
+        for codec in ["json", "binary"]:
+            stream = b"".join(encode_current(request, codec, num_messages))
+            current.append(rate(num_messages, decode_current, stream, chunk_size))
+        print(f"{name:<36}{legacy:>14,.0f}{current[0]:>14,.0f}{current[1]:>14,.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Message codec throughput.')
+    parser.add_argument('-n', '--messages', type=int, default=20000)
+    parser.add_argument('-r', '--rows', type=int, default=20)
+    parser.add_argument('-c', '--chunk-size', type=int, default=4096)
+    args = parser.parse_args()
+    run(args.messages, args.rows, args.chunk_size)
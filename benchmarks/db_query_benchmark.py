@@ -0,0 +1,71 @@
+# Query latency of the metric database against table size, with the schema before its indexes (version 3) and the
+# current one. Fills hardware_metrics with samples of a number of components at a fixed rate and times the window
+# query a METRIC request runs for the last period, the same query over the whole run and the recent history of one
+# component, as well as the insert rate the indexes leave.
+# Run from the repository root: python -m benchmarks.db_query_benchmark
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from src.app.DatabaseSchema import SCHEMA_VERSION, migrate
+from src.PerformanceReport.HardwareMetrics import HardwareMetrics
+from src.PerformanceReport.Metrics import MetricCollectionMode, MetricCollector
+
+UNINDEXED_VERSION = 3
+
+
+def fill(db: sqlite3.Connection, num_rows, num_components, period, batch_size=10000):
+    for pid in range(num_components):
+        db.execute("INSERT INTO components VALUES (?, ?)", (f"component-{pid}", 1000 + pid))
+    start_t = time.perf_counter()
+    for batch_start in range(0, num_rows, batch_size):
+        rows = [dict(timestamp=(i // num_components) * period, pid=1000 + i % num_components,
+                     cpu=random.uniform(0, 100), memory=random.randint(10 ** 8, 10 ** 9), lag=0.0)
+                for i in range(batch_start, min(batch_start + batch_size, num_rows))]
+        db.executemany(HardwareMetrics.db_query_template, rows)
+        db.commit()
+    return num_rows / (time.perf_counter() - start_t)
+
+
+def time_query(db: sqlite3.Connection, query, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        start_t = time.perf_counter()
+        db.execute(query, params).fetchall()
+        timings.append(time.perf_counter() - start_t)
+    return statistics.median(timings) * 1000
+
+
+def run(args):
+    window_query = MetricCollector(HardwareMetrics, [], MetricCollectionMode.TO_DB, None).window_query
+    history_query = "SELECT timestamp, cpu, memory FROM hardware_metrics WHERE component = ? AND timestamp > ?"
+    print(f"{'rows':>10} {'schema':>7} {'inserts/s':>10} {'window ms':>10} {'full ms':>10} {'history ms':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for num_rows in args.rows:
+            for version in (UNINDEXED_VERSION, SCHEMA_VERSION):
+                db_file = os.path.join(directory, f"{num_rows}_{version}.db")
+                db = sqlite3.connect(db_file)
+                db.execute("PRAGMA journal_mode=wal")
+                db.execute("PRAGMA synchronous=normal")
+                migrate(db, version)
+                insert_rate = fill(db, num_rows, args.components, args.period)
+                end = (num_rows // args.components) * args.period
+                recent = time_query(db, window_query, (end - args.window,), args.repeat)
+                full = time_query(db, window_query, (0,), args.repeat)
+                history = time_query(db, history_query, (1000, end - args.window), args.repeat)
+                print(f"{num_rows:>10,} {version:>7} {insert_rate:>10,.0f} {recent:>10.3f} {full:>10.3f} {history:>10.3f}")
+                db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Metric database query latency against table size.')
+    parser.add_argument('-r', '--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('-c', '--components', type=int, default=10)
+    parser.add_argument('-p', '--period', type=float, default=0.01, help='seconds between samples')
+    parser.add_argument('-w', '--window', type=float, default=1.0, help='seconds covered by a METRIC request')
+    parser.add_argument('--repeat', type=int, default=20)
+    run(parser.parse_args())
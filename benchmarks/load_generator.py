@@ -0,0 +1,352 @@
+# Load generator for the resource server. Runs the server side networking (connection monitor, message handler,
+# codecs) in this process and a swarm of lightweight fake clients in a child process on one event loop. The fake
+# clients perform the real HANDSHAKE, answer METRIC and COMPONENT requests with synthetic data and can disconnect
+# and reconnect at a configurable rate. The server requests metrics from every connected client each tick and reports
+# throughput, response latency percentiles and its memory use per connected client. With --stream the server
+# subscribes to the clients' metrics instead and they push them, the server only sends COMPONENT requests.
+# Run from the repository root: python -m benchmarks.load_generator -n 500
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import random
+import selectors
+import socket
+import threading
+import time
+import uuid
+from queue import Queue
+
+from src.NetProtocol.AsyncConnectionHandler import AsyncConnectionMonitor
+from src.NetProtocol.Codec import CODECS
+from src.NetProtocol.Compression import Compressor
+from src.NetProtocol.ConnectionHandler import ConnectionClosed, ConnectionMonitor
+from src.NetProtocol.Message import Message
+from src.NetProtocol.MessageHandler import MessageHandler
+from src.NetProtocol.Ping import LatencyMonitor
+from src.NetProtocol.Request import Request, RequestType
+from src.NetworkGraph.NetworkGraph import NetworkGraph, NetworkNodeType
+from src.Utility.NetworkUtilities import backoff_delay
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+# Thousands of sockets per process need more than the usual 1024 file descriptors
+def raise_fd_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# Resident set size in bytes, the peak on platforms without /proc
+def current_rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, AttributeError):
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return 0
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return float("nan")
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+# One fake client. Shares the swarm's event loop and receive queue with all others.
+class FakeClient:
+    def __init__(self, swarm: "Swarm", num):
+        self.swarm = swarm
+        self.num = num
+        self.uuid = uuid.uuid4()  # Kept across reconnects, so the server resumes the session
+        self.conn_handler = None
+        self.stopped = False
+        self.stream_period = 0
+
+    async def connect(self):
+        if self.stopped:
+            return
+        conn_handler = await self.swarm.monitor._connect(self.swarm.ip, self.swarm.port, None, 10.0)
+        if conn_handler is None:
+            return
+        conn_handler.fake_client = self
+        self.conn_handler = conn_handler
+        self.swarm.num_connects += 1
+        handshake_dict = dict(uuid=str(self.uuid),
+                              hw_stats=dict(num_cpu=4, cpu_speed=3000.0, ram=8 * 1024 ** 3, has_gpu=False),
+                              codecs=[self.swarm.args.wire_format, 'json'],
+                              compression=self.swarm.compression,
+                              response=False)
+        conn_handler.send_message(Message(content=Request(RequestType.HANDSHAKE, handshake_dict)))
+        if self.swarm.args.churn > 0:
+            self.swarm.loop.call_later(random.expovariate(self.swarm.args.churn), self.drop, conn_handler)
+
+    # Simulate the connection dropping
+    def drop(self, conn_handler):
+        if conn_handler is self.conn_handler and not self.stopped:
+            conn_handler.close()
+
+    # Push a batch of rows every subscribed period, as a client's MetricCollector does
+    def push(self, conn_handler):
+        if conn_handler is not self.conn_handler or not self.stream_period or self.stopped:
+            return
+        metric_dict = dict(metrics=self.swarm.stream_rows, period=self.stream_period, stream="hardware_metrics")
+        conn_handler.send_message(Message(content=Request(RequestType.METRIC, metric_dict)))
+        self.swarm.loop.call_later(self.stream_period, self.push, conn_handler)
+
+    def connection_lost(self, conn_handler):
+        if conn_handler is not self.conn_handler:
+            return
+        self.conn_handler = None
+        self.stream_period = 0
+        if not self.stopped:
+            delay = self.swarm.args.reconnect_delay + backoff_delay(0)
+            self.swarm.loop.call_later(delay, lambda: self.swarm.loop.create_task(self.connect()))
+
+    def handle(self, item: Message):
+        content = item.content.request
+        action = content['action']
+        conn_handler = item.conn_handler
+        if action == RequestType.HANDSHAKE and content['response']:
+            # Same as a real client, switch to what the server picked
+            if 'codec' in content:
+                conn_handler.codec = CODECS[content['codec']]
+            if content.get('compression') is not None:
+                conn_handler.compressor = Compressor(content['compression'], 6, 1024, conn_handler.compression_stats)
+        elif action == RequestType.METRIC and content.get('subscribe'):
+            if not self.stream_period and content['period'] > 0:
+                self.swarm.loop.call_later(random.uniform(0, content['period']), self.push, conn_handler)
+            self.stream_period = content['period']
+            content['response'] = True
+            item.content = Request(RequestType.METRIC, content)
+            conn_handler.send_message(item, is_response=True)
+        elif action == RequestType.METRIC and not content['response']:
+            item.content = Request(RequestType.METRIC, dict(period=content['period'], metrics=self.swarm.metric_rows,
+                                                            response=True))
+            conn_handler.send_message(item, is_response=True)
+        elif action == RequestType.COMPONENT and not content['response']:
+            content['response'] = True
+            content['results'] = [True for _ in content['component_actions']]
+            item.content = Request(RequestType.COMPONENT, content)
+            conn_handler.send_message(item, is_response=True)
+        elif action == RequestType.PING:
+            item.content = Request(RequestType.ACK, dict(sent=content['sent'], response=True))
+            conn_handler.send_message(item, is_response=True)
+        elif action == RequestType.EXIT:
+            self.stopped = True
+            conn_handler.close()
+
+
+# All fake clients of the child process
+class Swarm:
+    def __init__(self, args, port, loop: asyncio.AbstractEventLoop):
+        self.args = args
+        self.ip = "127.0.0.1"
+        self.port = port
+        self.loop = loop
+        self.compression = [] if args.compression == 'none' else [args.compression]
+        self.receive_queue = asyncio.Queue()
+        self.monitor = AsyncConnectionMonitor(threading.Event(), loop, self.receive_queue)
+        self.monitor.stop_when_idle = False
+        self.clients = [FakeClient(self, i) for i in range(args.clients)]
+        self.num_connects = 0
+        # Every client answers with the same synthetic report, shaped like the server's metric query result
+        self.metric_rows = [{"AVG(cpu)": random.uniform(0, 100), "AVG(memory)": random.uniform(1e8, 1e9),
+                             "pid": 1000 + i, "process_name": f"component-{i}"} for i in range(args.rows)]
+        # Pushed rows are raw samples with the keys and key order of HardwareMetrics.measure: the system wide row
+        # (pid -1) followed by one row per component
+        self.stream_rows = [dict(timestamp=1.0, lag=0.0, pid=-1, cpu=random.uniform(0, 100),
+                                 memory=random.uniform(4e9, 8e9))]
+        self.stream_rows += [dict(timestamp=1.0, lag=0.0, pid=1000 + i, cpu=random.uniform(0, 100),
+                                  memory=random.uniform(1e8, 1e9)) for i in range(args.rows)]
+
+    async def _dispatch(self):
+        while True:
+            item = await self.receive_queue.get()
+            if item is None:
+                continue
+            fake_client = getattr(item.conn_handler, 'fake_client', None)
+            if fake_client is None:
+                continue
+            if isinstance(item, ConnectionClosed):
+                fake_client.connection_lost(item.conn_handler)
+            else:
+                fake_client.handle(item)
+
+    async def run(self, stop_event):
+        dispatcher = self.loop.create_task(self._dispatch())
+        # Ramp up, a burst of thousands of connects overflows the server's listen backlog
+        for i in range(0, len(self.clients), self.args.ramp):
+            for fake_client in self.clients[i:i + self.args.ramp]:
+                self.loop.create_task(fake_client.connect())
+            await asyncio.sleep(1)
+        while not stop_event.is_set() and not all(c.stopped for c in self.clients):
+            await asyncio.sleep(0.2)
+        for fake_client in self.clients:
+            fake_client.stopped = True
+        dispatcher.cancel()
+
+
+def run_swarm(args, port, stop_event):
+    raise_fd_limit()
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.new_event_loop()
+    swarm = Swarm(args, port, loop)
+    loop.run_until_complete(swarm.run(stop_event))
+    print(f"swarm: {swarm.num_connects} connects for {len(swarm.clients)} clients")
+    swarm.monitor.join(timeout=5)
+
+
+# Stands in for Application as the owner of the server side message handler
+class LoadServer:
+    is_server = True
+    finished = False
+
+    def __init__(self, args):
+        self.uuid = uuid.uuid4()
+        self.hardware_stats = dict()
+        self.elapsed_time = 0
+        self.db = None
+        self.net_graph = NetworkGraph("LoadServer", ("127.0.0.1", args.port), NetworkNodeType.CLOUD, self.uuid,
+                                      self.hardware_stats)
+        self.wire_formats = [args.wire_format, 'json']
+        self.compression = [] if args.compression == 'none' else [args.compression]
+        self.compression_level = 6
+        self.compression_threshold = 1024
+        # Subscribed to on every handshake when streaming
+        self.stream_metrics = ["hardware_metrics"] if args.stream else []
+        self.stream_interval = 1 / args.rate
+        self.latency_monitor = LatencyMonitor(self, 0)
+        self.termination_event = threading.Event()
+        if args.transport == 'asyncio':
+            self.loop = asyncio.new_event_loop()
+            self.receive_queue = asyncio.Queue()
+            self.connection_monitor = AsyncConnectionMonitor(self.termination_event, self.loop, self.receive_queue)
+            self.connection_monitor.start_server(('', args.port))
+        else:
+            self.loop = None
+            self.sel = selectors.DefaultSelector()
+            self.receive_queue = Queue()
+            self.connection_monitor = ConnectionMonitor(self.termination_event, self.sel, self.receive_queue)
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(('', args.port))
+            s.listen(1024)
+            s.setblocking(False)
+            self.sel.register(s, selectors.EVENT_READ, data=None)
+            self.connection_monitor.start()
+        self.message_handler = MessageHandler(self.receive_queue, self.termination_event, owner=self, loop=self.loop)
+
+    def connected_nodes(self):
+        return [n for n in self.net_graph.get_all_connected_nodes_self() if n is not None]
+
+
+def run(args):
+    raise_fd_limit()
+    server = LoadServer(args)
+    rss_start = current_rss()
+    stop_event = multiprocessing.Event()
+    swarm = multiprocessing.Process(target=run_swarm, args=(args, args.port, stop_event), name="swarm")
+    swarm.start()
+
+    latencies = []
+    num_requests = num_responses = num_timeouts = 0
+    tick = 1 / args.rate
+    start_t = time.monotonic()
+    report_t = start_t
+    report_responses = 0
+    peak_rss_per_client = 0
+    metric_message = Message(content=Request(RequestType.METRIC, dict(metrics=["hardware_metrics"], period=tick)))
+    try:
+        while time.monotonic() - start_t < args.duration:
+            tick_end = time.monotonic() + tick
+            nodes = server.connected_nodes()
+            sent_t = time.monotonic()
+            events = []
+            for node in nodes:
+                if args.stream and random.random() >= args.component_ratio:
+                    continue
+                if args.stream or random.random() < args.component_ratio:
+                    comp_dict = dict(components=["load"], component_actions=["status"], args=[dict()])
+                    message = Message(content=Request(RequestType.COMPONENT, comp_dict))
+                else:
+                    message = Message(content=metric_message.content)
+                events.append(node.conn_handler.send_message_and_wait_response(message, yield_message=True))
+            num_requests += len(events)
+            for event in server.message_handler.as_completed(events, max(tick_end - time.monotonic(), 0)):
+                if event.is_set():
+                    latencies.append(time.monotonic() - sent_t)
+                    num_responses += 1
+                else:
+                    num_timeouts += 1
+            # Handle whatever else arrived (handshakes, closes) until the next tick
+            server.message_handler.dispatch_for(tick_end - time.monotonic())
+
+            now = time.monotonic()
+            if now - report_t >= 1:
+                if nodes:
+                    peak_rss_per_client = max(peak_rss_per_client, (current_rss() - rss_start) / len(nodes))
+                print(f"{now - start_t:6.1f}s clients {len(nodes):6d} responses/s "
+                      f"{(num_responses - report_responses) / (now - report_t):10,.0f} timeouts {num_timeouts}")
+                report_t = now
+                report_responses = num_responses
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.monotonic() - start_t
+    nodes = server.connected_nodes()
+    rss_per_client = (current_rss() - rss_start) / len(nodes) if nodes else 0
+
+    # End the swarm's sessions the way an experiment ends, with an EXIT to every client
+    for node in nodes:
+        node.conn_handler.send_message(Message(content=Request(RequestType.EXIT)))
+    server.message_handler.dispatch_for(1)
+    stop_event.set()
+    swarm.join(30)
+    server.termination_event.set()
+    server.connection_monitor.join(timeout=5)
+
+    latencies.sort()
+    print(f"transport {args.transport}, wire format {args.wire_format}, compression {args.compression}")
+    print(f"clients connected at end {len(nodes)}, sessions seen {len(server.net_graph._nodes) - 1}")
+    print(f"requests {num_requests}, responses {num_responses}, timeouts {num_timeouts}, "
+          f"throughput {num_responses / elapsed:,.0f} responses/s")
+    print(f"latency ms p50 {percentile(latencies, 50) * 1000:.2f} p90 {percentile(latencies, 90) * 1000:.2f} "
+          f"p99 {percentile(latencies, 99) * 1000:.2f} max {percentile(latencies, 100) * 1000:.2f}")
+    for action, stats in server.message_handler.get_stats().items():
+        print(f"handler {action:<10} count {stats['count']:8d} avg ms {stats['avg_ms']:.3f} max ms {stats['max_ms']:.3f}")
+        if 'us_per_sample' in stats:
+            print(f"        {'':<10} samples {stats['samples']:8d} us per sample {stats['us_per_sample']:.2f}")
+    print(f"server memory per client KiB now {rss_per_client / 1024:.1f} peak {peak_rss_per_client / 1024:.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resource server load generator.')
+    parser.add_argument('-n', '--clients', type=int, default=200)
+    parser.add_argument('-d', '--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('-r', '--rate', type=float, default=2, help='request rounds per second')
+    parser.add_argument('--rows', type=int, default=20, help='rows per synthetic metric response')
+    parser.add_argument('--stream', default=False, action='store_true',
+                        help='clients push metrics every round instead of being polled for them')
+    parser.add_argument('--component-ratio', type=float, default=0.1,
+                        help='fraction of requests that are COMPONENT status requests')
+    parser.add_argument('--churn', type=float, default=0,
+                        help='disconnects per client per second, e.g. 0.01 drops each client every ~100s')
+    parser.add_argument('--reconnect-delay', type=float, default=0.5, help='seconds before a dropped client reconnects')
+    parser.add_argument('--ramp', type=int, default=200, help='clients connecting per second at startup')
+    parser.add_argument('--transport', choices=['asyncio', 'selector'], default='asyncio')
+    parser.add_argument('--wire-format', choices=list(CODECS), default='binary')
+    parser.add_argument('--compression', choices=['zlib', 'none'], default='zlib')
+    parser.add_argument('-p', '--port', type=int, default=25556)
+    parser.add_argument('-v', '--verbose', default=False, action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    run(args)
@@ -3,6 +3,7 @@ import argparse
 import os
 
 from src.app.Application import Application
+from src.PerformanceReport.MetricExport import export_run
 import logging
 
 # Python entry point
@@ -10,6 +11,9 @@ if __name__ == '__main__':
     # Read configuration
     parser = argparse.ArgumentParser(description='Reads and controls game network resources.')
     parser.add_argument('-s', '--server', default=False, action='store_true')
+    parser.add_argument('--export', nargs='+', metavar='DB',
+                        help='export the metric databases of finished runs to columnar files and exit')
+    parser.add_argument('--export-dir', default='./exports', help='directory the exported runs are written to')
     args = parser.parse_args()
     CONFIG = configparser.ConfigParser()
     CONFIG.read('config.ini')
@@ -29,7 +33,12 @@ if __name__ == '__main__':
     if not os.path.isdir('./logs'):
         os.makedirs('./logs')
 
-    # Begin resource monitoring
-    app = Application(CONFIG, args.server)
-    app.start()
+    if args.export:
+        # One directory of memory mappable column arrays (and Parquet files if pyarrow is installed) per run
+        for db_file in args.export:
+            export_run(db_file, args.export_dir)
+    else:
+        # Begin resource monitoring
+        app = Application(CONFIG, args.server)
+        app.start()
 
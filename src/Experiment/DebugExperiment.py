@@ -57,10 +57,12 @@ class DebugExperiment(Experiment):
         message = Message(content=Request(RequestType.COMPONENT, comp_dict))
         future1 = self.node_1.conn_handler.send_message_and_wait_response(message, yield_message=True)
 
-        if not self.message_handler.wait_for_responses([future1], 30):
+        message1, = self.message_handler.gather([future1], 30)
+        if message1 is None:
             logging.error(f"Timeout on launching game server!")
+            return False
 
-        resp_1 = future1.get_message().content.request
+        resp_1 = message1.content.request
         if resp_1['action'] != RequestType.COMPONENT:
             logging.error(f"Failed to start game server component.")
             return False
@@ -73,10 +75,12 @@ class DebugExperiment(Experiment):
         message = Message(content=Request(RequestType.COMPONENT, comp_dict))
         future1 = self.node_1.conn_handler.send_message_and_wait_response(message, yield_message=True)
 
-        if not self.message_handler.wait_for_responses([future1], 30):
+        message1, = self.message_handler.gather([future1], 30)
+        if message1 is None:
             logging.error(f"Timeout on launching game client!")
+            return False
 
-        resp_1 = future1.get_message().content.request
+        resp_1 = message1.content.request
         if resp_1['action'] != RequestType.COMPONENT:
             logging.error(f"Failed to start game client components.")
             return False
@@ -86,6 +90,11 @@ class DebugExperiment(Experiment):
 
     def _retrieve_metrics(self):
         metric_dict = dict(metrics=["hardware_metrics"], period=self.sampling_frequency)
+        if not self.node_1.is_active:
+            return
+        if self.node_1.conn_handler.is_backpressured():
+            logging.debug(f"Send queue to {self.node_1.name} is backed up, skipping metric request")
+            return
         message = Message(content=Request(RequestType.METRIC, metric_dict))
         self.node_1.conn_handler.send_message(message)
 
@@ -102,11 +111,7 @@ class DebugExperiment(Experiment):
         self._retrieve_metrics()
 
         # check stop conditions
-        if not self.node_1.is_active:
+        if self.node_1.is_lost(self.reconnect_grace):
             logging.info(f"Experiment peer is now inactive, stopping experiment.")
             return False
         return True
-
-    def end(self):
-        message = Message(content=Request(RequestType.EXIT))
-        self.node_1.conn_handler.send_message(message)  # don't wait for a response
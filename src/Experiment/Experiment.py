@@ -10,6 +10,8 @@ class Experiment:
     message_handler = None
     sampling_frequency = -1
     duration = -1
+    # Seconds a disconnected peer has to reconnect before the experiment gives up on it
+    reconnect_grace = 0
 
     # Perform local and remote component setup steps
     def setup(self, net_graph, message_handler, termination_event):
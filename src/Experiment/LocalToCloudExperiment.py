@@ -94,12 +94,13 @@ class LocalToCloudExperiment(Experiment):
         message = Message(content=Request(RequestType.COMPONENT, comp_dict))
         future1 = self.local_node.conn_handler.send_message_and_wait_response(message, yield_message=True)
 
-        if not self.message_handler.wait_for_responses([future1, future2], 60):
+        message1, message2 = self.message_handler.gather([future1, future2], 60)
+        if message1 is None or message2 is None:
             logging.error(f"Timeout on pairing the game stream server and client!")
             return False
 
-        resp_1 = future1.get_message().content.request['results']
-        resp_2 = future2.get_message().content.request['results']
+        resp_1 = message1.content.request['results']
+        resp_2 = message2.content.request['results']
         if resp_1[0] != "PAIRED" or resp_2[0] != "PAIRED":
             logging.error(f"Failed to pair the game stream server and client!")
             return False
@@ -111,11 +112,12 @@ class LocalToCloudExperiment(Experiment):
         message = Message(content=Request(RequestType.COMPONENT, comp_dict))
         future1 = self.local_node.conn_handler.send_message_and_wait_response(message, yield_message=True)
 
-        if not self.message_handler.wait_for_responses([future1], 30):
+        message1, = self.message_handler.gather([future1], 30)
+        if message1 is None:
             logging.error(f"Timeout on launching game server!")
             return False
 
-        resp_1 = future1.get_message().content.request['results']
+        resp_1 = message1.content.request['results']
         if resp_1[0] == -1 or resp_1[1] != "READY":
             logging.error(f"Failed to start game server component.")
             return False
@@ -133,12 +135,13 @@ class LocalToCloudExperiment(Experiment):
         future1 = self.local_node.conn_handler.send_message_and_wait_response(message, yield_message=True)
         future2 = self.remote_node.conn_handler.send_message_and_wait_response(message, yield_message=True)
 
-        if not self.message_handler.wait_for_responses([future1, future2], 35):
+        message1, message2 = self.message_handler.gather([future1, future2], 35)
+        if message1 is None or message2 is None:
             logging.error(f"Timeout on launching game clients!")
             return False
 
-        resp_1 = future1.get_message().content.request['results']
-        resp_2 = future2.get_message().content.request['results']
+        resp_1 = message1.content.request['results']
+        resp_2 = message2.content.request['results']
         if resp_1[0] == -1 or resp_2[0] == -1:
             logging.error(f"Failed to start game client components.")
             return False
@@ -163,8 +166,14 @@ class LocalToCloudExperiment(Experiment):
     def _retrieve_metrics(self):
         metric_dict = dict(metrics=["hardware_metrics"], period=self.sampling_frequency)
         message = Message(content=Request(RequestType.METRIC, metric_dict))
-        self.local_node.conn_handler.send_message(message)
-        self.remote_node.conn_handler.send_message(message)
+        for node in [self.local_node, self.remote_node]:
+            if not node.is_active:
+                continue
+            # Skip this round for peers that are not keeping up, the next request covers the same period
+            if node.conn_handler.is_backpressured():
+                logging.debug(f"Send queue to {node.name} is backed up, skipping metric request")
+                continue
+            node.conn_handler.send_message(message)
 
     # One iteration of experiment loop
     def experiment_step(self):
@@ -180,16 +189,7 @@ class LocalToCloudExperiment(Experiment):
         # self._retrieve_metrics()
 
         # check stop conditions
-        if not self.local_node.is_active or not self.remote_node.is_active:
+        if self.local_node.is_lost(self.reconnect_grace) or self.remote_node.is_lost(self.reconnect_grace):
             logging.info(f"Experiment peer is now inactive, stopping experiment.")
             return False
         return True
-
-    def end(self):
-        if not self.is_server:
-            return
-        message = Message(content=Request(RequestType.EXIT))
-        if self.remote_node is not None:
-            self.remote_node.conn_handler.send_message(message)  # don't wait for a response
-        if self.local_node is not None:
-            self.local_node.conn_handler.send_message(message)
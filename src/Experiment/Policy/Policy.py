@@ -60,10 +60,11 @@ class StartComponentAction(PolicyAction):
         future = self.target_node.conn_handler.send_message_and_wait_response(self.start_component_message,
                                                                               yield_message=True)
         comp_name = self.start_component_message.content.request['components']
-        if not self.message_handler.wait_for_responses([future], 5):
+        response, = self.message_handler.gather([future], 5)
+        if response is None:
             logging.error(f"Timeout on starting component: {comp_name}")
             return False
-        resp = future.get_message().content.request['results']
+        resp = response.content.request['results']
         if resp[0] == -1:
             logging.error(f"Failed to start {comp_name}.")
             return False
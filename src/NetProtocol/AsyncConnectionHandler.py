@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import traceback
+from threading import Event
+
+from src.NetProtocol.ConnectionHandler import ConnectionClosed, ConnectionHandler
+from src.Utility.NetworkUtilities import backoff_delay
+
+
+# Handles setting up connections on an asyncio event loop. Unlike ConnectionMonitor this is not a thread, the loop is
+# driven by whoever is waiting on it (see MessageHandler.dispatch_for), so an idle process sleeps in select.
+class AsyncConnectionMonitor:
+    def __init__(self, termination_event: Event, loop: asyncio.AbstractEventLoop, receive_queue: asyncio.Queue):
+        self.termination_event = termination_event
+        self.loop = loop
+        self.receive_queue = receive_queue
+        self.connection_number = 1
+        self.connections = set()
+        self.server = None
+        self._all_closed = asyncio.Event()
+        # Stop once no connection is left. Clients that reconnect keep going while disconnected.
+        self.stop_when_idle = True
+        self._reconnect_task = None
+
+    # Listen for new connections on addr
+    def start_server(self, addr):
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(self._accept_wrapper, host=addr[0] or None, port=addr[1], reuse_address=True))
+
+    # Connect to a server, returns the connection handler or None
+    def connect(self, ip, port, num_retries, timeout) -> "AsyncConnectionHandler":
+        return self.loop.run_until_complete(self._connect(ip, port, num_retries, timeout))
+
+    # Connect to ip:port again in the background with backoff, on_connected is called with the new handler. Runs while
+    # the loop is driven, e.g. by MessageHandler.dispatch_for.
+    def reconnect(self, ip, port, timeout, on_connected):
+        self._reconnect_task = self.loop.create_task(self._reconnect(ip, port, timeout, on_connected))
+
+    async def _reconnect(self, ip, port, timeout, on_connected):
+        conn_handler = await self._connect(ip, port, None, timeout)
+        if conn_handler is not None:
+            logging.info(f"Reconnected to {ip}:{port}")
+            on_connected(conn_handler)
+
+    # With num_retries None it keeps trying until the termination event is set
+    async def _connect(self, ip, port, num_retries, timeout):
+        attempt = 0
+        while num_retries is None or attempt < num_retries:
+            if attempt:
+                await asyncio.sleep(backoff_delay(attempt - 1))
+                if self.termination_event.is_set():
+                    return None
+            attempt += 1
+            try:
+                _, conn_handler = await asyncio.wait_for(
+                    self.loop.create_connection(lambda: AsyncConnectionHandler(self, (ip, port), 0), ip, port),
+                    timeout)
+                return conn_handler
+            except asyncio.TimeoutError:
+                logging.debug(f"timed out connecting to {ip}:{port}, retrying...")
+            except ConnectionRefusedError:
+                logging.debug(f"connection refused to {ip}:{port}, retrying...")
+            except OSError as e:
+                # e.g. network unreachable while an interface is down
+                logging.debug(f"could not connect to {ip}:{port} ({e!r}), retrying...")
+        logging.error(f"Could not connect to {ip}:{port}")
+        return None
+
+    # Protocol factory for a new incoming connection
+    def _accept_wrapper(self):
+        conn_handler = AsyncConnectionHandler(self, None, self.connection_number)
+        self.connection_number += 1
+        return conn_handler
+
+    def connection_opened(self, conn_handler: "AsyncConnectionHandler"):
+        self.connections.add(conn_handler)
+        self._all_closed.clear()
+
+    def connection_closed(self, conn_handler: "AsyncConnectionHandler"):
+        self.connections.discard(conn_handler)
+        if self.connections:
+            return
+        self._all_closed.set()
+        # Same as the selector loop: with nothing left to monitor we are done
+        if self.server is None and self.stop_when_idle:
+            self.termination_event.set()
+            # Wake anything waiting on the receive queue
+            self.receive_queue.put_nowait(None)
+
+    # Close all connections and the event loop, mirrors Thread.join of ConnectionMonitor
+    def join(self, timeout=None):
+        if self.loop.is_closed():
+            return
+        if self.server is not None:
+            self.server.close()
+        if self._reconnect_task is not None and not self._reconnect_task.done():
+            self._reconnect_task.cancel()
+            self.loop.run_until_complete(asyncio.gather(self._reconnect_task, return_exceptions=True))
+        for conn_handler in list(self.connections):
+            conn_handler.close()
+        if self.connections:
+            try:
+                self.loop.run_until_complete(asyncio.wait_for(self._all_closed.wait(), timeout))
+            except asyncio.TimeoutError:
+                logging.warning(f"Timed out waiting for {len(self.connections)} connections to close.")
+        logging.debug(f"Connection handler stopped.")
+        self.loop.close()
+
+
+# Handles receiving and sending on a specific connection, callbacks are run by the event loop. As a buffered protocol
+# the transport reads straight into the same receive buffer ConnectionHandler parses from.
+class AsyncConnectionHandler(ConnectionHandler, asyncio.BufferedProtocol):
+    def __init__(self, monitor: AsyncConnectionMonitor, addr, num):
+        super().__init__(selector=None, sock=None, addr=addr, num=num, receive_queue=monitor.receive_queue)
+        self.monitor = monitor
+        self.transport = None
+        # Set while the transport's own buffer is above its high-water mark, frames then wait in the send queue where
+        # the overflow policy applies
+        self._writing_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        logging.info(f"Connection established with {self.addr}")
+        self.monitor.connection_opened(self)
+
+    def get_buffer(self, sizehint):
+        return self._get_recv_space()
+
+    def buffer_updated(self, nbytes):
+        self._recv_advance(nbytes)
+        try:
+            self._process_frames()
+        except Exception:
+            logging.error(f"Exception in message from/to {self.addr}\n:{traceback.format_exc()}")
+            self.close()
+
+    def connection_lost(self, exc):
+        logging.info(f"Peer at {self.addr} closed.")
+        logging.info(f"Connection stats for {self.addr}: {self.get_stats()}")
+        if self.peer is not None:
+            self.peer.deactivate(self)
+        self.transport = None
+        self._receive_queue.put_nowait(ConnectionClosed(self))
+        self.monitor.connection_closed(self)
+
+    # Flush once the current loop iteration is done, so frames sent together go out in a single write. Thread safe,
+    # component jobs send their responses from worker threads.
+    def _request_write(self):
+        self.monitor.loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        with self._send_queue.lock:
+            self._write_requested = False
+            if self._writing_paused:
+                # resume_writing flushes
+                return
+        frames = self._send_queue.take()
+        self._send_queue.sent(sum(len(frame) for frame in frames), len(frames))
+        if self.transport is None or self.transport.is_closing():
+            logging.error(f"Dropping {len(frames)} message(s) to closed connection {self.addr}")
+            return
+        # The transport buffers whatever the socket does not take and only polls for writes while it has data
+        self.transport.writelines(frames)
+
+    def pause_writing(self):
+        logging.debug(f"Transport to {self.addr} is full, holding back sends")
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._flush()
+
+    # Sends come from the thread running the loop, which is also the one that would have to drain the queue
+    def _can_block_on_send(self) -> bool:
+        return False
+
+    def close(self):
+        logging.info(f"Closing connection to {self.addr}")
+        if self.peer is not None:
+            self.peer.deactivate(self)
+        if self.transport is not None:
+            self.transport.close()
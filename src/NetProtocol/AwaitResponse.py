@@ -1,15 +1,25 @@
+import heapq
 import threading
+import time
 from typing import Union
 
 from src.NetProtocol.Message import Message
 
 
-# Event object for a message arriving.
+# Event object for a message arriving. Is done once the response arrived (set) or it was cancelled, either explicitly,
+# because its deadline passed or because the connection closed.
 class MessageEvent(threading.Event):
-    def __init__(self, yield_message):
+    def __init__(self, yield_message, CSeq=None, deadline=None, pending: "PendingRequests" = None):
         super().__init__()
         self.message = None
         self.yield_message = yield_message
+        self.CSeq = CSeq
+        self.deadline = deadline  # time.monotonic() after which the response is no longer awaited
+        self.cancelled = False
+        self._pending = pending
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+        self._finished = False
 
     def set_message(self, message: Message):
         self.message = message
@@ -19,3 +29,103 @@ class MessageEvent(threading.Event):
             return self.message
         else:
             return None
+
+    def done(self) -> bool:
+        return self.is_set() or self.cancelled
+
+    def set(self):
+        super().set()
+        self._run_callbacks()
+
+    # Call fn(event) once the event is done, right away if it already is
+    def add_done_callback(self, fn):
+        with self._callbacks_lock:
+            if not self._finished:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _run_callbacks(self):
+        with self._callbacks_lock:
+            if self._finished:
+                return
+            self._finished = True
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            fn(self)
+
+    def _mark_cancelled(self):
+        self.cancelled = True
+        self._run_callbacks()
+
+    def expired(self, now=None) -> bool:
+        return self.deadline is not None and (time.monotonic() if now is None else now) >= self.deadline
+
+    # Stop waiting for the response, a late response is handled as if it was never awaited
+    def cancel(self) -> bool:
+        if self.done():
+            return False
+        if self._pending is not None:
+            self._pending.discard(self)
+        self._mark_cancelled()
+        return True
+
+
+# Table of requests sent on a connection that are awaiting a response, by CSeq
+class PendingRequests:
+    def __init__(self):
+        self._events: dict[int, MessageEvent] = dict()
+        self._deadlines = []  # heap of (deadline, CSeq, event), entries of resolved events are skipped when popped
+        self._lock = threading.Lock()
+
+    def __contains__(self, CSeq):
+        return CSeq in self._events
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, CSeq, yield_message, timeout=None) -> MessageEvent:
+        self.sweep()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        event = MessageEvent(yield_message, CSeq, deadline, self)
+        with self._lock:
+            previous = self._events.get(CSeq)
+            self._events[CSeq] = event
+            if deadline is not None:
+                heapq.heappush(self._deadlines, (deadline, CSeq, event))
+        if previous is not None:
+            previous._mark_cancelled()
+        return event
+
+    # Remove and return the event awaiting this CSeq, None if nothing (or no longer anything) is waiting on it
+    def resolve(self, CSeq) -> Union[None, MessageEvent]:
+        with self._lock:
+            return self._events.pop(CSeq, None)
+
+    def discard(self, event: MessageEvent):
+        with self._lock:
+            if self._events.get(event.CSeq) is event:
+                del self._events[event.CSeq]
+
+    # Cancel all requests whose deadline has passed, returns how many were cancelled
+    def sweep(self, now=None) -> int:
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, CSeq, event = heapq.heappop(self._deadlines)
+                if self._events.get(CSeq) is event:
+                    del self._events[CSeq]
+                    expired.append(event)
+        for event in expired:
+            event._mark_cancelled()
+        return len(expired)
+
+    def cancel_all(self):
+        with self._lock:
+            events = list(self._events.values())
+            self._events.clear()
+            self._deadlines.clear()
+        for event in events:
+            event._mark_cancelled()
@@ -0,0 +1,216 @@
+import struct
+import sys
+from typing import TYPE_CHECKING
+
+from src.NetProtocol.Compression import Compressor, decompress
+from src.NetProtocol.Request import Request, RequestType
+from src.Utility.NetworkUtilities import json_decode, json_encode
+
+if TYPE_CHECKING:
+    from src.NetProtocol.ConnectionHandler import ConnectionHandler
+    from src.NetProtocol.Message import Message
+
+
+# Required headers in the JSON header
+REQUIRED_HEADERS = [
+    "byteorder",
+    "content_length",
+    "content_type",
+    "content_encoding",
+    "CSeq"
+]
+
+# First byte of every binary frame. A JSON frame starts with the high byte of its header length, which would need a
+# header of over 46k to collide, so the receiver can tell the codec of each frame without any negotiated state.
+BINARY_MAGIC = 0xB5
+
+
+# Reject a frame whose content is larger than the connection accepts, before any of it is buffered
+def check_frame_size(conn_handler: "ConnectionHandler", content_len):
+    if content_len > conn_handler.max_frame_size:
+        raise ValueError(f"Frame content of {content_len} bytes exceeds the limit of {conn_handler.max_frame_size}.")
+
+
+# Turns messages into frames and parses frames from a connection's receive buffer
+class Codec:
+    name = "unknown"
+
+    # Serialize a message into a single frame
+    def encode(self, message: "Message", compressor: Compressor = None) -> bytes:
+        return self.encode_frame(message, self.encode_body(message, compressor))
+
+    # Encode the parts of a frame that only depend on the message content and compression, these are cached by the
+    # message. The content is compressed if a compressor is given and it decides the content is worth compressing.
+    def encode_body(self, message: "Message", compressor: Compressor = None) -> tuple:
+        pass
+
+    # Build the frame for the message's current CSeq around an encoded body
+    def encode_frame(self, message: "Message", body: tuple) -> bytes:
+        pass
+
+    # Parse the frame at the front of the receive buffer into message, which keeps state between calls while the frame
+    # is incomplete. Returns True once the whole frame has been parsed.
+    def decode(self, conn_handler: "ConnectionHandler", message: "Message") -> bool:
+        pass
+
+
+# Original framing: 2 byte big endian header length, JSON header, JSON content
+class JsonCodec(Codec):
+    name = "json"
+
+    # Body is the encoded content and the JSON header up to the CSeq value, which is always the last header field
+    def encode_body(self, message: "Message", compressor: Compressor = None) -> tuple:
+        content_bytes = json_encode(message.content.request, message.content.encoding)
+        compressed = compressor.compress(content_bytes) if compressor is not None else None
+        header = dict(
+            byteorder=sys.byteorder,
+            content_length=len(content_bytes if compressed is None else compressed),
+            content_type=message.content.m_type,
+            content_encoding=message.content.encoding
+        )
+        if compressed is not None:
+            content_bytes = compressed
+            header['content_compression'] = compressor.name
+        header['CSeq'] = 0
+        header_prefix = json_encode(header, "utf-8")
+        header_prefix = header_prefix[:header_prefix.rindex(b'0')]
+        return content_bytes, header_prefix
+
+    def encode_frame(self, message: "Message", body: tuple) -> bytes:
+        content_bytes, header_prefix = body
+        json_header_bytes = header_prefix + str(message.CSeq).encode("utf-8") + b"}"
+        if len(json_header_bytes) >> 8 == BINARY_MAGIC:
+            raise ValueError(f"JSON header of {len(json_header_bytes)} bytes is too long.")
+        return struct.pack(">H", len(json_header_bytes)) + json_header_bytes + content_bytes
+
+    def decode(self, conn_handler: "ConnectionHandler", message: "Message") -> bool:
+        # could take multiple reads to process single message, so keep track of headers
+        if message.json_header_len is None:
+            self._process_protoheader(conn_handler, message)
+
+        if message.json_header_len is not None:
+            if message.json_header is None:
+                self._process_jsonheader(conn_handler, message)
+
+        if message.json_header:
+            if message.content is None:
+                return self._process_message(conn_handler, message)
+        return False
+
+    # Process the fixed length header (2 byte, big endian), gives length of following JSON header
+    @staticmethod
+    def _process_protoheader(conn_handler: "ConnectionHandler", message: "Message"):
+        hdrlen = 2
+        if conn_handler._recv_pending() >= hdrlen:
+            message.json_header_len = struct.unpack(">H", conn_handler._recv_consume(hdrlen))[0]
+
+    # Process variable length json_header
+    @staticmethod
+    def _process_jsonheader(conn_handler: "ConnectionHandler", message: "Message"):
+        hdrlen = message.json_header_len
+        if conn_handler._recv_pending() >= hdrlen:
+            message.json_header = json_decode(conn_handler._recv_consume(hdrlen), "utf-8")
+            for req_hdr in REQUIRED_HEADERS:
+                if req_hdr not in message.json_header:
+                    raise ValueError(f"Missing required header '{req_hdr}'.")
+            # Make sure CSeq is correct on the message
+            message.CSeq = message.json_header['CSeq']
+
+    # Process message after reading the header
+    @staticmethod
+    def _process_message(conn_handler: "ConnectionHandler", message: "Message") -> bool:
+        hdr = message.json_header
+        content_len = hdr["content_length"]
+        check_frame_size(conn_handler, content_len)
+        # don't process now if we haven't received the whole message yet
+        if not conn_handler._recv_pending() >= content_len:
+            return False
+        # get received content
+        data = conn_handler._recv_consume(content_len)
+        if "content_compression" in hdr:
+            data = decompress(hdr["content_compression"], data, conn_handler.compression_stats,
+                              conn_handler.max_frame_size)
+
+        if hdr["content_type"] == "text/json":
+            message.content = Request(content=json_decode(data, hdr["content_encoding"]))
+        else:
+            # Binary or unknown content-type, copied out since the receive buffer is reused
+            message.content = bytes(data)
+        return True
+
+
+# Compact framing: fixed struct header (magic, action, flags, CSeq, content length) followed by a compact JSON body
+# without the action and response fields. Lists of metric rows are sent as a column list plus value rows.
+class BinaryCodec(Codec):
+    name = "binary"
+    header = struct.Struct(">BBBiI")
+    FLAG_RESPONSE = 0x01
+    FLAG_ROWS = 0x02
+    # Compression algorithm of the content, one flag per algorithm
+    COMPRESSION_FLAGS = dict(zlib=0x04)
+
+    # Body is the flags and the encoded content
+    def encode_body(self, message: "Message", compressor: Compressor = None) -> tuple:
+        body = dict(message.content.request)
+        action = body.pop('action')
+        flags = self.FLAG_RESPONSE if body.pop('response', False) else 0
+        rows = body.get('metrics')
+        if rows and all(isinstance(row, dict) for row in rows):
+            columns = list(rows[0].keys())
+            # Same keys in any order, the values are taken in column order
+            if all(row.keys() == rows[0].keys() for row in rows):
+                body['metrics'] = dict(columns=columns, rows=[[row[column] for column in columns] for row in rows])
+                flags |= self.FLAG_ROWS
+        content_bytes = json_encode(body, "utf-8") if body else b""
+        compressed = compressor.compress(content_bytes) if compressor is not None else None
+        if compressed is not None:
+            content_bytes = compressed
+            flags |= self.COMPRESSION_FLAGS[compressor.name]
+        return action, flags, content_bytes
+
+    def encode_frame(self, message: "Message", body: tuple) -> bytes:
+        action, flags, content_bytes = body
+        return self.header.pack(BINARY_MAGIC, action, flags, message.CSeq, len(content_bytes)) + content_bytes
+
+    def decode(self, conn_handler: "ConnectionHandler", message: "Message") -> bool:
+        if message.json_header is None:
+            if conn_handler._recv_pending() < self.header.size:
+                return False
+            _, action, flags, CSeq, content_len = self.header.unpack(conn_handler._recv_consume(self.header.size))
+            check_frame_size(conn_handler, content_len)
+            message.json_header = dict(action=action, flags=flags, CSeq=CSeq, content_length=content_len)
+            message.CSeq = CSeq
+        hdr = message.json_header
+        if conn_handler._recv_pending() < hdr['content_length']:
+            return False
+        data = conn_handler._recv_consume(hdr['content_length'])
+        for name, flag in self.COMPRESSION_FLAGS.items():
+            if hdr['flags'] & flag:
+                data = decompress(name, data, conn_handler.compression_stats, conn_handler.max_frame_size)
+        body = json_decode(data, "utf-8") if hdr['content_length'] else dict()
+        if hdr['flags'] & self.FLAG_ROWS:
+            columns = body['metrics']['columns']
+            body['metrics'] = [dict(zip(columns, row)) for row in body['metrics']['rows']]
+        body['action'] = RequestType(hdr['action'])
+        body['response'] = bool(hdr['flags'] & self.FLAG_RESPONSE)
+        message.content = Request(content=body)
+        return True
+
+
+CODECS = {codec.name: codec for codec in [JsonCodec(), BinaryCodec()]}
+DEFAULT_CODEC = CODECS[JsonCodec.name]
+
+
+# Codec a frame was sent with, from the first byte of the frame
+def codec_for_frame(first_byte: int) -> Codec:
+    if first_byte == BINARY_MAGIC:
+        return CODECS[BinaryCodec.name]
+    return CODECS[JsonCodec.name]
+
+
+# First of the peer's supported codecs, in its order of preference, that we also support
+def choose_codec(peer_codecs: list, own_codecs: list) -> str:
+    for name in peer_codecs:
+        if name in own_codecs and name in CODECS:
+            return name
+    return DEFAULT_CODEC.name
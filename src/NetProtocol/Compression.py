@@ -0,0 +1,85 @@
+import time
+import zlib
+
+# Inflate at most max_size bytes, a payload inflating to more is rejected before it is allocated
+def _zlib_decompress(data, max_size) -> bytes:
+    decompressor = zlib.decompressobj()
+    raw = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Compressed payload inflates to more than {max_size} bytes.")
+    if not decompressor.eof:
+        raise ValueError("Truncated compressed payload.")
+    return raw
+
+
+# Supported payload compression algorithms: name -> (compress(data, level), decompress(data, max_size))
+ALGORITHMS = dict(
+    zlib=(zlib.compress, _zlib_decompress)
+)
+
+
+# Per connection compression counters, CPU time is measured with the thread CPU clock of the calling thread
+class CompressionStats:
+    def __init__(self):
+        self.num_compressed = 0
+        self.num_uncompressed = 0  # Payloads below the threshold or that did not shrink
+        self.raw_out = 0
+        self.compressed_out = 0
+        self.compress_time = 0.0
+        self.num_decompressed = 0
+        self.compressed_in = 0
+        self.raw_in = 0
+        self.decompress_time = 0.0
+
+    def report(self) -> dict:
+        return dict(
+            num_compressed=self.num_compressed,
+            num_uncompressed=self.num_uncompressed,
+            ratio_out=self.raw_out / self.compressed_out if self.compressed_out else 1.0,
+            compress_cpu_ms=self.compress_time * 1000,
+            num_decompressed=self.num_decompressed,
+            ratio_in=self.raw_in / self.compressed_in if self.compressed_in else 1.0,
+            decompress_cpu_ms=self.decompress_time * 1000
+        )
+
+
+# Compresses outgoing payloads of one connection with the algorithm agreed on in the handshake
+class Compressor:
+    def __init__(self, name, level, threshold, stats: CompressionStats):
+        if name not in ALGORITHMS:
+            raise ValueError(f"Unsupported compression {name!r}.")
+        self.name = name
+        self.level = level
+        self.threshold = threshold  # Payloads smaller than this many bytes are sent as is
+        self.stats = stats
+        self._compress = ALGORITHMS[name][0]
+
+    # Returns the compressed payload, or None if it should be sent uncompressed
+    def compress(self, data: bytes):
+        if len(data) < self.threshold:
+            self.stats.num_uncompressed += 1
+            return None
+        start_t = time.thread_time()
+        compressed = self._compress(data, self.level)
+        self.stats.compress_time += time.thread_time() - start_t
+        if len(compressed) >= len(data):
+            self.stats.num_uncompressed += 1
+            return None
+        self.stats.num_compressed += 1
+        self.stats.raw_out += len(data)
+        self.stats.compressed_out += len(compressed)
+        return compressed
+
+
+# Inflate a received payload, the algorithm comes from the frame header so it works regardless of negotiation state.
+# Payloads inflating to more than max_size bytes raise ValueError.
+def decompress(name, data, stats: CompressionStats, max_size) -> bytes:
+    if name not in ALGORITHMS:
+        raise ValueError(f"Unsupported compression {name!r}.")
+    start_t = time.thread_time()
+    raw = ALGORITHMS[name][1](data, max_size)
+    stats.decompress_time += time.thread_time() - start_t
+    stats.num_decompressed += 1
+    stats.compressed_in += len(data)
+    stats.raw_in += len(raw)
+    return raw
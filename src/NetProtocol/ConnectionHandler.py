@@ -1,25 +1,26 @@
 import logging
 import queue
-import struct
 import selectors
+import socket as socket_module
 import traceback
+from collections import deque
+from itertools import islice
 from socket import socket
-from threading import Event, Thread
+from threading import Event, Lock, Thread, current_thread
 
-from src.NetProtocol.AwaitResponse import MessageEvent
-from src.NetProtocol.Request import Request
-from src.Utility.NetworkUtilities import json_decode
+from src.NetProtocol.AwaitResponse import MessageEvent, PendingRequests
+from src.NetProtocol.Codec import DEFAULT_CODEC, Codec, codec_for_frame
+from src.NetProtocol.Compression import CompressionStats, Compressor
 from src.NetProtocol.Message import Message
+from src.NetProtocol.SendQueue import DROPPABLE_ACTIONS, SendQueue
+from src.Utility.NetworkUtilities import wait_for_connection
 
 
-# Required headers in the JSON header
-REQUIRED_HEADERS = [
-    "byteorder",
-    "content_length",
-    "content_type",
-    "content_encoding",
-    "CSeq"
-]
+# Queued after the last message of a closed connection. Once handled, responses still awaited on the connection are
+# cancelled, anything it received before closing has been handled by then.
+class ConnectionClosed:
+    def __init__(self, conn_handler: "ConnectionHandler"):
+        self.conn_handler = conn_handler
 
 
 # Handles setting up connections and monitoring all socket connections
@@ -30,6 +31,17 @@ class ConnectionMonitor(Thread):
         self.selector = selector
         self.receive_queue = receive_queue
         self.connection_number = 1
+        # Other threads wake the selector through this socket pair when a connection has something to send
+        self._wakeup_recv, self._wakeup_send = socket_module.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, data=self)
+        self._want_write = set()
+        self._want_write_lock = Lock()
+        # Sockets connected on other threads, registered by the monitor thread on its next wakeup
+        self._pending_register = []
+        # Stop once no connection is left. Clients that reconnect keep the monitor running while disconnected.
+        self.stop_when_idle = True
 
     def run(self):
         try:
@@ -40,6 +52,8 @@ class ConnectionMonitor(Thread):
                     if key.data is None:
                         # A new connection
                         self._accept_wrapper(key.fileobj)
+                    elif key.data is self:
+                        self._process_wakeup()
                     else:
                         conn_handler = key.data
                         try:
@@ -47,30 +61,110 @@ class ConnectionMonitor(Thread):
                         except Exception:
                             logging.error(f"Exception in message from/to {conn_handler.addr}\n:{traceback.format_exc()}")
                             conn_handler.close()
-                # Check for a socket still being monitored
-                if not self.selector.get_map():
+                # Check for a socket other than the wakeup socket still being monitored
+                if self.stop_when_idle and len(self.selector.get_map()) <= 1:
                     break
         except KeyboardInterrupt:
             logging.info("Caught keyboard interrupt, exiting.")
         finally:
             logging.debug(f"Connection handler stopped.")
             self.selector.close()
+            self._wakeup_recv.close()
+            self._wakeup_send.close()
             self.termination_event.set()
+            # Wake anything waiting on the receive queue
+            self.receive_queue.put_nowait(None)
 
     # Handle a new connection
     def _accept_wrapper(self, sock: socket):
         conn, addr = sock.accept()
         logging.info(f"Accepted connection from {conn.getpeername()}")
-        conn.setblocking(False)
         conn_handler = ConnectionHandler(selector=self.selector, sock=conn, addr=conn.getpeername(),
                                          num=self.connection_number, receive_queue=self.receive_queue)
         self.connection_number += 1
-        self.selector.register(conn, selectors.EVENT_READ | selectors.EVENT_WRITE, data=conn_handler)
+        self.register(conn, conn_handler)
+
+    # Monitor a connected socket. Sockets only listen for writes while their handler has something to send.
+    def register(self, sock: socket, conn_handler: "ConnectionHandler"):
+        self._prepare(sock, conn_handler)
+        self.selector.register(sock, selectors.EVENT_READ, data=conn_handler)
+
+    def _prepare(self, sock: socket, conn_handler: "ConnectionHandler"):
+        sock.setblocking(False)
+        # Small frames such as pings and acks go out immediately, as on asyncio transports
+        if sock.family in (socket_module.AF_INET, socket_module.AF_INET6):
+            sock.setsockopt(socket_module.IPPROTO_TCP, socket_module.TCP_NODELAY, 1)
+        conn_handler.monitor = self
+
+    # Connect to ip:port again in the background with backoff, on_connected is called with the new handler from the
+    # connecting thread. The handler can send straight away, the monitor registers it before it writes.
+    def reconnect(self, ip, port, timeout, on_connected):
+        Thread(target=self._reconnect, args=(ip, port, timeout, on_connected), name="Reconnect", daemon=True).start()
+
+    def _reconnect(self, ip, port, timeout, on_connected):
+        sock = wait_for_connection(ip, port, None, timeout, self.termination_event)
+        if sock is None:
+            return
+        logging.info(f"Reconnected to {ip}:{port}")
+        conn_handler = ConnectionHandler(selector=self.selector, sock=sock, addr=(ip, port), num=0,
+                                         receive_queue=self.receive_queue)
+        self._prepare(sock, conn_handler)
+        with self._want_write_lock:
+            self._pending_register.append((sock, conn_handler))
+        self._wakeup()
+        on_connected(conn_handler)
+
+    # Called from any thread, asks the monitor thread to listen for writes on this connection
+    def request_write(self, conn_handler: "ConnectionHandler"):
+        with self._want_write_lock:
+            needs_wakeup = not self._want_write
+            self._want_write.add(conn_handler)
+        if needs_wakeup:
+            self._wakeup()
+
+    # Interrupt the blocking select
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            # Wakeup already pending, or the monitor has stopped
+            pass
+
+    # The selector blocks until there is something to do, wake it so it notices the termination event
+    def join(self, timeout=None):
+        self._wakeup()
+        super().join(timeout)
+
+    def _process_wakeup(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._want_write_lock:
+            pending_register = self._pending_register
+            self._pending_register = []
+            want_write = self._want_write
+            self._want_write = set()
+        # Register first, writes may already be requested on the new connections
+        for sock, conn_handler in pending_register:
+            self.selector.register(sock, selectors.EVENT_READ, data=conn_handler)
+        for conn_handler in want_write:
+            if conn_handler.sock is not None:
+                conn_handler._set_selector_events_mask('rw')
 
 
 # Handles receiving and sending on a specific connection. Run on main server/client thread
 # based on https://realpython.com/python-sockets/#application-client-and-server
 class ConnectionHandler(Thread):
+    # Bounds of the adaptive read size, reads double while they fill the requested size and halve when mostly empty
+    min_read_size = 4096
+    max_read_size = 1 << 20
+    # Most queued frames handed to a single sendmsg call
+    max_send_frames = 512
+    # Largest frame content accepted, compressed or once inflated. A peer sending more is disconnected.
+    max_frame_size = 64 << 20
+
     def __init__(self, selector: selectors.BaseSelector, sock: socket, addr, num, receive_queue: queue.Queue):
         super().__init__(name="ConnectionHandler")
         self.selector = selector
@@ -79,128 +173,168 @@ class ConnectionHandler(Thread):
         self.peer_name = f"peer_{num}"
         self.CSeq = -1  # Sequence number we use when sending messages, incremented each message
         self.peer = None  # Is set to a NetworkNode after a successful handshake
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        # Received bytes live in _recv_buffer[_recv_start:_recv_end], parsing advances _recv_start
+        self._recv_buffer = bytearray(self.min_read_size)
+        self._recv_start = 0
+        self._recv_end = 0
+        self._read_size = self.min_read_size
+        # Frames taken from the send queue that are (partially) unsent, only touched by the monitor
+        self._send_buffers: deque[memoryview] = deque()
+        self._send_batch_frames = 0  # Number of frames in _send_buffers when they were taken
         self._current_recv_message = None
+        self._current_recv_codec: Codec = None
+        # Codec used for frames we send, agreed on during the handshake
+        self.codec: Codec = DEFAULT_CODEC
+        # Compressor for frames we send if compression was agreed on during the handshake
+        self.compressor: Compressor = None
+        self.compression_stats = CompressionStats()
         # submit messages to the global receive queue
         self._receive_queue = receive_queue
-        # each message handler gets own send queue
-        self._send_queue = queue.Queue()
-        # CSeq -> Event dict, events are set when the CSeq we are awaiting arrives
-        self.await_list = dict()
+        # each message handler gets own bounded send queue, filled from any thread and drained by the monitor
+        self._send_queue = SendQueue()
+        self._write_requested = False
+        self.monitor = None  # Set when registered with a ConnectionMonitor
+        # CSeq -> Event table, events are set when the CSeq we are awaiting arrives
+        self.await_list = PendingRequests()
 
     def process_events(self, mask):
         if mask & selectors.EVENT_READ:
             self._read_wrapper()
-        if mask & selectors.EVENT_WRITE:
+        if mask & selectors.EVENT_WRITE and self.sock is not None:
             self._write_wrapper()
 
     def _read_wrapper(self):
-        self._read()
+        if self._read():
+            self._process_frames()
 
+    # Parse every complete message in the receive buffer
+    def _process_frames(self):
+        while self._process_frame():
+            pass
+
+    # Advance parsing of the message in the receive buffer, returns True if a whole message was received
+    def _process_frame(self) -> bool:
         if self._current_recv_message is None:
+            if not self._recv_pending():
+                return False
             #logging.debug(f"started receiving new message")
             self._current_recv_message = Message(handler=self)
+            self._current_recv_codec = codec_for_frame(self._recv_buffer[self._recv_start])
 
-        # could take multiple _read to process single message, so keep track of headers
-        if self._current_recv_message.json_header_len is None:
-            self._process_protoheader()
-
-        if self._current_recv_message.json_header_len is not None:
-            if self._current_recv_message.json_header is None:
-                self._process_jsonheader()
-
-        if self._current_recv_message.json_header:
-            if self._current_recv_message.content is None:
-                self._process_message()
+        if not self._current_recv_codec.decode(self, self._current_recv_message):
+            return False
+        content = self._current_recv_message.content
+        if isinstance(content, bytes):
+            logging.debug(f"Received {self._current_recv_message.json_header['content_type']} "
+                          f"request from {self.addr}")
+        else:
+            logging.debug(f"Received request {content.request['action']} from {self.addr}")
+        self._receive_queue.put_nowait(self._current_recv_message)
+        self._current_recv_message = None
+        return True
 
-    # read from socket to a buffer
-    def _read(self):
+    # read from socket into the receive buffer, returns the number of bytes read
+    def _read(self) -> int:
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            nbytes = self.sock.recv_into(self._get_recv_space())
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
-            pass
+            return 0
+        if nbytes:
+            self._recv_advance(nbytes)
         else:
-            if data:
-                self._recv_buffer += data
+            # Empty message interpreted as socket closed
+            logging.info(f"Peer at {self.addr} closed.")
+            self.close()
+        return nbytes
+
+    # Returns a writable view of at least _read_size free bytes at the end of the receive buffer. The buffer is never
+    # resized in place, so views handed out earlier stay valid.
+    def _get_recv_space(self) -> memoryview:
+        if self._recv_start == self._recv_end:
+            self._recv_start = self._recv_end = 0
+        if len(self._recv_buffer) - self._recv_end < self._read_size:
+            pending = self._recv_end - self._recv_start
+            if pending + self._read_size <= len(self._recv_buffer):
+                # Enough room once parsed bytes are dropped, move the pending bytes to the front
+                self._recv_buffer[:pending] = self._recv_buffer[self._recv_start:self._recv_end]
             else:
-                # Empty message interpreted as socket closed
-                logging.info(f"Peer at {self.addr} closed.")
-                self.close()
+                grown = bytearray(max(2 * len(self._recv_buffer), pending + self._read_size))
+                grown[:pending] = self._recv_buffer[self._recv_start:self._recv_end]
+                self._recv_buffer = grown
+            self._recv_start = 0
+            self._recv_end = pending
+        return memoryview(self._recv_buffer)[self._recv_end:self._recv_end + self._read_size]
+
+    # Mark nbytes written to the space from _get_recv_space as received and adapt the next read size
+    def _recv_advance(self, nbytes):
+        self._recv_end += nbytes
+        if nbytes == self._read_size and self._read_size < self.max_read_size:
+            self._read_size *= 2
+        elif nbytes < self._read_size // 4 and self._read_size > self.min_read_size:
+            self._read_size //= 2
+
+    def _recv_pending(self) -> int:
+        return self._recv_end - self._recv_start
+
+    # Take nbytes from the front of the receive buffer without copying
+    def _recv_consume(self, nbytes) -> memoryview:
+        data = memoryview(self._recv_buffer)[self._recv_start:self._recv_start + nbytes]
+        self._recv_start += nbytes
+        return data
 
     def _write_wrapper(self):
-        if not self._send_buffer:
-            if not self._send_queue.empty():
-                self._send_buffer += self._send_queue.get()
-            #else:
-            #    logging.info("Nothing more to write")
-            #    self._set_selector_events_mask('r')
+        if not self._send_buffers:
+            frames = self._send_queue.take(self.max_send_frames)
+            self._send_batch_frames = len(frames)
+            self._send_buffers.extend(memoryview(frame) for frame in frames)
 
         self._write()
 
-    # Send data in the send buffer
+        if not self._send_buffers:
+            with self._send_queue.lock:
+                if not self._send_queue:
+                    # Nothing more to write, stop listening for writes until the next enqueue
+                    self._write_requested = False
+                    self._set_selector_events_mask('r')
+
+    # Send as many of the pending frames as the socket accepts in one call
     def _write(self):
-        if self._send_buffer:
-            # logging.debug(f"Sending {self._send_buffer!r} to {self.addr}")
-            try:
-                # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
-
-            except BlockingIOError:
-                # Resource temporarily unavailable (errno EWOULDBLOCK)
-                pass
+        if not self._send_buffers:
+            return
+        if not hasattr(self.sock, "sendmsg") and len(self._send_buffers) > 1:
+            # No scatter-gather (e.g. Windows), coalesce into a single buffer once
+            joined = memoryview(b"".join(self._send_buffers))
+            self._send_buffers.clear()
+            self._send_buffers.append(joined)
+        try:
+            # Should be ready to write
+            if len(self._send_buffers) > 1:
+                sent = self.sock.sendmsg(list(islice(self._send_buffers, self.max_send_frames)))
             else:
-                self._send_buffer = self._send_buffer[sent:]
-                if sent and not self._send_buffer:
-                    # buffer is drained. The response has been sent.
-                    logging.debug(f"Message has been sent")
-
-
-    # Process the fixed length header (2 byte, big endian), gives length of following JSON header
-    def _process_protoheader(self):
-        hdrlen = 2
-        if len(self._recv_buffer) >= hdrlen:
-            self._current_recv_message.json_header_len = struct.unpack(">H", self._recv_buffer[:hdrlen])[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-
-    # Process variable length json_header
-    def _process_jsonheader(self):
-        hdrlen = self._current_recv_message.json_header_len
-        if len(self._recv_buffer) >= hdrlen:
-            self._current_recv_message.json_header = json_decode(self._recv_buffer[:hdrlen], "utf-8")
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-            for req_hdr in REQUIRED_HEADERS:
-                if req_hdr not in self._current_recv_message.json_header:
-                    raise ValueError(f"Missing required header '{req_hdr}'.")
-            # Make sure CSeq is correct on the message
-            self._current_recv_message.CSeq = self._current_recv_message.json_header['CSeq']
-
-    # Process message after reading the header
-    def _process_message(self):
-        hdr = self._current_recv_message.json_header
-        content_len = hdr["content_length"]
-        # don't process now if we haven't received the whole message yet
-        if not len(self._recv_buffer) >= content_len:
+                sent = self.sock.send(self._send_buffers[0])
+        except BlockingIOError:
+            # Resource temporarily unavailable (errno EWOULDBLOCK)
             return
-        # get received content
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
-
-        if hdr["content_type"] == "text/json":
-            encoding = hdr["content_encoding"]
-            self._current_recv_message.content = Request(content=json_decode(data, encoding))
-            logging.debug(f"Received request {self._current_recv_message.content.request['action']} from {self.addr}")
+        total_sent = sent
+        num_sent = 0
+        while sent:
+            frame = self._send_buffers[0]
+            if len(frame) <= sent:
+                sent -= len(frame)
+                self._send_buffers.popleft()
+                num_sent += 1
+            else:
+                self._send_buffers[0] = frame[sent:]
+                sent = 0
+        if self._send_buffers:
+            self._send_queue.sent(total_sent, 0)
         else:
-            # Binary or unknown content-type
-            self._current_recv_message.content = data
-            logging.debug(
-                f"Received {hdr['content_type']} "
-                f"request from {self.addr}"
-            )
-        self._receive_queue.put(self._current_recv_message)
-        self._current_recv_message = None
+            # buffer is drained. The response has been sent.
+            self._send_queue.sent(total_sent, self._send_batch_frames)
+            logging.debug(f"{self._send_batch_frames} message(s) have been sent")
+            self._send_batch_frames = 0
 
     # enqueue a request, return CSeq
     def send_message(self, message: Message, is_response=False):
@@ -211,13 +345,18 @@ class ConnectionHandler(Thread):
             self.CSeq += 1
             logging.debug(f"CSeq for {self.addr} is now {self.CSeq}")
             message.CSeq = self.CSeq
-        logging.debug(f"Enqueued{' response' if is_response else ''}: {message.content.request['action']} to {self.addr} with CSeq {message.CSeq}")
-        #self._set_selector_events_mask('rw')
-        self._send_queue.put(message.get_serialized())
+        action = message.content.request['action']
+        data = message.get_serialized()
+        if self._enqueue_send(data, droppable=action in DROPPABLE_ACTIONS, key=message.content_key()):
+            logging.debug(f"Enqueued{' response' if is_response else ''}: {action} to {self.addr} with CSeq {message.CSeq}")
+        else:
+            logging.debug(f"Send queue to {self.addr} is full, dropped {action} with CSeq {message.CSeq}")
 
     # enqueue a request, returns a future to wait for a response. If yield_message is true, the message handler will
-    # pass the message through this event rather than handle it itself
-    def send_message_and_wait_response(self, message: Message, is_response=False, yield_message=False) -> MessageEvent:
+    # pass the message through this event rather than handle it itself. After timeout seconds the request is no
+    # longer awaited, by default it is awaited until a wait on it times out or the connection closes.
+    def send_message_and_wait_response(self, message: Message, is_response=False, yield_message=False,
+                                       timeout=None) -> MessageEvent:
         message.conn_handler = self
         message.is_received = False
         # Don't change the CSeq if we are responding to a message
@@ -225,22 +364,45 @@ class ConnectionHandler(Thread):
             self.CSeq += 1
             logging.debug(f"CSeq for {self.addr} is now {self.CSeq}")
             message.CSeq = self.CSeq
-        #self._set_selector_events_mask('rw')
         # Add the wait event before sending
         logging.debug(f"Enqueued{' response' if is_response else ''}: {message.content.request['action']} to {self.addr} with wait on CSeq {message.CSeq}")
-        message_event = self._add_new_await(message.CSeq, yield_message)
-        # Force a reserialize, fixes an edge case where we wait on a message with wrong CSeq sent
-        self._send_queue.put(message.get_serialized(force_reserialize=True))
+        message_event = self._add_new_await(message.CSeq, yield_message, timeout)
+        # The header is rebuilt whenever the CSeq changed, so a resent message never carries a stale CSeq. Awaited
+        # messages are never dropped.
+        self._enqueue_send(message.get_serialized())
         return message_event
 
-    # Add a new CSeq await to the list of waiting event objects
-    def _add_new_await(self, CSeq, yield_message) -> MessageEvent:
+    # Queue serialized bytes to be written when the socket is writable, returns False if the queue was full and the
+    # frame was dropped. Only droppable frames are ever dropped, what happens on overflow depends on the queue's policy.
+    def _enqueue_send(self, data: bytes, droppable=False, key=None) -> bool:
+        if not self._send_queue.put(data, droppable, key, can_block=self._can_block_on_send()):
+            return False
+        with self._send_queue.lock:
+            if self._write_requested:
+                return True
+            self._write_requested = True
+        self._request_write()
+        return True
+
+    # Waiting for the send queue to drain would deadlock the thread that drains it
+    def _can_block_on_send(self) -> bool:
+        return self.monitor is None or current_thread() is not self.monitor
+
+    # True while the send queue is filling up faster than the peer takes it, callers should hold off on sending
+    # anything that can wait
+    def is_backpressured(self) -> bool:
+        return self._send_queue.is_backpressured()
+
+    # Ask for the queue to be flushed, here by making the monitor listen for writes on our socket
+    def _request_write(self):
+        self.monitor.request_write(self)
+
+    # Add a new CSeq await to the table of waiting event objects
+    def _add_new_await(self, CSeq, yield_message, timeout=None) -> MessageEvent:
         if CSeq in self.await_list:
             logging.error(f"Already waiting for a response to this message...")
-        event = MessageEvent(yield_message)
         #logging.debug(f"Adding await for CSeq {CSeq}")
-        self.await_list[CSeq] = event
-        return event
+        return self.await_list.add(CSeq, yield_message, timeout)
 
     # Set selector to listen for events: mode is 'r', 'w', or 'rw'.
     def _set_selector_events_mask(self, mode):
@@ -255,10 +417,22 @@ class ConnectionHandler(Thread):
             raise ValueError(f"Invalid events mask mode {mode!r}.")
         self.selector.modify(self.sock, events, data=self)
 
+    # Report of the connection's transfer statistics
+    def get_stats(self) -> dict:
+        return dict(codec=self.codec.name,
+                    compression=self.compressor.name if self.compressor is not None else None,
+                    **self.compression_stats.report(),
+                    send_queue=self._send_queue.get_stats())
+
     def close(self):
+        if self.sock is None:
+            # Already closed, e.g. the peer hung up before its EXIT was handled
+            return
         logging.info(f"Closing connection to {self.addr}")
+        logging.info(f"Connection stats for {self.addr}: {self.get_stats()}")
         if self.peer is not None:
-            self.peer.is_active = False
+            self.peer.deactivate(self)
+        self._receive_queue.put_nowait(ConnectionClosed(self))
         try:
             self.selector.unregister(self.sock)
         except Exception as e:
@@ -274,3 +448,6 @@ class ConnectionHandler(Thread):
         finally:
             # Delete reference to socket object for garbage collection
             self.sock = None
+        if self.monitor is not None:
+            # Let the monitor notice when this was the last connection
+            self.monitor._wakeup()
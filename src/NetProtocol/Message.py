@@ -1,11 +1,9 @@
-import struct
-import sys
 # controllers.py
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from src.NetProtocol.ConnectionHandler import ConnectionHandler
+from src.NetProtocol.Codec import DEFAULT_CODEC
 from src.NetProtocol.Request import Request
-from src.Utility.NetworkUtilities import json_encode
 
 
 class Message:
@@ -15,27 +13,43 @@ class Message:
         self.json_header_len = None
         self.json_header = None
         self.CSeq = -1
+        self._encoded_body = None
+        self._encoded_body_key = None
+        self._serialized_key = None
         self.content = content
+
+    @property
+    def content(self) -> Request:
+        return self._content
+
+    # Replacing the content invalidates the cached body and frame
+    @content.setter
+    def content(self, content: Request):
+        self._content = content
+        self._encoded_body = None
         self._serialized = None
+        self._serialized_CSeq = None
 
     def get_serialized(self, force_reserialize=False):
-        if force_reserialize or self._serialized is None:
-            self._serialize()
+        codec, compressor = DEFAULT_CODEC, None
+        if self.conn_handler is not None:
+            codec, compressor = self.conn_handler.codec, self.conn_handler.compressor
+        key = (codec, compressor.name, compressor.level, compressor.threshold) if compressor is not None else (codec,)
+        if force_reserialize or self._serialized is None or self._serialized_key != key \
+                or self._serialized_CSeq != self.CSeq:
+            self._serialize(key, codec, compressor)
         return self._serialized
 
-    def _serialize(self):
-        content_bytes = json_encode(self.content.request, self.content.encoding)
-        self._construct_header(len(content_bytes))
-        json_header_bytes = json_encode(self.json_header, "utf-8")
-        message_hdr_bytes = struct.pack(">H", len(json_header_bytes))
-        message = message_hdr_bytes + json_header_bytes + content_bytes
-        self._serialized = message
+    # Identifies the content as last serialized independent of the CSeq, messages with equal keys are duplicates
+    def content_key(self):
+        return self._encoded_body
 
-    def _construct_header(self, content_bytes_len):
-        self.json_header = dict(
-            byteorder=sys.byteorder,
-            content_length=content_bytes_len,
-            content_type=self.content.m_type,
-            content_encoding=self.content.encoding,
-            CSeq=self.CSeq
-        )
+    # The encoded body only depends on the content and compression settings, so it is reused and only the CSeq
+    # dependent header is rebuilt
+    def _serialize(self, key, codec, compressor):
+        if self._encoded_body is None or self._encoded_body_key != key:
+            self._encoded_body = codec.encode_body(self, compressor)
+            self._encoded_body_key = key
+        self._serialized = codec.encode_frame(self, self._encoded_body)
+        self._serialized_key = key
+        self._serialized_CSeq = self.CSeq
@@ -1,11 +1,17 @@
+import asyncio
+import heapq
 import logging
 import threading
 import time
+from collections import deque
 from uuid import UUID
 
 from src.NetProtocol.AwaitResponse import MessageEvent
+from src.NetProtocol.Codec import CODECS, DEFAULT_CODEC, choose_codec
+from src.NetProtocol.Compression import Compressor
+from src.NetProtocol.ConnectionHandler import ConnectionClosed, ConnectionHandler
 from src.NetProtocol.Message import Message
-from queue import Queue
+from queue import Empty, Queue
 
 # thread that processes the incoming message queue
 from src.NetProtocol.Request import RequestType, Request
@@ -16,117 +22,430 @@ if TYPE_CHECKING:
     from src.app.Application import Application
 
 
+# Time spent handling requests of one action
+class ActionStats:
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+    def report(self) -> dict:
+        return dict(count=self.count,
+                    avg_ms=self.total_time / self.count * 1000 if self.count else 0.0,
+                    max_ms=self.max_time * 1000,
+                    total_ms=self.total_time * 1000)
+
+
 class MessageHandler:
-    def __init__(self, message_queue: "Queue[Message]", termination_event: threading.Event, owner: "Application"):
+    # How long read_messages blocks waiting for a message before returning
+    poll_interval = 0.1
+    # Most messages handled per wakeup before deadlines and wait conditions are checked again
+    max_batch = 64
+
+    def __init__(self, message_queue: "Queue[Message]", termination_event: threading.Event, owner: "Application",
+                 loop: asyncio.AbstractEventLoop = None):
         self.message_queue = message_queue
         self.termination_event = termination_event
         self.owner = owner
+        # If set, messages arrive on an asyncio.Queue and are dispatched by running this loop
+        self.loop = loop
+        # RequestType -> handler(message) for requests and responses nobody is waiting on
+        self.handlers = dict()
+        self.register_handler(RequestType.PING, self._handle_ping)
+        self.register_handler(RequestType.ACK, self._handle_ack)
+        self.register_handler(RequestType.HANDSHAKE, self._handle_handshake)
+        self.register_handler(RequestType.METRIC, self._handle_metric)
+        self.register_handler(RequestType.COMPONENT, self._handle_component)
+        self.register_handler(RequestType.EXIT, self._handle_exit)
+        # RequestType -> ActionStats of its handler
+        self.action_stats = dict()
+        # Time spent ingesting pushed metric batches, and the number of rows they held
+        self.stream_stats = ActionStats()
+        self.stream_samples = 0
+
+    # Handle messages of this action with handler, replacing the previous one
+    def register_handler(self, action: RequestType, handler):
+        self.handlers[action] = handler
+
+    # Per action handling time report, with the ingestion cost per pushed metric row
+    def get_stats(self) -> dict:
+        stats = {RequestType(action).name: stats.report() for action, stats in self.action_stats.items()}
+        if self.stream_samples:
+            stats['METRIC_STREAM'] = dict(self.stream_stats.report(), samples=self.stream_samples,
+                                          us_per_sample=self.stream_stats.total_time / self.stream_samples * 1e6)
+        return stats
+
+    # Handle the messages that arrive within timeout seconds, returns after the first batch
+    def read_messages(self, timeout=None):
+        timeout = self.poll_interval if timeout is None else timeout
+        self._run_dispatch(time.monotonic() + timeout, max_messages=1)
+
+    # Handle incoming messages until timeout seconds have passed
+    def dispatch_for(self, timeout):
+        self._run_dispatch(time.monotonic() + max(timeout, 0))
+
+    # Handle incoming messages until condition() holds or timeout seconds have passed, returns whether it holds
+    def dispatch_until(self, condition, timeout) -> bool:
+        return self._run_dispatch(time.monotonic() + max(timeout, 0), condition=condition)
+
+    # Handle incoming messages until the deadline, at least max_messages have been handled or the condition holds.
+    # Blocks on the receive queue (or the event loop) until a message arrives, then drains up to max_batch queued
+    # messages before checking again. Returns whether the condition was met.
+    def _run_dispatch(self, deadline, max_messages=None, condition=None) -> bool:
+        if self.loop is not None:
+            return self.loop.run_until_complete(self._dispatch_until(deadline, max_messages, condition))
+        handled = 0
+        while not self.termination_event.is_set():
+            if condition is not None and condition():
+                return True
+            if max_messages is not None and handled >= max_messages:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.message_queue.get(timeout=remaining)
+            except Empty:
+                break
+            handled += self._dispatch_batch(item)
+        return condition is not None and condition()
+
+    # Coroutine version of _run_dispatch for the event loop
+    async def _dispatch_until(self, deadline, max_messages=None, condition=None) -> bool:
+        handled = 0
+        while not self.termination_event.is_set():
+            if condition is not None and condition():
+                return True
+            if max_messages is not None and handled >= max_messages:
+                break
+            if self.message_queue.empty():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.message_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self.message_queue.get_nowait()
+            handled += self._dispatch_batch(item)
+            # Let the transports run before the next batch, they fill the queue and flush our replies
+            await asyncio.sleep(0)
+        return condition is not None and condition()
+
+    # Handle item and up to max_batch - 1 more messages that are already queued, returns how many were handled
+    def _dispatch_batch(self, item) -> int:
+        handled = 0
+        while True:
+            if item is not None:
+                self._dispatch(item)
+                handled += 1
+            if handled >= self.max_batch:
+                return handled
+            try:
+                item = self.message_queue.get_nowait()
+            except (Empty, asyncio.QueueEmpty):
+                return handled
 
-    def read_messages(self):
-        if self.message_queue.empty():
+    def _dispatch(self, item: Message):
+        if isinstance(item, ConnectionClosed):
+            # Everything the connection received has been handled, nothing it still owes us will arrive
+            item.conn_handler.await_list.cancel_all()
             return
-        item = self.message_queue.get()
-        # hdr = item.json_header
-        # m_type = hdr["content_type"]
-        # encoding = hdr["content_encoding"]
         content = item.content.request
         action = content['action']
-        response = False
-        if 'response' in content:
-            response = content['response']
+        response = content.get('response', False)
 
         # If this message is a response being waited on, notify. If yield message is true, return to let the event
-        # listener handle it.
-        #logging.debug(f"Await list on {item.conn_handler.addr} is {item.conn_handler.await_list}")
-        if response and item.CSeq in item.conn_handler.await_list:
-            yield_message = item.conn_handler.await_list[item.CSeq].yield_message
-            if yield_message:
-                item.conn_handler.await_list[item.CSeq].set_message(item)
-            item.conn_handler.await_list[item.CSeq].set()
-            # Remove this CSeq from the await dict
-            #logging.debug(f"Removing await for CSeq {item.CSeq}")
-            item.conn_handler.await_list.pop(item.CSeq)
-            if yield_message:
+        # listener handle it. Progress messages share the CSeq of the request but leave the wait in place.
+        final = response and 'progress' not in content
+        message_event = item.conn_handler.await_list.resolve(item.CSeq) if final else None
+        if message_event is not None:
+            if message_event.yield_message:
+                message_event.set_message(item)
+            message_event.set()
+            if message_event.yield_message:
+                return
+
+        handler = self.handlers.get(action)
+        if handler is None:
+            logging.debug(f"No handler for {action!r} from {item.conn_handler.addr}, dropping it")
+            return
+        start_t = time.perf_counter()
+        handler(item)
+        stats = self.action_stats.get(action)
+        if stats is None:
+            stats = self.action_stats[action] = ActionStats()
+        stats.add(time.perf_counter() - start_t)
+
+    # Yield the events as they are done, until all are or the deadline passed. Events past their own deadline are
+    # cancelled. Completion is signalled through callbacks, so waiting on many events stays linear.
+    def _iter_done(self, message_events: list[MessageEvent], deadline):
+        done = deque()
+        for m in message_events:
+            m.add_done_callback(done.append)
+        deadlines = [(m.deadline, i) for i, m in enumerate(message_events) if m.deadline is not None]
+        heapq.heapify(deadlines)
+        pending = len(message_events)
+        while True:
+            while done:
+                pending -= 1
+                yield done.popleft()
+            if not pending:
+                return
+            now = time.monotonic()
+            while deadlines and deadlines[0][0] <= now:
+                message_events[heapq.heappop(deadlines)[1]].cancel()
+            if done:
+                continue
+            if now >= deadline or self.termination_event.is_set():
                 return
+            wake = min(deadline, deadlines[0][0]) if deadlines else deadline
+            self._run_dispatch(wake, condition=lambda: bool(done))
 
-        if action == RequestType.HANDSHAKE:
-            self._handle_handshake(item)
-        elif action == RequestType.METRIC:
-            self._handle_metric(item)
-        elif action == RequestType.COMPONENT:
-            self._handle_component(item)
-        elif action == RequestType.EXIT:
-            self._handle_exit(item)
+    # Wait until all events are done or the deadline passed
+    def _wait_all(self, message_events: list[MessageEvent], deadline) -> bool:
+        for _ in self._iter_done(message_events, deadline):
+            pass
+        return all(m.done() for m in message_events)
 
-    # Given list of MessageEvents, wait for all of their associated responses to arrive.
+    # Given list of MessageEvents, wait for all of their associated responses to arrive. Requests still without a
+    # response after the timeout are cancelled.
     def wait_for_responses(self, message_events: list[MessageEvent], timeout: int) -> bool:
-        start_t = time.time()
-        not_ready = True
-        while not_ready:
-            self.read_messages()
-            if time.time() - start_t > timeout or self.termination_event.is_set():
-                return False
-            not_ready = False
-            for m in message_events:
-                if not m.is_set():
-                    not_ready = True
-                    break
-        return True
+        self._wait_all(message_events, time.monotonic() + timeout)
+        for m in message_events:
+            m.cancel()
+        return all(m.is_set() for m in message_events)
+
+    # Wait for the responses of all events, returns the response messages in the same order, None for any that did not
+    # arrive in time. Only meaningful for requests sent with yield_message.
+    def gather(self, message_events: list[MessageEvent], timeout: int) -> list[Message]:
+        self.wait_for_responses(message_events, timeout)
+        return [m.get_message() for m in message_events]
+
+    # Yield the events in the order they are done, whether answered or cancelled. Events not done after the timeout
+    # are cancelled and yielded last.
+    def as_completed(self, message_events: list[MessageEvent], timeout: int):
+        yield from self._iter_done(message_events, time.monotonic() + timeout)
+        for m in message_events:
+            if not m.done():
+                m.cancel()
+                yield m
+
+    def _handle_ping(self, item: Message):
+        # Answer straight away with the sender's timestamp, the sender computes the round trip
+        item.content = Request(RequestType.ACK, dict(sent=item.content.request['sent'], response=True))
+        item.conn_handler.send_message(item, is_response=True)
+
+    def _handle_ack(self, item: Message):
+        if item.conn_handler.peer is None:
+            # Ping raced the handshake, no edge to record it on yet
+            return
+        self.owner.latency_monitor.record(item.conn_handler.peer, item.content.request['sent'])
 
     def _handle_handshake(self, item: Message):
         content = item.content.request
         logging.debug(
-            f"Received handshake CSEQ {item.json_header['CSeq']} with response: {content['response']} and UUID: {content['uuid']}"
+            f"Received handshake CSEQ {item.CSeq} with response: {content['response']} and UUID: {content['uuid']}"
             f" from {item.conn_handler.addr}")
         peer_uuid = UUID(content['uuid'])
-        peer_node = self.owner.net_graph.new_node(item.conn_handler.peer_name, item.conn_handler,
-                                                  item.conn_handler.addr, NetworkNodeType.CLIENT,
-                                                  peer_uuid, content['hw_stats'])
+        if self.owner.is_server and self.owner.finished and not content['response']:
+            # The run is over, a client reconnecting to resume its session is told to exit instead
+            logging.info(f"Refusing to resume the session of {peer_uuid} from {item.conn_handler.addr}, run finished")
+            item.conn_handler.send_message(Message(content=Request(RequestType.EXIT)))
+            return
+        net_graph = self.owner.net_graph
+        if net_graph.has_node(peer_uuid):
+            # A peer we knew reconnected, keep its node with its components, metrics and edge
+            peer_node = net_graph.get_node(peer_uuid)
+            stale = peer_node.conn_handler
+            peer_node.reattach(item.conn_handler, item.conn_handler.addr)
+            logging.info(f"Resumed session of {peer_node} from {item.conn_handler.addr}")
+            if stale is not None and stale is not item.conn_handler:
+                # The old connection may be half open if we never noticed it dropping
+                stale.close()
+        else:
+            peer_node = net_graph.new_node(item.conn_handler.peer_name, item.conn_handler,
+                                           item.conn_handler.addr, NetworkNodeType.CLIENT,
+                                           peer_uuid, content['hw_stats'])
+            net_graph.new_connection_to_self(peer_uuid)
         item.conn_handler.peer = peer_node  # Update connection's knowledge of peer
-
-        self.owner.net_graph.new_connection_to_self(peer_uuid)
-        logging.debug(str(self.owner.net_graph))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            # Formatting the whole graph on every handshake is quadratic in the number of peers
+            logging.debug(str(self.owner.net_graph))
         if not content['response']:
+            # Pick the wire format from the ones the peer offered, peers that predate codecs only speak JSON
+            codec_name = choose_codec(content.get('codecs', [DEFAULT_CODEC.name]), self.owner.wire_formats)
+            # Compress only with an algorithm both sides have enabled
+            compression = next((c for c in content.get('compression', []) if c in self.owner.compression), None)
             # Reply with our own stats and UUID
             response_dict = dict(uuid=str(self.owner.uuid),
                                  hw_stats=self.owner.hardware_stats.copy(),
+                                 codec=codec_name,
+                                 compression=compression,
                                  response=True)
             item.content = Request(RequestType.HANDSHAKE, response_dict)
             item.conn_handler.send_message(item, is_response=True)  # don't wait for reply
+            # The reply is already serialized, anything sent after it uses the agreed codec and compression
+            item.conn_handler.codec = CODECS[codec_name]
+            self._set_compression(item.conn_handler, compression)
+            if self.owner.is_server and self.owner.stream_metrics:
+                self._subscribe_metrics(item.conn_handler, self.owner.stream_metrics, self.owner.stream_interval)
+        else:
+            if 'codec' in content:
+                item.conn_handler.codec = CODECS[content['codec']]
+            self._set_compression(item.conn_handler, content.get('compression'))
+        logging.debug(f"Sending to {item.conn_handler.addr} with codec {item.conn_handler.codec.name} and "
+                      f"compression {content.get('compression')}")
+
+    # Ask the peer to push the given metric tables every interval seconds, from then on it sends batches of rows
+    # without being polled. An interval of 0 unsubscribes.
+    @staticmethod
+    def _subscribe_metrics(conn_handler: ConnectionHandler, metrics: list, interval):
+        metric_dict = dict(metrics=metrics, period=interval, subscribe=True)
+        conn_handler.send_message(Message(content=Request(RequestType.METRIC, metric_dict)))
+
+    # Ask the peer to dump its raw high rate samples of the last period seconds of table to a file on its machine.
+    # Returns (path, number of samples) of the dump, None if it failed or was not answered within timeout.
+    def request_metric_dump(self, conn_handler: ConnectionHandler, table, period, timeout=30):
+        metric_dict = dict(metrics=[table], period=period, dump=True)
+        future = conn_handler.send_message_and_wait_response(Message(content=Request(RequestType.METRIC, metric_dict)),
+                                                             yield_message=True, timeout=timeout)
+        response, = self.gather([future], timeout)
+        if response is None:
+            logging.error(f"Timeout on dumping {table!r} on {conn_handler.addr}")
+            return None
+        content = response.content.request
+        if content.get('dump') is None:
+            logging.error(f"{conn_handler.addr} failed to dump {period}s of raw {table!r} samples")
+            return None
+        logging.info(f"{conn_handler.addr} dumped {content['samples']} raw {table!r} samples to {content['dump']}")
+        return content['dump'], content['samples']
+
+    # Compress what we send on this connection with our own level and threshold settings
+    def _set_compression(self, conn_handler: ConnectionHandler, compression):
+        if compression is None:
+            conn_handler.compressor = None
+            return
+        conn_handler.compressor = Compressor(compression, self.owner.compression_level,
+                                             self.owner.compression_threshold, conn_handler.compression_stats)
 
     def _handle_metric(self, item: Message):
         content = item.content.request
         # logging.debug(f"Received metric request metrics: {content['metrics']} from {item.conn_handler.addr}")
-        if not content['response']:
+        if content.get('stream'):
+            # A batch of pushed rows, timed per sample so the cost of ingesting a stream can be compared to polling
+            start_t = time.perf_counter()
+            item.conn_handler.peer.add_received_metric(content['metrics'])
+            self.stream_stats.add(time.perf_counter() - start_t)
+            self.stream_samples += len(content['metrics'])
+        elif content.get('replay'):
+            # Metrics the peer sampled while it was disconnected
+            logging.info(f"Received {len(content['metrics'])} replayed metrics from {item.conn_handler.addr}")
+            item.conn_handler.peer.add_received_metric(content['metrics'], live=False)
+        elif content.get('subscribe') and not content['response']:
+            self._handle_subscribe(item)
+        elif content.get('subscribe'):
+            logging.info(f"{item.conn_handler.addr} streams {content['metrics']} every {content['period']}s")
+        elif 'dump' in content and not content['response']:
+            self._dump_metric(item)
+        elif 'dump' in content:
+            # A failed dump is answered with no path
+            if content['dump'] is None:
+                logging.error(f"{item.conn_handler.addr} failed to dump {content['period']}s of raw samples")
+            else:
+                logging.info(f"{item.conn_handler.addr} dumped {content['samples']} raw samples to {content['dump']}")
+        elif not content['response']:
             # reply with an aggregate report of metrics
             time_start = self.owner.elapsed_time - content['period']
-            cur = self.owner.db.cursor()
             table = content['metrics'][0]  # in a request, 'metrics' is a list of metrics to return
-            res = cur.execute(f"SELECT AVG(cpu), AVG(memory), pid, process_name FROM {table} INNER JOIN components ON"
-                              f" components.pid = {table}.component WHERE timestamp > ? GROUP BY pid", (time_start,))
-            # logging.debug(f"metric report: {res.fetchall()}")
+            collector = self.owner.get_metric_collector(table)
+            if collector is None or collector.window_query is None:
+                logging.error(f"Metric request for unknown metric {table!r} from {item.conn_handler.addr}")
+                rows = []
+            else:
+                # Served from the running aggregates, the database is only queried for windows they don't cover
+                rows = collector.averages_since(time_start)
+                if rows is None:
+                    rows = collector.query_since(self.owner.db, time_start)
             response_dict = dict(period=content['period'],
-                                 metrics=res.fetchall(),
+                                 metrics=rows,
                                  response=True)
             item.content = Request(RequestType.METRIC, response_dict)
             item.conn_handler.send_message(item, is_response=True)
         else:
             item.conn_handler.peer.add_received_metric(content['metrics'])
 
+    def _handle_subscribe(self, item: Message):
+        content = item.content.request
+        subscribed = []
+        for table in content['metrics']:
+            collector = self.owner.get_metric_collector(table)
+            if collector is None:
+                logging.error(f"Subscription to unknown metric {table!r} from {item.conn_handler.addr}")
+                continue
+            collector.subscribe(item.conn_handler, content['period'])
+            subscribed.append(table)
+        response_dict = dict(metrics=subscribed, period=content['period'], subscribe=True, response=True)
+        item.content = Request(RequestType.METRIC, response_dict)
+        item.conn_handler.send_message(item, is_response=True)
+
+    # Dump the raw high rate samples of the last period seconds to a file on this machine, reply where they went
+    def _dump_metric(self, item: Message):
+        content = item.content.request
+        table = content['metrics'][0]
+        collector = self.owner.get_metric_collector(table)
+        end = self.owner.elapsed_time
+        path = f"./logs/{self.owner.p_name}_{str(self.owner.uuid)[-5:]}_{table}_{end:.0f}.npz"
+        samples = collector.dump_high_rate(end - content['period'], end + 1, path) if collector is not None else None
+        if samples is None:
+            logging.error(f"Dump request for {table!r} from {item.conn_handler.addr}, which is not sampled at a high"
+                          f" rate")
+            path, samples = None, 0
+        response_dict = dict(period=content['period'], metrics=[], dump=path, samples=samples, response=True)
+        item.content = Request(RequestType.METRIC, response_dict)
+        item.conn_handler.send_message(item, is_response=True)
+
     def _handle_component(self, item: Message):
         content = item.content.request
         comp_name = content['components'][0]
         logging.debug(f"Received component request with CSeq {item.CSeq} for {comp_name} from {item.conn_handler.addr}")
         if not content['response']:
-            component_actions = content['component_actions'][0]
-            # ensure it is a list
-            component_actions = [component_actions] if not isinstance(component_actions, list) else component_actions
-            component_action_responses = []
-            for i, component_action in enumerate(component_actions):
-                try:
-                    args = content['args'][i] if 'args' in content else dict()
-                except IndexError:
-                    args = dict()
+            # Component actions can take minutes, run them on a worker so the loop keeps handling other messages
+            self.owner.job_executor.submit(self._run_component_actions, item)
+        elif 'progress' in content:
+            logging.info(f"Component request CSeq {item.CSeq} for {comp_name} on {item.conn_handler.addr}: "
+                         f"{content['progress']}")
+        else:
+            # handle a received component response
+            # currently handled by where a component request was sent.
+            logging.error(f"Message handler received an un-awaited component response, dropping it...")
+
+    # Runs on a job worker, replies once all actions of the request are done. If the request sets report_progress,
+    # a progress message with the same CSeq is sent before each action.
+    def _run_component_actions(self, item: Message):
+        content = item.content.request
+        comp_name = content['components'][0]
+        component_actions = content['component_actions'][0]
+        # ensure it is a list
+        component_actions = [component_actions] if not isinstance(component_actions, list) else component_actions
+        component_action_responses = []
+        start_t = time.monotonic()
+        for i, component_action in enumerate(component_actions):
+            try:
+                args = content['args'][i] if 'args' in content else dict()
+            except IndexError:
+                args = dict()
+            if content.get('report_progress', False):
+                self._send_component_progress(item, dict(action=component_action, step=i + 1,
+                                                         steps=len(component_actions),
+                                                         elapsed=time.monotonic() - start_t))
+            try:
                 if component_action == "start":
                     # start the requested components, reply with pid
                     pid = self.owner.component_handler.start_component(comp_name, args)
@@ -143,15 +462,29 @@ class MessageHandler:
                     self.owner.component_handler.stop_component(comp_name, args)
                 else:
                     component_action_responses.append("UNSUPPORTED")
-            content['response'] = True
-            content['results'] = component_action_responses
-            item.content = Request(RequestType.COMPONENT, content)
-            item.conn_handler.send_message(item, is_response=True)
-        else:
-            # handle a received component response
-            # currently handled by where a component request was sent.
-            logging.error(f"Message handler received an un-awaited component response, dropping it...")
+            except Exception as error:
+                # Still reply, the requester would otherwise wait for its timeout
+                logging.error(f"Component action {component_action} for {comp_name} failed with {error!r}")
+                component_action_responses.append("ERROR")
+        content['response'] = True
+        content['results'] = component_action_responses
+        item.content = Request(RequestType.COMPONENT, content)
+        item.conn_handler.send_message(item, is_response=True)
+
+    @staticmethod
+    def _send_component_progress(item: Message, progress: dict):
+        content = item.content.request
+        progress_dict = dict(components=content['components'], component_actions=content['component_actions'],
+                             response=True, progress=progress)
+        message = Message(content=Request(RequestType.COMPONENT, progress_dict))
+        message.CSeq = item.CSeq
+        item.conn_handler.send_message(message, is_response=True)
 
     def _handle_exit(self, item: Message):
         logging.debug(f"Received exit request from {item.conn_handler.addr}")
+        if item.conn_handler.peer is not None:
+            item.conn_handler.peer.exited = True
         item.conn_handler.close()
+        if not self.owner.is_server:
+            # The server ended the session, don't reconnect
+            self.termination_event.set()
@@ -0,0 +1,105 @@
+import logging
+import math
+import time
+from collections import deque
+from typing import TYPE_CHECKING
+
+from src.NetProtocol.Message import Message
+from src.NetProtocol.Request import Request, RequestType
+
+if TYPE_CHECKING:
+    from src.app.Application import Application
+    from src.NetworkGraph.NetworkGraph import NetworkNode
+
+
+# Round trip time statistics of a connection, in seconds. Percentiles are over the most recent window of samples.
+class RTTStats:
+    window = 1000
+
+    def __init__(self):
+        self.samples = deque(maxlen=self.window)
+        self.count = 0
+        self.last = None
+        self.min = math.inf
+        self.total = 0.0
+        self.jitter = 0.0  # Smoothed mean deviation between consecutive samples, as RFC 3550 interarrival jitter
+
+    def add(self, rtt):
+        if self.last is not None:
+            self.jitter += (abs(rtt - self.last) - self.jitter) / 16
+        self.samples.append(rtt)
+        self.count += 1
+        self.last = rtt
+        self.min = min(self.min, rtt)
+        self.total += rtt
+
+    @property
+    def avg(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+    def report(self) -> dict:
+        return dict(count=self.count,
+                    last=self.last,
+                    min=self.min if self.count else None,
+                    avg=self.avg,
+                    p99=self.percentile(99),
+                    jitter=self.jitter)
+
+    def __str__(self):
+        if not self.count:
+            return "no samples"
+        return f"min {self.min * 1000:.2f} ms, avg {self.avg * 1000:.2f} ms, p99 {self.percentile(99) * 1000:.2f} ms," \
+               f" jitter {self.jitter * 1000:.2f} ms"
+
+
+# Pings every connected peer each interval seconds. The peer echoes our monotonic send time back in an ACK, so no
+# state is kept per ping and no clock is compared across hosts. Samples are kept on the edge to the peer and logged
+# to the network_latency table.
+class LatencyMonitor:
+    def __init__(self, owner: "Application", interval):
+        self.owner = owner
+        self.interval = interval  # 0 disables pinging, pings from peers are still answered
+        self._next_ping = time.monotonic() + interval
+
+    # Seconds until the next round of pings is due
+    def time_until_next(self):
+        if self.interval <= 0:
+            return math.inf
+        return max(self._next_ping - time.monotonic(), 0)
+
+    # Send a round of pings if one is due, never waits on the network
+    def tick(self):
+        if self.interval <= 0:
+            return
+        now = time.monotonic()
+        if now < self._next_ping:
+            return
+        self._next_ping += self.interval
+        if self._next_ping <= now:
+            # Fell behind, skip the missed rounds rather than sending them in a burst
+            self._next_ping = now + self.interval
+        for node in self.owner.net_graph.get_all_connected_nodes_self():
+            if node is None or node.conn_handler is None:
+                continue
+            message = Message(content=Request(RequestType.PING, dict(sent=now)))
+            node.conn_handler.send_message(message)
+
+    # Record the round trip of a ping sent at monotonic time sent, answered by peer
+    def record(self, peer: "NetworkNode", sent):
+        rtt = time.monotonic() - sent
+        edge = self.owner.net_graph.get_connection_to_self(peer.uuid)
+        if edge is None:
+            return
+        edge.rtt.add(rtt)
+        stats = edge.rtt
+        self.owner.db_writer.execute("INSERT INTO network_latency (timestamp, peer, rtt, min_rtt, avg_rtt, p99_rtt,"
+                                     " jitter) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     (self.owner.elapsed_time, str(peer.uuid), rtt, stats.min, stats.avg,
+                                      stats.percentile(99), stats.jitter))
+        logging.debug(f"RTT to {peer.name} is {rtt * 1000:.2f} ms ({stats})")
@@ -30,6 +30,8 @@ class Request:
         # Else build one
         if action == RequestType.PING:
             self._construct_ping_request(args)
+        elif action == RequestType.ACK:
+            self._construct_ack_request(args)
         elif action == RequestType.HANDSHAKE:
             self._construct_handshake_request(args)
         elif action == RequestType.METRIC:
@@ -82,4 +84,19 @@ class Request:
         self.request = args
 
     def _construct_ping_request(self, args):
-        pass
+        # sent is the sender's monotonic clock, only meaningful to the sender
+        req_fields = ['sent']
+        for req_field in req_fields:
+            if req_field not in args:
+                logging.error(f"Ping request missing {req_field}")
+                return
+        self.request = args
+
+    def _construct_ack_request(self, args):
+        # echoes sent of the ping being acknowledged
+        req_fields = ['sent']
+        for req_field in req_fields:
+            if req_field not in args:
+                logging.error(f"Ack request missing {req_field}")
+                return
+        self.request = args
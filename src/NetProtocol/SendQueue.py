@@ -0,0 +1,152 @@
+import logging
+import time
+from collections import deque
+from threading import Condition, Lock
+
+from src.NetProtocol.Request import RequestType
+
+
+# What to do when a send queue is over its limits
+class OverflowPolicy:
+    BLOCK = 'block'  # Sender waits for the queue to drain, up to block_timeout, then falls back to DROP_OLDEST
+    DROP_OLDEST = 'drop-oldest'  # Drop the oldest droppable frames to make room
+    COALESCE = 'coalesce'  # Drop queued duplicates of the new frame first, then behave as DROP_OLDEST
+
+
+# Frames of these actions may be dropped under overflow, unless a response to them is awaited. Control messages such
+# as HANDSHAKE, COMPONENT and EXIT are always sent.
+DROPPABLE_ACTIONS = {RequestType.METRIC, RequestType.PING, RequestType.ACK}
+
+
+# Bounded per-connection queue of serialized frames waiting to be written. Frames taken by the writer count towards
+# the limits until they are reported sent.
+class SendQueue:
+    max_bytes = 4 * 1024 * 1024
+    max_messages = 1000
+    policy = OverflowPolicy.DROP_OLDEST
+    block_timeout = 5.0
+    # Fraction of either limit above which the connection reports backpressure
+    backpressure_ratio = 0.75
+
+    @classmethod
+    def configure(cls, max_bytes, max_messages, policy, block_timeout):
+        if policy not in (OverflowPolicy.BLOCK, OverflowPolicy.DROP_OLDEST, OverflowPolicy.COALESCE):
+            raise ValueError(f"Unknown send queue overflow policy {policy!r}.")
+        cls.max_bytes = max_bytes
+        cls.max_messages = max_messages
+        cls.policy = policy
+        cls.block_timeout = block_timeout
+
+    def __init__(self):
+        self._entries = deque()  # (frame, droppable, key)
+        self.lock = Lock()
+        self._space = Condition(self.lock)
+        self.queued_bytes = 0
+        self.in_flight_bytes = 0
+        self.in_flight_messages = 0
+        # statistics
+        self.high_water_bytes = 0
+        self.high_water_messages = 0
+        self.num_dropped = 0
+        self.num_coalesced = 0
+        self.num_blocked = 0
+        self.blocked_time = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _total_bytes(self):
+        return self.queued_bytes + self.in_flight_bytes
+
+    def _total_messages(self):
+        return len(self._entries) + self.in_flight_messages
+
+    def _is_full(self, extra_bytes=0, extra_messages=0) -> bool:
+        return self._total_bytes() + extra_bytes > self.max_bytes \
+            or self._total_messages() + extra_messages > self.max_messages
+
+    def is_backpressured(self) -> bool:
+        return self._total_bytes() > self.max_bytes * self.backpressure_ratio \
+            or self._total_messages() > self.max_messages * self.backpressure_ratio
+
+    # Queue a frame, returns False if it was dropped. Droppable frames with the same key carry the same content.
+    # Callers that must not wait (the thread doing the writing) pass can_block=False.
+    def put(self, frame: bytes, droppable=False, key=None, can_block=True) -> bool:
+        with self.lock:
+            if self._is_full(len(frame), 1):
+                if self.policy == OverflowPolicy.BLOCK and can_block:
+                    self._wait_for_space(len(frame))
+                if self.policy == OverflowPolicy.COALESCE and droppable:
+                    self._coalesce(key)
+                if self._is_full(len(frame), 1) and not self._drop_oldest(len(frame), droppable):
+                    self.num_dropped += 1
+                    return False
+            self._entries.append((frame, droppable, key))
+            self.queued_bytes += len(frame)
+            self.high_water_bytes = max(self.high_water_bytes, self._total_bytes())
+            self.high_water_messages = max(self.high_water_messages, self._total_messages())
+            return True
+
+    def _wait_for_space(self, frame_len):
+        self.num_blocked += 1
+        start_t = time.monotonic()
+        self._space.wait_for(lambda: not self._is_full(frame_len, 1), self.block_timeout)
+        self.blocked_time += time.monotonic() - start_t
+
+    def _coalesce(self, key):
+        if key is None:
+            return
+        kept = deque()
+        for entry in self._entries:
+            if entry[1] and entry[2] == key:
+                self.queued_bytes -= len(entry[0])
+                self.num_coalesced += 1
+            else:
+                kept.append(entry)
+        self._entries = kept
+
+    # Drop the oldest droppable frames until the new frame fits. Returns False if the new frame should be dropped
+    # instead, which only happens to droppable frames. Control frames are queued over the limit.
+    def _drop_oldest(self, frame_len, droppable) -> bool:
+        while self._is_full(frame_len, 1):
+            index = next((i for i, entry in enumerate(self._entries) if entry[1]), None)
+            if index is None:
+                if droppable:
+                    return False
+                logging.warning(f"Send queue over its limits with control messages only, queueing anyway.")
+                return True
+            frame, _, _ = self._entries[index]
+            del self._entries[index]
+            self.queued_bytes -= len(frame)
+            self.num_dropped += 1
+        return True
+
+    # Take up to max_frames frames for writing, they stay counted until reported with sent()
+    def take(self, max_frames=None) -> list[bytes]:
+        with self.lock:
+            count = len(self._entries) if max_frames is None else min(max_frames, len(self._entries))
+            frames = [self._entries.popleft()[0] for _ in range(count)]
+            taken_bytes = sum(len(frame) for frame in frames)
+            self.queued_bytes -= taken_bytes
+            self.in_flight_bytes += taken_bytes
+            self.in_flight_messages += count
+            return frames
+
+    # Report bytes and whole frames of taken frames that were written
+    def sent(self, nbytes, num_frames):
+        with self.lock:
+            self.in_flight_bytes -= nbytes
+            self.in_flight_messages -= num_frames
+            self._space.notify_all()
+
+    def get_stats(self) -> dict:
+        return dict(
+            queued_bytes=self._total_bytes(),
+            queued_messages=self._total_messages(),
+            high_water_bytes=self.high_water_bytes,
+            high_water_messages=self.high_water_messages,
+            dropped=self.num_dropped,
+            coalesced=self.num_coalesced,
+            blocked=self.num_blocked,
+            blocked_ms=self.blocked_time * 1000
+        )
@@ -0,0 +1,154 @@
+import math
+import time
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Preallocated ring of the last capacity (timestamp, value) samples of one series. Appending is O(1), window
+# queries look at every retained sample, as replayed samples may arrive after newer ones. Backed by array.array,
+# with numpy installed the queries run on zero copy views of it.
+class TimeSeriesRing:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.count = 0  # samples appended over the whole run
+        if numpy is not None:
+            self._timestamps_view = numpy.frombuffer(self.timestamps)
+            self._values_view = numpy.frombuffer(self.values)
+
+    def append(self, timestamp, value):
+        i = self.count % self.capacity
+        self.timestamps[i] = timestamp
+        self.values[i] = value
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    # Latest appended (timestamp, value), None if empty
+    def last(self):
+        if not self.count:
+            return None
+        i = (self.count - 1) % self.capacity
+        return self.timestamps[i], self.values[i]
+
+    # (timestamps, values) of the retained samples with timestamp >= start, oldest first
+    def window(self, start=-math.inf):
+        size = len(self)
+        if numpy is not None:
+            timestamps = self._timestamps_view[:size]
+            mask = timestamps >= start
+            order = numpy.argsort(timestamps[mask], kind='stable')
+            return timestamps[mask][order].tolist(), self._values_view[:size][mask][order].tolist()
+        samples = sorted((t, v) for t, v in zip(self.timestamps[:size], self.values[:size]) if t >= start)
+        return [t for t, _ in samples], [v for _, v in samples]
+
+    # Values with timestamp >= start, in no particular order
+    def values_since(self, start=-math.inf):
+        size = len(self)
+        if numpy is not None:
+            return self._values_view[:size][self._timestamps_view[:size] >= start]
+        return [v for t, v in zip(self.timestamps[:size], self.values[:size]) if t >= start]
+
+    def mean(self, start=-math.inf):
+        values = self.values_since(start)
+        if not len(values):
+            return None
+        return float(numpy.mean(values)) if numpy is not None else sum(values) / len(values)
+
+    # Nearest rank percentile, as RTTStats
+    def percentile(self, p, start=-math.inf):
+        values = self.values_since(start)
+        if not len(values):
+            return None
+        ordered = numpy.sort(values) if numpy is not None else sorted(values)
+        return float(ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)])
+
+
+# Metrics a node reported to us, one TimeSeriesRing per (component, metric). The component is the pid of a row, or
+# its network interface, the metric is a numeric column (cpu, memory, bytes_sent, ...), the averaged AVG(cpu) of a
+# polled report is stored as cpu. Timestamps are moved to our time.monotonic(): rows sampled by the node are shifted
+# by an estimate of the offset between its clock and ours, rows without a timestamp (polled averages) are stamped
+# with their arrival. Windows are the last seconds before now, so policies read recent metrics of every node the
+# same way, without the database.
+class NodeMetricStore:
+    # Samples kept per series
+    capacity = 3600
+    # A live batch arriving this many seconds later than the offset predicts means the node's clock restarted
+    clock_restart_tolerance = 10.0
+    _not_metrics = frozenset(('timestamp', 'lag', 'pid', 'component', 'interface', 'process_name', 'child'))
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity or self.capacity
+        self.series = dict()  # (component, metric) -> TimeSeriesRing
+        self._component_rings = dict()  # component -> row column -> TimeSeriesRing, the columns of rows as sent
+        self.component_names = dict()  # pid -> process name, from the rows that carry one
+        self.num_rows = 0
+        # Our clock minus the node's. Estimated from live batches, whose newest row was sampled just before it was
+        # sent: the smallest estimate is the closest to the truth, later arrivals only add delay.
+        self._clock_offset = None
+
+    # Store a batch of metric rows received at received_t (time.monotonic(), now by default). Rows that are not
+    # live, such as replayed ones, are older than their arrival and don't count towards the clock offset.
+    def add(self, rows: list[dict], received_t=None, live=True):
+        received_t = time.monotonic() if received_t is None else received_t
+        timestamps = [row['timestamp'] for row in rows if row.get('timestamp') is not None]
+        if timestamps and (live or self._clock_offset is None):
+            offset = received_t - max(timestamps)
+            if self._clock_offset is None or offset > self._clock_offset + self.clock_restart_tolerance:
+                self._clock_offset = offset
+            else:
+                self._clock_offset = min(self._clock_offset, offset)
+        for row in rows:
+            timestamp = row.get('timestamp')
+            timestamp = received_t if timestamp is None else timestamp + self._clock_offset
+            component = row.get('interface')
+            if component is None:
+                component = row.get('pid')
+            if row.get('process_name') is not None:
+                self.component_names[component] = row['process_name']
+            rings = self._component_rings.get(component)
+            if rings is None:
+                rings = self._component_rings[component] = dict()
+            for key, value in row.items():
+                ring = rings.get(key)
+                if ring is None:
+                    if key in self._not_metrics or not isinstance(value, (int, float)):
+                        continue
+                    metric = key[4:-1] if key.startswith('AVG(') else key
+                    ring = self.series.get((component, metric))
+                    if ring is None:
+                        ring = self.series[(component, metric)] = TimeSeriesRing(self.capacity)
+                    rings[key] = ring
+                if value is not None:
+                    ring.append(timestamp, value)
+        self.num_rows += len(rows)
+
+    def get_series(self, component, metric) -> TimeSeriesRing:
+        return self.series.get((component, metric))
+
+    @staticmethod
+    def _start(seconds):
+        return -math.inf if seconds is None else time.monotonic() - seconds
+
+    # (timestamps, values) of the last seconds (everything retained for None), None for an unknown series
+    def window(self, component, metric, seconds=None):
+        ring = self.get_series(component, metric)
+        return None if ring is None else ring.window(self._start(seconds))
+
+    def mean(self, component, metric, seconds=None):
+        ring = self.get_series(component, metric)
+        return None if ring is None else ring.mean(self._start(seconds))
+
+    def percentile(self, component, metric, p, seconds=None):
+        ring = self.get_series(component, metric)
+        return None if ring is None else ring.percentile(p, self._start(seconds))
+
+    def last(self, component, metric):
+        ring = self.get_series(component, metric)
+        return None if ring is None else ring.last()
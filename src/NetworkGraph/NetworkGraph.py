@@ -1,9 +1,12 @@
+import time
 import uuid
 from enum import Enum
 import logging
 from typing import Union
 
 from src.NetProtocol.ConnectionHandler import ConnectionHandler
+from src.NetProtocol.Ping import RTTStats
+from src.NetworkGraph.MetricStore import NodeMetricStore
 from src.app.Component import Component
 
 
@@ -19,9 +22,10 @@ class NetworkEdge:
         self.v1_uuid = v1_uuid
         self.v2_uuid = v2_uuid
         self.conn_uuid = v1_uuid.bytes + v2_uuid.bytes
+        self.rtt = RTTStats()  # Measured by pinging the other end
 
     def __str__(self):
-        return f"{str(self.v1_uuid)[-5:]} <-> {str(self.v2_uuid)[-5:]}"
+        return f"{str(self.v1_uuid)[-5:]} <-> {str(self.v2_uuid)[-5:]} (rtt {self.rtt})"
 
 
 # Represents a host on the network
@@ -30,7 +34,6 @@ class NetworkNode:
     name = "unknown"
     type = NetworkNodeType.UNKNOWN
     components = []  # Known components
-    received_metrics = []  # List of received metric dicts
 
     def __init__(self, name, conn_handler: ConnectionHandler, addr, node_uuid, node_type, hardware=None):
         self.name = name
@@ -40,15 +43,41 @@ class NetworkNode:
         self.type = node_type
         self.hardware = hardware
         self.is_active = True
+        self.inactive_since = None  # time.monotonic() when the connection was lost
+        self.exited = False  # The peer said goodbye, it will not reconnect
+        self.metrics = NodeMetricStore()  # Metrics the peer reported, kept across reconnects
 
     def __str__(self):
         return f"({self.name}, {str(self.uuid) [-5:]})"
 
+    # The connection to the peer was lost. Ignored for connections the peer has since been reattached from.
+    def deactivate(self, conn_handler: ConnectionHandler = None):
+        if conn_handler is not None and conn_handler is not self.conn_handler:
+            return
+        if self.is_active:
+            self.is_active = False
+            self.inactive_since = time.monotonic()
+
+    # The peer reconnected and resumed its identity, keep everything known about it
+    def reattach(self, conn_handler: ConnectionHandler, addr):
+        self.conn_handler = conn_handler
+        self.addr = addr
+        self.is_active = True
+        self.inactive_since = None
+        self.exited = False
+
+    # True once the peer exited, or has been disconnected for longer than grace seconds
+    def is_lost(self, grace=0) -> bool:
+        if self.is_active:
+            return False
+        return self.exited or time.monotonic() - self.inactive_since >= grace
+
     def add_known_component(self, component: Component):
         self.components.append(component)
 
-    def add_received_metric(self, metric):
-        self.received_metrics.append(metric)
+    # Store a batch of metric rows the peer sent, live unless they were sampled a while ago (replayed)
+    def add_received_metric(self, metric: list[dict], live=True):
+        self.metrics.add(metric, live=live)
 
 
 # Constructs a graph of the network resources that this node knows about
@@ -72,6 +101,9 @@ class NetworkGraph:
     def get_server(self):
         return self.get_node(self._server)
 
+    def has_node(self, node_uuid) -> bool:
+        return node_uuid in self._nodes
+
     # Create new node and add it to the dict
     def new_node(self, name, conn_handler: ConnectionHandler, addr, node_type, node_uuid, hardware=None):
         node = NetworkNode(name, conn_handler, addr, node_uuid, node_type, hardware)
@@ -161,7 +193,10 @@ class NetworkGraph:
             return
 
         # Check connection not already made, using uuid combination as a per-connection uuid
-        return self.get_connection_by_conn_uuid(v1_uuid + v2_uuid)
+        return self.get_connection_by_conn_uuid(v1_uuid.bytes + v2_uuid.bytes)
+
+    def get_connection_to_self(self, other_uuid) -> Union[NetworkEdge, None]:
+        return self.get_connection_by_nodes(self._own_uuid, other_uuid)
 
     def __str__(self):
         f_str = "Nodes:\n"
@@ -1,10 +1,8 @@
 import logging
 from pynvml import *
 
-from psutil import NoSuchProcess, AccessDenied
-
 from src.PerformanceReport.Metrics import Metric
-import psutil
+from src.PerformanceReport.ProcessStats import ProcessGone, get_descendants, get_process_stats_reader
 
 
 
@@ -13,35 +11,89 @@ from src.app.Component import Component
 
 
 class HardwareMetrics(Metric):
+    name = "HardwareMetrics"
     _db_sub_query = "SELECT pid FROM components WHERE pid = :pid"
-    db_query_template = f"INSERT INTO hardware_metrics VALUES (:timestamp, ({_db_sub_query}), :cpu, :memory)"
+    db_query_template = f"INSERT INTO hardware_metrics (timestamp, component, cpu, memory, lag) VALUES" \
+                        f" (:timestamp, ({_db_sub_query}), :cpu, :memory, :lag)"
+    db_table = "hardware_metrics"
+    aggregate_fields = ('cpu', 'memory')
+    high_rate_key = 'pid'
+    high_rate_fields = aggregate_fields
+    db_child_query_template = "INSERT INTO process_tree_metrics (timestamp, component, pid, cpu, memory, lag) VALUES" \
+                              " (:timestamp, :component, :pid, :cpu, :memory, :lag)"
+    db_child_table = "process_tree_metrics"
+    # Read /proc directly on Linux instead of going through psutil
+    use_procfs = True
+    # Seconds between looking for new child processes of the components, finding them means listing all processes
+    process_tree_interval = 2.0
+    # Also store a row for every child process, in process_tree_metrics
+    store_child_metrics = False
+
+    def __init__(self, components: [Component]):
+        super().__init__(components)
+        self.reader = get_process_stats_reader(self.use_procfs)
+        self._tree_refreshed = None
 
-    def __init__(self, components: [Component], elapsed_time):
-        super().__init__(components, elapsed_time)
-        self.name = "HardwareMetrics"
+    # Find the processes started by each component, components started by us are not part of our tree. Other
+    # samplers read comp.children from their own threads, so it is only ever replaced, never changed in place.
+    def _refresh_process_trees(self):
+        children_map = self.reader.children_map()
+        component_pids = {comp.pid for comp in self.components if comp.is_active}
+        for comp in self.components:
+            if comp.is_active:
+                comp.children = get_descendants(children_map, comp.pid, exclude=component_pids)
 
     # Gets report of hardware stats that do change, eg cpu percentage
-    def run(self):
+    def measure(self, timestamp, lag) -> list[dict]:
         # collect global cpu percentage, first call will return a zero!
-
-        cpu_global = psutil.cpu_percent(interval=None, percpu=False)
-        mem_global = psutil.virtual_memory().used
-        results_dicts = [dict(timestamp=self.elapsed_time, pid=-1,
+        cpu_global, mem_global = self.reader.read_system()
+        results_dicts = [dict(timestamp=timestamp, lag=lag, pid=-1,
                               cpu=cpu_global, memory=mem_global)]
+        if self._tree_refreshed is None or timestamp - self._tree_refreshed >= self.process_tree_interval:
+            self._tree_refreshed = timestamp
+            self._refresh_process_trees()
+        active_pids = set()
         for comp in self.components:
             if not comp.is_active:
                 continue
+            active_pids.add(comp.pid)
             try:
-                # if we didnt spawn this process then add a psutil wrapper to it
-                if comp.process is None:
-                    comp.process = psutil.Process(pid=comp.pid)
-                # otherwise we already have one
-                cpu = comp.process.cpu_percent(interval=None)
+                # Components we spawned already have a psutil handle, the reader keeps one for the others
                 # RSS is platform portable, but not the best measure of memory usage
-                mem = comp.process.memory_info().rss
-                results_dicts.append(dict(timestamp=self.elapsed_time, pid=comp.pid,
-                                          cpu=cpu, memory=mem))
+                cpu, mem = self.reader.read(comp.pid, comp.process)
+            except ProcessGone:
+                logging.warning(f"Component {comp.name} (PID {comp.pid}) has exited, no longer measuring it")
+                comp.is_active = False
+                continue
             except Exception as e:
                 logging.error(f"PID {comp.pid} hw measuring gave error {e}")
+                continue
+            # The component's numbers cover its whole process tree. Memory shared between the processes is
+            # counted once per process.
+            children = comp.children
+            gone = set()
+            for child in children:
+                try:
+                    child_cpu, child_mem = self.reader.read(child)
+                except ProcessGone:
+                    gone.add(child)
+                    continue
+                except Exception as e:
+                    logging.debug(f"PID {child} of {comp.name} hw measuring gave error {e}")
+                    continue
+                active_pids.add(child)
+                cpu += child_cpu
+                mem += child_mem
+                if self.store_child_metrics:
+                    results_dicts.append(dict(timestamp=timestamp, lag=lag, component=comp.pid, pid=child,
+                                              cpu=child_cpu, memory=child_mem, child=True))
+            if gone:
+                comp.children = children - gone
+            results_dicts.append(dict(timestamp=timestamp, lag=lag, pid=comp.pid,
+                                      cpu=cpu, memory=mem))
+        self.reader.retain(active_pids)
         # result to dict, could also be dataframe
-        self.result = results_dicts
+        return results_dicts
+
+    def close(self):
+        self.reader.close()
@@ -0,0 +1,74 @@
+from collections import deque
+
+
+# Running count, sum, min, max and last of one value
+class Aggregate:
+    __slots__ = ('count', 'total', 'min', 'max', 'last')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.last = value
+
+    def avg(self):
+        return self.total / self.count if self.count else None
+
+    def report(self) -> dict:
+        return dict(count=self.count, avg=self.avg(), min=self.min, max=self.max, last=self.last)
+
+
+# Per component aggregates of the rows a metric collector stores, kept alongside the database so period queries
+# don't rescan the metric table. Rows are bucketed by sample time (a collection writes all its rows with the same
+# timestamp); the newest max_buckets buckets are kept, so a window query costs the number of samples in the window
+# regardless of how long the run is. Windows reaching past the retained buckets return None.
+class MetricAggregates:
+    max_buckets = 3600
+
+    def __init__(self, fields: tuple, max_buckets=None):
+        self.fields = fields
+        self.max_buckets = max_buckets or self.max_buckets
+        self._buckets = deque()  # (timestamp, [(pid, values)])
+        # Largest timestamp that was evicted, windows starting before it are incomplete
+        self._evicted_until = None
+        # pid -> Aggregate per field over the whole run
+        self.totals = dict()
+
+    def add(self, rows: list[dict]):
+        for row in rows:
+            timestamp = row['timestamp']
+            if not self._buckets or self._buckets[-1][0] != timestamp:
+                self._buckets.append((timestamp, []))
+                if len(self._buckets) > self.max_buckets:
+                    self._evicted_until = self._buckets.popleft()[0]
+            values = tuple(row[field] for field in self.fields)
+            self._buckets[-1][1].append((row['pid'], values))
+            totals = self.totals.get(row['pid'])
+            if totals is None:
+                totals = self.totals[row['pid']] = [Aggregate() for _ in self.fields]
+            for aggregate, value in zip(totals, values):
+                aggregate.add(value)
+
+    # pid -> Aggregate per field of the rows with timestamp > time_start, None if they are not all retained
+    def window(self, time_start) -> dict:
+        if self._evicted_until is not None and time_start < self._evicted_until:
+            return None
+        result = dict()
+        for timestamp, samples in reversed(self._buckets):
+            if timestamp <= time_start:
+                break
+            for pid, values in samples:
+                aggregates = result.get(pid)
+                if aggregates is None:
+                    aggregates = result[pid] = [Aggregate() for _ in self.fields]
+                for aggregate, value in zip(aggregates, values):
+                    aggregate.add(value)
+        return result
@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import sqlite3
+
+from src.app.DatabaseSchema import get_schema_version
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Columnar export of a run's metric database. Every table becomes a directory of one .npy file per column, which
+# numpy.load can memory map, so many runs are analysed without turning rows into Python objects. REAL columns are
+# float64, INTEGER columns int64 (float64 with NaN if they hold NULLs) and TEXT columns fixed width unicode with ''
+# for NULL. With pyarrow installed every table is also written as <table>.parquet. manifest.json lists the tables
+# and their row counts.
+
+# Rows read from the database at a time
+export_chunk_rows = 65536
+
+
+def _column_dtype(db: sqlite3.Connection, table, column, declared_type):
+    declared_type = declared_type.upper()
+    if 'INT' in declared_type:
+        has_null = db.execute(f'SELECT COUNT(*) - COUNT("{column}") FROM "{table}"').fetchone()[0]
+        return numpy.float64 if has_null else numpy.int64
+    if 'CHAR' in declared_type or 'TEXT' in declared_type or 'CLOB' in declared_type:
+        length = db.execute(f'SELECT MAX(LENGTH("{column}")) FROM "{table}"').fetchone()[0]
+        return numpy.dtype(f'U{max(length or 0, 1)}')
+    return numpy.float64
+
+
+# Write the columns of one table to table_dir, returns the number of rows
+def export_table(db: sqlite3.Connection, table, table_dir, parquet=True) -> int:
+    columns = [(row[1], row[2]) for row in db.execute(f'PRAGMA table_info("{table}")')]
+    num_rows = db.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    os.makedirs(table_dir, exist_ok=True)
+    arrays = []
+    for column, declared_type in columns:
+        dtype = _column_dtype(db, table, column, declared_type)
+        arrays.append(numpy.lib.format.open_memmap(os.path.join(table_dir, f"{column}.npy"), mode='w+',
+                                                   dtype=dtype, shape=(num_rows,)))
+    selected = ', '.join(f'"{column}"' for column, _ in columns)
+    cursor = db.execute(f'SELECT {selected} FROM "{table}"')
+    written = 0
+    while written < num_rows:
+        chunk = cursor.fetchmany(export_chunk_rows)
+        if not chunk:
+            break
+        for array, values in zip(arrays, zip(*chunk)):
+            if array.dtype.kind == 'U':
+                values = ['' if value is None else value for value in values]
+            array[written:written + len(chunk)] = values
+        written += len(chunk)
+    for array in arrays:
+        array.flush()
+    if parquet and pyarrow is not None:
+        pyarrow.parquet.write_table(pyarrow.table({column: array[:written] for (column, _), array
+                                                   in zip(columns, arrays)}), f"{table_dir}.parquet")
+    return written
+
+
+# Export every table of the database in db_file to out_dir/<run name>, returns that directory
+def export_run(db_file, out_dir, tables=None, parquet=True) -> str:
+    if numpy is None:
+        raise RuntimeError("Exporting metrics needs numpy")
+    run_dir = os.path.join(out_dir, os.path.splitext(os.path.basename(db_file))[0])
+    os.makedirs(run_dir, exist_ok=True)
+    # Read only and in one transaction, a run still being written is exported as far as it was committed
+    db = sqlite3.connect(f"file:{os.path.abspath(db_file)}?mode=ro", uri=True)
+    try:
+        db.execute("BEGIN")
+        all_tables = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'"
+                                                   " AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+        manifest = dict(source=os.path.abspath(db_file), schema_version=get_schema_version(db), tables=dict())
+        for table in all_tables:
+            if tables and table not in tables:
+                continue
+            manifest['tables'][table] = export_table(db, table, os.path.join(run_dir, table), parquet)
+    finally:
+        db.close()
+    with open(os.path.join(run_dir, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    logging.info(f"Exported {db_file} to {run_dir}: {manifest['tables']}")
+    return run_dir
+
+
+# Column name -> array of a table of an exported run, memory mapped unless mmap is False
+def load_run(run_dir, table, columns=None, mmap=True) -> dict:
+    table_dir = os.path.join(run_dir, table)
+    if columns is None:
+        columns = [name[:-4] for name in sorted(os.listdir(table_dir)) if name.endswith('.npy')]
+    return {column: numpy.load(os.path.join(table_dir, f"{column}.npy"), mmap_mode='r' if mmap else None)
+            for column in columns}
+
+
+# A table of many exported runs as one array per column, with a 'run' column holding each row's index in run_dirs.
+# Runs without the table are left out.
+def load_runs(run_dirs, table, columns=None) -> dict:
+    runs = [(i, load_run(run_dir, table, columns)) for i, run_dir in enumerate(run_dirs)
+            if os.path.isdir(os.path.join(run_dir, table))]
+    if not runs:
+        return dict()
+    result = {column: numpy.concatenate([run[column] for _, run in runs]) for column in runs[0][1]}
+    result['run'] = numpy.concatenate([numpy.full(len(next(iter(run.values()))), i, dtype=numpy.int32)
+                                       for i, run in runs])
+    return result
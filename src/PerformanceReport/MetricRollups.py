@@ -0,0 +1,68 @@
+import math
+
+
+# Rollup tiers of a metric's aggregate fields in {db_table}_rollup: count, sum, min and max per component over
+# buckets of each tier's resolution in seconds. Every batch of rows a collector writes is folded into its buckets
+# and upserted, so a bucket is complete as soon as its time has passed and no raw rows are read again. Buckets older
+# than their tier's retention (0 keeps them) are deleted. Buckets are keyed by the pid of the rows, system wide rows
+# keep their pid of -1.
+class MetricRollups:
+    # A window is answered from a tier once it spans this many of its buckets
+    min_buckets = 60
+
+    def __init__(self, db_table, fields: tuple, tiers):
+        self.db_table = db_table
+        self.table = f"{db_table}_rollup"
+        self.fields = fields
+        self.tiers = sorted(tiers)  # (resolution, retention) pairs, finest first
+        columns = [f"{field}_{stat}" for field in fields for stat in ('sum', 'min', 'max')]
+        updates = [f"{field}_sum = {field}_sum + excluded.{field}_sum,"
+                   f" {field}_min = min({field}_min, excluded.{field}_min),"
+                   f" {field}_max = max({field}_max, excluded.{field}_max)" for field in fields]
+        self.upsert_query = f"INSERT INTO {self.table} (resolution, timestamp, component, count," \
+                            f" {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 4))})" \
+                            f" ON CONFLICT (resolution, timestamp, component) DO UPDATE SET" \
+                            f" count = count + excluded.count, {', '.join(updates)}"
+        # Keyed like the rows of the collector's window query
+        averages = ', '.join(f'SUM({field}_sum) / SUM(count) AS "AVG({field})"' for field in fields)
+        self.window_query = f"SELECT {averages}, pid, process_name FROM {self.table} INNER JOIN components ON" \
+                            f" components.pid = {self.table}.component WHERE resolution = ? AND timestamp > ?" \
+                            f" GROUP BY pid"
+        self.prune_query = f"DELETE FROM {self.table} WHERE resolution = ? AND timestamp < ?"
+
+    # Upsert parameters of the buckets the rows fall into, one per tier, bucket and component
+    def add(self, rows: list[dict]) -> list[tuple]:
+        buckets = dict()  # (resolution, bucket start, pid) -> [count, sum, min, max of each field]
+        for row in rows:
+            values = [row[field] for field in self.fields]
+            for resolution, _ in self.tiers:
+                key = (resolution, math.floor(row['timestamp'] / resolution) * resolution, row['pid'])
+                bucket = buckets.get(key)
+                if bucket is None:
+                    bucket = buckets[key] = [0]
+                    for value in values:
+                        bucket += (value, value, value)
+                else:
+                    for i, value in enumerate(values):
+                        bucket[3 * i + 1] += value
+                        bucket[3 * i + 2] = min(bucket[3 * i + 2], value)
+                        bucket[3 * i + 3] = max(bucket[3 * i + 3], value)
+                bucket[0] += 1
+        return [(*key, *bucket) for key, bucket in buckets.items()]
+
+    # (resolution, cutoff) for each tier with a retention, buckets starting before the cutoff are expired
+    def expired(self, now) -> list[tuple]:
+        return [(resolution, now - retention) for resolution, retention in self.tiers if retention > 0]
+
+    # Resolution of the tier to answer the window from time_start to time_end with, None for the raw rows: the
+    # coarsest tier the window spans min_buckets buckets of that still covers it. Shorter windows use the raw rows
+    # while raw_start (the oldest retained raw timestamp) covers them, otherwise the finest tier that does.
+    def select_tier(self, time_start, time_end, raw_start=None):
+        covering = [resolution for resolution, retention in self.tiers
+                    if retention <= 0 or time_start >= time_end - retention]
+        spanned = [resolution for resolution in covering if time_end - time_start >= resolution * self.min_buckets]
+        if spanned:
+            return spanned[-1]
+        if raw_start is None or time_start >= raw_start or not covering:
+            return None
+        return covering[0]
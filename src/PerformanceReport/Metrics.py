@@ -1,56 +1,278 @@
-import datetime
 import logging
+import math
 import sqlite3
 import threading
-from enum import Enum
+import time
+from collections import deque
 
+from src.NetProtocol.Message import Message
+from src.NetProtocol.Request import Request, RequestType
+from src.PerformanceReport.MetricAggregates import MetricAggregates
+from src.PerformanceReport.MetricRollups import MetricRollups
+from src.PerformanceReport.SampleRing import HighRateStore
 from src.app.Component import Component
+from src.app.DatabaseWriter import DatabaseWriter
 
 
 class MetricCollectionMode:
     TO_DB = 'd'
     SEND = 's'
     TO_STDOUT = 'l'
+    # Keep samples in memory rings and only store per second aggregates, combined with TO_DB
+    HIGH_RATE = 'h'
 
 
-# Parent class for metric collectors
-class Metric(threading.Thread):
-    result = None
+# Parent class for metrics. One instance is kept for the whole run, so it can hold state between samples.
+class Metric:
+    name = "Metric"
+    # Table the results are written to and the per component columns kept as running aggregates
+    db_table = None
+    aggregate_fields = ()
+    # Insert for rows marked child=True, which are kept out of db_table and its aggregates, and the table it writes
+    db_child_query_template = None
+    db_child_table = None
+    # In high rate mode, rows are kept in a ring per value of this column with these columns sampled
+    high_rate_key = None
+    high_rate_fields = ()
 
-    def __init__(self, components: [Component], elapsed_time):
-        super().__init__()
+    def __init__(self, components: [Component]):
         self.components = components
-        self.elapsed_time = elapsed_time
 
-    def run(self):
+    # Take one sample, returns the rows to store. Rows carry the sample timestamp and its scheduling lag.
+    def measure(self, timestamp, lag) -> list[dict]:
+        return []
+
+    # Release whatever the metric holds on to, called once sampling stopped
+    def close(self):
         pass
 
 
-# Manages running metric collector threads
+# Runs a metric at a fixed rate on its own thread. Ticks are scheduled on the monotonic clock against the start
+# time, so the rate does not drift with how long samples take or with wall clock changes. A sample that is late by
+# a whole period or more skips the ticks it missed (sampling back to back would only measure a few microseconds),
+# they are counted in num_skipped.
+class Sampler(threading.Thread):
+    def __init__(self, metric: Metric, period, start_t, termination_event: threading.Event,
+                 store: HighRateStore = None):
+        super().__init__(name=f"{metric.name}Sampler", daemon=True)
+        self.metric = metric
+        # Takes the rows it keeps in high rate mode
+        self.store = store
+        self.period = period
+        self.start_t = start_t
+        self.termination_event = termination_event
+        self._stop_event = threading.Event()
+        # Collected rows waiting to be processed by the owning thread
+        self.results = deque()
+        # statistics
+        self.num_samples = 0
+        self.num_skipped = 0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        tick = 0
+        while not self.termination_event.is_set() and not self._stop_event.is_set():
+            deadline = self.start_t + tick * self.period
+            remaining = deadline - time.monotonic()
+            if remaining > 0 and self._stop_event.wait(remaining):
+                break
+            now = time.monotonic()
+            lag = now - deadline
+            try:
+                rows = self.metric.measure(now - self.start_t, lag)
+            except Exception as error:
+                logging.error(f"{self.metric.name} sample failed with {error!r}")
+                rows = []
+            if self.store is not None:
+                rows = self.store.add(rows)
+            if rows:
+                self.results.append(rows)
+            self.num_samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            # Next tick that is less than a period overdue, the ones before it are skipped
+            next_tick = max(int((time.monotonic() - self.start_t) / self.period), tick + 1)
+            self.num_skipped += next_tick - tick - 1
+            tick = next_tick
+        self.metric.close()
+
+    def get_stats(self) -> dict:
+        return dict(samples=self.num_samples, skipped=self.num_skipped,
+                    avg_lag_ms=self.total_lag / self.num_samples * 1000 if self.num_samples else 0.0,
+                    max_lag_ms=self.max_lag * 1000)
+
+
+# Manages a metric's sampler thread and stores what it collects
 class MetricCollector:
-    def __init__(self, metric_type, components, mode: str, db_cursor: sqlite3.Cursor):
+    # Seconds of raw samples kept in high rate mode
+    high_rate_window = 60.0
+    high_rate_query_template = "INSERT INTO high_rate_metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    # (resolution, retention) in seconds of the rollup tiers of the aggregate fields, retention 0 keeps a tier
+    rollup_tiers = ()
+    # Seconds stored rows are kept for, 0 keeps them for the whole run. Rollups and running aggregates are kept.
+    raw_retention = 0.0
+    # Seconds of samples between deleting what is past its retention
+    prune_interval = 10.0
+
+    def __init__(self, metric_type, components, mode: str, db_writer: DatabaseWriter):
         self.metric_type = metric_type
-        self.metric_thread = None
+        self.sampler = None
+        self.high_rate = None
+        # Connection the stored rows are pushed over in SEND mode, see subscribe
+        self.stream_conn = None
+        self.stream_interval = 1.0
+        self._stream_rows = []
+        self._stream_sent = 0.0
         self.mode = mode
         self.components = components
-        self.db = db_cursor
+        self.db = db_writer
+        # Aggregates of the rows written to the database, for answering period queries without scanning the table
+        self.aggregates = MetricAggregates(metric_type.aggregate_fields) \
+            if mode.__contains__(MetricCollectionMode.TO_DB) and metric_type.aggregate_fields else None
+        # Rollup tiers, for windows the aggregates no longer cover
+        self.rollups = MetricRollups(metric_type.db_table, metric_type.aggregate_fields, self.rollup_tiers) \
+            if mode.__contains__(MetricCollectionMode.TO_DB) and metric_type.aggregate_fields and self.rollup_tiers \
+            else None
+        # Latest timestamp stored and when stored rows were last pruned
+        self._latest = None
+        self._pruned = None
+        # Fallback for windows the aggregates no longer cover, without rollups. The table name comes from the metric class, never
+        # from a request. None for metrics without per component averages.
+        self.window_query = None
+        if metric_type.aggregate_fields:
+            self.window_query = f"SELECT {', '.join(f'AVG({field})' for field in metric_type.aggregate_fields)}," \
+                                f" pid, process_name FROM {metric_type.db_table} INNER JOIN components ON" \
+                                f" components.pid = {metric_type.db_table}.component WHERE timestamp > ? GROUP BY pid"
+
+    # Sample every period seconds, timestamps are seconds since start_t on the monotonic clock
+    def start(self, period, start_t, termination_event: threading.Event):
+        metric = self.metric_type(self.components)
+        if self.mode.__contains__(MetricCollectionMode.HIGH_RATE) and metric.high_rate_key is not None:
+            if HighRateStore.is_supported():
+                self.high_rate = HighRateStore(metric.name, metric.high_rate_key, metric.high_rate_fields,
+                                               math.ceil(self.high_rate_window / period) + 1)
+            else:
+                logging.warning(f"High rate mode needs numpy, storing every {metric.name} sample instead")
+        self.sampler = Sampler(metric, period, start_t, termination_event, store=self.high_rate)
+        self.sampler.start()
 
-    def collect(self, elapsed_time):
-        self.metric_thread = self.metric_type(self.components, elapsed_time)
-        self.metric_thread.start()
+    def stop(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.join(timeout=1)
+            logging.info(f"{self.sampler.metric.name} sampling stats: {self.sampler.get_stats()}")
 
+    # Store everything sampled since the last call, runs on the thread owning the database connection
     def process_results(self):
-        self.metric_thread.join()
-        # Collect the metric
-        collected_result = self.metric_thread.result
+        if self.sampler is None:
+            return
+        while self.sampler.results:
+            self._process_result(self.sampler.results.popleft())
+        if self.high_rate is not None:
+            mean_rows, summary_rows = self.high_rate.aggregate(final=not self.sampler.is_alive())
+            if mean_rows:
+                self._process_result(mean_rows)
+            if summary_rows and self.mode.__contains__(MetricCollectionMode.TO_DB):
+                self.db.executemany(self.high_rate_query_template, summary_rows)
+        self._prune()
+
+    # Delete the stored rows and rollup buckets past their retention, every prune_interval seconds of samples
+    def _prune(self):
+        if self._latest is None or (self._pruned is not None and self._latest - self._pruned < self.prune_interval):
+            return
+        self._pruned = self._latest
+        if self.raw_retention > 0:
+            cutoff = self._latest - self.raw_retention
+            self.db.execute(f"DELETE FROM {self.metric_type.db_table} WHERE timestamp < ?", (cutoff,))
+            if self.metric_type.db_child_table is not None:
+                self.db.execute(f"DELETE FROM {self.metric_type.db_child_table} WHERE timestamp < ?", (cutoff,))
+            if self.high_rate is not None:
+                self.db.execute("DELETE FROM high_rate_metrics WHERE metric = ? AND timestamp < ?",
+                                (self.high_rate.metric_name, cutoff))
+        if self.rollups is not None:
+            for resolution, cutoff in self.rollups.expired(self._latest):
+                self.db.execute(self.rollups.prune_query, (resolution, cutoff))
+
+    # Push what is stored to conn_handler every interval seconds, stop with an interval of 0
+    def subscribe(self, conn_handler, interval):
+        self.mode = self.mode.replace(MetricCollectionMode.SEND, '')
+        self._stream_rows = []
+        if interval > 0:
+            self.mode += MetricCollectionMode.SEND
+            self.stream_conn = conn_handler
+            self.stream_interval = interval
+            self._stream_sent = time.monotonic()
+        else:
+            self.stream_conn = None
+
+    # Send the rows batched since the last push if the interval passed. No round trip, the peer doesn't reply.
+    def flush_stream(self):
+        if self.stream_conn is None or time.monotonic() - self._stream_sent < self.stream_interval:
+            return
+        self._stream_sent = time.monotonic()
+        rows, self._stream_rows = self._stream_rows, []
+        # While disconnected rows are only stored, they are replayed once the session is resumed
+        if not rows or (self.stream_conn.peer is not None and not self.stream_conn.peer.is_active):
+            return
+        metric_dict = dict(metrics=rows, period=self.stream_interval, stream=self.metric_type.db_table)
+        self.stream_conn.send_message(Message(content=Request(RequestType.METRIC, metric_dict)))
 
+    # Write the raw high rate samples with start <= timestamp < end to an .npz file, returns the number of samples
+    # or None if the collector is not in high rate mode
+    def dump_high_rate(self, start, end, path) -> int:
+        if self.high_rate is None:
+            return None
+        return self.high_rate.dump(start, end, path)
+
+    def _process_result(self, collected_result):
         if self.mode.__contains__(MetricCollectionMode.TO_STDOUT):
-            logging.info(f"{self.metric_thread.name} - {self.metric_thread.elapsed_time} - {collected_result}")
+            logging.info(f"{self.sampler.metric.name} - {collected_result}")
         if self.mode.__contains__(MetricCollectionMode.SEND):
-            # TODO Send the results as a message to the server immediately
-            pass
+            # Batched until the next flush_stream
+            self._stream_rows.extend(collected_result)
         if self.mode.__contains__(MetricCollectionMode.TO_DB):
-            try:
-                self.db.executemany(self.metric_thread.db_query_template, collected_result)
-            except sqlite3.Error as error:
-                logging.error(error)
+            rows, child_rows = collected_result, None
+            if self.metric_type.db_child_query_template is not None:
+                child_rows = [row for row in collected_result if row.get('child')]
+                if child_rows:
+                    rows = [row for row in collected_result if not row.get('child')]
+            # Written on the database writer's thread, which logs failed writes
+            self.db.executemany(self.metric_type.db_query_template, rows)
+            if child_rows:
+                self.db.executemany(self.metric_type.db_child_query_template, child_rows)
+            if self.aggregates is not None:
+                self.aggregates.add(rows)
+            if self.rollups is not None:
+                self.db.executemany(self.rollups.upsert_query, self.rollups.add(rows))
+            if collected_result:
+                latest = max(row['timestamp'] for row in collected_result)
+                self._latest = latest if self._latest is None else max(self._latest, latest)
+
+    # Rows like averages_since's from the database. Windows long enough for a rollup tier, or reaching past the
+    # retained rows, are answered from the coarsest fitting tier, its buckets overlapping the window are averaged.
+    def query_since(self, db: sqlite3.Connection, time_start) -> list:
+        tier = None
+        if self.rollups is not None and self._latest is not None:
+            raw_start = self._latest - self.raw_retention if self.raw_retention > 0 else None
+            tier = self.rollups.select_tier(time_start, self._latest, raw_start)
+        if tier is None:
+            return db.execute(self.window_query, (time_start,)).fetchall()
+        return db.execute(self.rollups.window_query, (tier, time_start - tier)).fetchall()
+
+    # Rows with the average of each aggregate field, the pid and the component name for each component sampled
+    # after time_start, keyed like the rows of window_query. None if the aggregates don't cover the window.
+    def averages_since(self, time_start) -> list:
+        if self.aggregates is None:
+            return None
+        window = self.aggregates.window(time_start)
+        if window is None:
+            return None
+        # Only components are reported, as the join with the components table does
+        names = {component.pid: component.name for component in self.components}
+        columns = [f"AVG({field})" for field in self.metric_type.aggregate_fields]
+        return [dict(zip(columns, (aggregate.avg() for aggregate in window[pid])), pid=pid, process_name=names[pid])
+                for pid in sorted(window) if pid in names]
@@ -1,6 +1,97 @@
-from Metrics import *
+import logging
 
+from src.PerformanceReport.Metrics import Metric
+from src.PerformanceReport.ProcessStats import get_process_stats_reader
+from src.app.Component import Component
 
-# Collects network metrics
-class NetworkMetrics(MetricCollector):
-    pass
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Collects network throughput per interface and socket activity per component. Interface counters are turned into
+# per second rates of everything net_io_counters reports. Per process byte counts are not available without kernel
+# tracing, so components report their established TCP connections, UDP sockets and distinct remote hosts instead,
+# summed over their process trees.
+class NetworkMetrics(Metric):
+    name = "NetworkMetrics"
+    counter_fields = ('bytes_sent', 'bytes_recv', 'packets_sent', 'packets_recv', 'errin', 'errout', 'dropin',
+                      'dropout')
+    socket_fields = ('tcp_connections', 'udp_sockets', 'remote_hosts')
+    _db_sub_query = "SELECT pid FROM components WHERE pid = :pid"
+    db_query_template = f"INSERT INTO network_metrics (timestamp, interface, component," \
+                        f" {', '.join(counter_fields + socket_fields)}, lag) VALUES (:timestamp, :interface," \
+                        f" ({_db_sub_query}), {', '.join(f':{field}' for field in counter_fields + socket_fields)}, :lag)"
+    db_table = "network_metrics"
+    # Interface rates are sampled at a high rate, component socket rows only every socket_interval
+    high_rate_key = 'interface'
+    high_rate_fields = counter_fields
+    # Read /proc directly on Linux instead of going through psutil
+    use_procfs = True
+    # Seconds between socket scans of the components, a scan goes through every open file of their processes
+    socket_interval = 2.0
+
+    def __init__(self, components: [Component]):
+        super().__init__(components)
+        self.reader = get_process_stats_reader(self.use_procfs)
+        self._last_interfaces = None
+        self._last_counters = None
+        self._last_timestamp = None
+        self._sockets_read = None
+
+    # Counter increase per second for every interface and counter. A counter that went down was reset, it reports 0.
+    def _rates(self, counters, elapsed):
+        if numpy is not None:
+            deltas = numpy.asarray(counters, dtype=numpy.float64) - self._last_counters
+            return (numpy.clip(deltas, 0, None) / elapsed).tolist()
+        return [[max(value - last, 0) / elapsed for value, last in zip(row, last_row)]
+                for row, last_row in zip(counters, self._last_counters)]
+
+    def _measure_interfaces(self, timestamp, lag) -> list[dict]:
+        interfaces, counters = self.reader.read_interfaces()
+        rows = []
+        # Rates need a previous sample of the same interfaces, an interface coming or going starts over
+        if interfaces == self._last_interfaces and timestamp > self._last_timestamp:
+            for interface, rates in zip(interfaces, self._rates(counters, timestamp - self._last_timestamp)):
+                row = dict(zip(self.counter_fields, rates))
+                row.update(timestamp=timestamp, lag=lag, interface=interface, pid=-1,
+                           tcp_connections=None, udp_sockets=None, remote_hosts=None)
+                rows.append(row)
+        self._last_interfaces = interfaces
+        self._last_counters = numpy.asarray(counters, dtype=numpy.float64) if numpy is not None else counters
+        self._last_timestamp = timestamp
+        return rows
+
+    def _measure_sockets(self, timestamp, lag) -> list[dict]:
+        # The process trees are refreshed on the hardware sampler's thread, take a snapshot of each
+        trees = [(comp, (comp.pid, *tuple(comp.children))) for comp in self.components if comp.is_active]
+        sockets = self.reader.read_sockets({pid for _, pids in trees for pid in pids})
+        rows = []
+        for comp, pids in trees:
+            if comp.pid not in sockets:
+                continue
+            tcp, udp, remotes = 0, 0, set()
+            for pid in pids:
+                if pid in sockets:
+                    tcp += sockets[pid][0]
+                    udp += sockets[pid][1]
+                    remotes |= sockets[pid][2]
+            row = dict.fromkeys(self.counter_fields)
+            row.update(timestamp=timestamp, lag=lag, interface=None, pid=comp.pid,
+                       tcp_connections=tcp, udp_sockets=udp, remote_hosts=len(remotes))
+            rows.append(row)
+        return rows
+
+    def measure(self, timestamp, lag) -> list[dict]:
+        rows = self._measure_interfaces(timestamp, lag)
+        if self._sockets_read is None or timestamp - self._sockets_read >= self.socket_interval:
+            self._sockets_read = timestamp
+            try:
+                rows += self._measure_sockets(timestamp, lag)
+            except Exception as e:
+                logging.error(f"Reading component sockets gave error {e}")
+        return rows
+
+    def close(self):
+        self.reader.close()
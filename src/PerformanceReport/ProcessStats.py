@@ -0,0 +1,283 @@
+import logging
+import os
+import socket
+import sys
+import time
+
+import psutil
+from psutil import AccessDenied, NoSuchProcess
+
+
+# Raised when a tracked process is gone, including when its PID now belongs to another process
+class ProcessGone(Exception):
+    pass
+
+
+# Reads system and per process CPU and memory usage through psutil. Process handles are kept across samples, so
+# cpu_percent has a previous sample to compare against and nothing is looked up again. All reads of one process
+# happen inside oneshot(), which lets psutil share the underlying /proc (or platform) reads between them.
+class ProcessStatsReader:
+    def __init__(self):
+        self._handles = dict()  # pid -> psutil.Process
+
+    # (system wide cpu percent, used memory in bytes)
+    def read_system(self):
+        return psutil.cpu_percent(interval=None, percpu=False), psutil.virtual_memory().used
+
+    # (cpu percent, rss in bytes) of a process. The first sample of a process reports 0.0 cpu, as psutil does.
+    # process is a handle to reuse, e.g. the Popen of a component we started.
+    def read(self, pid, process: psutil.Process = None):
+        handle = self._handles.get(pid)
+        try:
+            if handle is None:
+                handle = self._handles[pid] = process or psutil.Process(pid)
+            # is_running compares the start time of whatever now has the PID with the one of our process, so a PID
+            # reused after our process exited counts as gone
+            elif not handle.is_running():
+                raise NoSuchProcess(pid)
+            with handle.oneshot():
+                return handle.cpu_percent(interval=None), handle.memory_info().rss
+        except NoSuchProcess:
+            self.forget(pid)
+            raise ProcessGone(pid)
+
+    # Names of the network interfaces and their counters, in the order of psutil.net_io_counters: bytes sent and
+    # received, packets sent and received, errors in and out, drops in and out
+    def read_interfaces(self):
+        counters = psutil.net_io_counters(pernic=True)
+        names = sorted(counters)
+        return names, [tuple(counters[name]) for name in names]
+
+    # PID -> (established TCP connections, UDP sockets, set of remote hosts) for the processes we may inspect
+    def read_sockets(self, pids) -> dict:
+        sockets = dict()
+        for pid in pids:
+            try:
+                process = self._handles.get(pid) or psutil.Process(pid)
+                # Renamed in psutil 6
+                connections = process.net_connections(kind='inet') if hasattr(process, 'net_connections') \
+                    else process.connections(kind='inet')
+            except (NoSuchProcess, AccessDenied):
+                continue
+            tcp = sum(1 for c in connections if c.type == socket.SOCK_STREAM and c.status == psutil.CONN_ESTABLISHED)
+            udp = sum(1 for c in connections if c.type == socket.SOCK_DGRAM)
+            sockets[pid] = (tcp, udp, {c.raddr.ip for c in connections if c.raddr})
+        return sockets
+
+    # Parent PID -> PIDs of its children, over all processes
+    def children_map(self) -> dict:
+        children = dict()
+        for process in psutil.process_iter(['ppid']):
+            children.setdefault(process.info['ppid'], []).append(process.pid)
+        return children
+
+    # Drop the cached handle of a process
+    def forget(self, pid):
+        self._handles.pop(pid, None)
+
+    # Drop the handles of processes that are no longer sampled
+    def retain(self, pids: set):
+        for pid in [pid for pid in self._handles if pid not in pids]:
+            self.forget(pid)
+
+    def close(self):
+        for pid in list(self._handles):
+            self.forget(pid)
+
+
+# Linux fast path reading /proc directly, no psutil objects per sample. The stat and statm files of every process
+# are kept open and re-read with pread, an open /proc/<pid> file keeps referring to the process it was opened for,
+# so a reused PID shows up as a read error instead of someone else's numbers.
+class ProcfsStatsReader(ProcessStatsReader):
+    _clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+    _page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    @staticmethod
+    def is_supported() -> bool:
+        return sys.platform.startswith('linux') and os.path.exists('/proc/self/statm')
+
+    def __init__(self):
+        super().__init__()
+        self._stat_fd = os.open('/proc/stat', os.O_RDONLY)
+        self._meminfo_fd = os.open('/proc/meminfo', os.O_RDONLY)
+        self._net_dev_fd = os.open('/proc/net/dev', os.O_RDONLY)
+        self._last_system = None  # (busy ticks, total ticks)
+
+    @staticmethod
+    def _pread(fd, size=4096) -> bytes:
+        return os.pread(fd, size, 0)
+
+    # Same definitions as psutil.cpu_percent and psutil.virtual_memory().used
+    def read_system(self):
+        fields = [int(field) for field in self._pread(self._stat_fd, 256).split(b'\n', 1)[0].split()[1:]]
+        # guest time is already part of user time
+        total = sum(fields[:8])
+        busy = total - fields[3] - fields[4]  # idle and iowait
+        last, self._last_system = self._last_system, (busy, total)
+        cpu = 0.0
+        if last is not None and total > last[1]:
+            cpu = round(max(busy - last[0], 0) / (total - last[1]) * 100, 1)
+        return cpu, self._read_used_memory()
+
+    # Total minus available memory, as psutil. Kernels before 3.14 don't report MemAvailable, psutil estimates it
+    # there, we take free memory and the page cache.
+    def _read_used_memory(self):
+        meminfo = dict()
+        for line in self._pread(self._meminfo_fd, 8192).split(b'\n'):
+            key, _, value = line.partition(b':')
+            if key in (b'MemTotal', b'MemFree', b'MemAvailable', b'Buffers', b'Cached'):
+                meminfo[key] = int(value.split()[0]) * 1024
+        total = meminfo[b'MemTotal']
+        available = meminfo.get(b'MemAvailable')
+        if available is None:
+            available = meminfo[b'MemFree'] + meminfo[b'Buffers'] + meminfo[b'Cached']
+        if available > total:
+            available = meminfo[b'MemFree']
+        return total - max(available, 0)
+
+    # Whether used memory and our own RSS read the same as through psutil, up to what changes between two reads
+    def agrees_with_psutil(self, tolerance=1 << 24) -> bool:
+        if abs(self._read_used_memory() - psutil.virtual_memory().used) > tolerance:
+            return False
+        pid = os.getpid()
+        _, rss = self.read(pid)
+        self.forget(pid)
+        return abs(rss - psutil.Process(pid).memory_info().rss) <= tolerance
+
+    def read(self, pid, process: psutil.Process = None):
+        handle = self._handles.get(pid)
+        try:
+            if handle is None:
+                handle = self._handles[pid] = [os.open(f'/proc/{pid}/stat', os.O_RDONLY), None, None]
+                handle[1] = os.open(f'/proc/{pid}/statm', os.O_RDONLY)
+            stat_fd, statm_fd, last = handle
+            stat = self._pread(stat_fd)
+            statm = self._pread(statm_fd, 256)
+        except OSError:
+            self.forget(pid)
+            raise ProcessGone(pid)
+        # The command name may contain spaces and parentheses, the fields after it don't
+        fields = stat[stat.rindex(b')') + 2:].split() if stat else None
+        # Exited but not yet reaped counts as gone, as for psutil
+        if not fields or fields[0] == b'Z':
+            self.forget(pid)
+            raise ProcessGone(pid)
+        now = time.monotonic()
+        cpu_time = (int(fields[11]) + int(fields[12])) / self._clock_ticks  # utime + stime
+        handle[2] = (cpu_time, now)
+        cpu = 0.0
+        if last is not None and now > last[1]:
+            cpu = round((cpu_time - last[0]) / (now - last[1]) * 100, 1)
+        rss = int(statm.split()[1]) * self._page_size
+        return cpu, rss
+
+    def read_interfaces(self):
+        names, counters = [], []
+        # Two header lines, then "name: rx bytes packets errs drop fifo frame compressed multicast tx bytes ..."
+        for line in self._pread(self._net_dev_fd, 65536).split(b'\n')[2:]:
+            name, _, values = line.partition(b':')
+            if not values:
+                continue
+            fields = [int(field) for field in values.split()]
+            names.append(name.strip().decode())
+            counters.append((fields[8], fields[0], fields[9], fields[1], fields[2], fields[10], fields[3], fields[11]))
+        order = sorted(range(len(names)), key=names.__getitem__)
+        return [names[i] for i in order], [counters[i] for i in order]
+
+    # Sockets are matched to processes through the socket inodes among their open files
+    def read_sockets(self, pids) -> dict:
+        inodes = dict()  # inode -> (is tcp, established, remote address)
+        for table in ('tcp', 'tcp6', 'udp', 'udp6'):
+            try:
+                with open(f'/proc/net/{table}', 'rb') as file:
+                    lines = file.read().split(b'\n')[1:]
+            except OSError:
+                continue
+            for line in lines:
+                fields = line.split()
+                if len(fields) < 10:
+                    continue
+                # remote address is hex ip:port, all zeroes when not connected
+                remote = fields[2].partition(b':')[0]
+                inodes[fields[9]] = (table.startswith('tcp'), fields[3] == b'01', remote.strip(b'0') and remote)
+        sockets = dict()
+        for pid in pids:
+            tcp, udp, remotes = 0, 0, set()
+            try:
+                fds = os.listdir(f'/proc/{pid}/fd')
+            except OSError:
+                continue
+            for fd in fds:
+                try:
+                    target = os.readlink(f'/proc/{pid}/fd/{fd}')
+                except OSError:
+                    continue
+                if not target.startswith('socket:['):
+                    continue
+                entry = inodes.get(target[8:-1].encode())
+                if entry is None:
+                    continue
+                is_tcp, established, remote = entry
+                if is_tcp:
+                    tcp += established
+                else:
+                    udp += 1
+                if remote:
+                    remotes.add(remote)
+            sockets[pid] = (tcp, udp, remotes)
+        return sockets
+
+    def children_map(self) -> dict:
+        children = dict()
+        for entry in os.scandir('/proc'):
+            if not entry.name.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry.name}/stat', 'rb') as file:
+                    stat = file.read()
+            except OSError:
+                continue
+            ppid = int(stat[stat.rindex(b')') + 2:].split(maxsplit=2)[1])
+            children.setdefault(ppid, []).append(int(entry.name))
+        return children
+
+    def forget(self, pid):
+        handle = self._handles.pop(pid, None)
+        if handle is not None:
+            for fd in handle[:2]:
+                if fd is not None:
+                    os.close(fd)
+
+    def close(self):
+        super().close()
+        os.close(self._stat_fd)
+        os.close(self._meminfo_fd)
+        os.close(self._net_dev_fd)
+
+
+# PIDs of all descendants of pid in a children_map, without descending into the processes in exclude
+def get_descendants(children_map: dict, pid, exclude=()) -> set:
+    descendants = set()
+    stack = [pid]
+    while stack:
+        for child in children_map.get(stack.pop(), ()):
+            if child not in exclude and child not in descendants:
+                descendants.add(child)
+                stack.append(child)
+    return descendants
+
+
+# Reader for this platform, the /proc fast path if allowed and available
+def get_process_stats_reader(use_procfs=True) -> ProcessStatsReader:
+    if use_procfs and ProcfsStatsReader.is_supported():
+        try:
+            reader = ProcfsStatsReader()
+        except OSError as error:
+            logging.warning(f"Reading /proc failed with {error}, falling back to psutil")
+        else:
+            # The fast path must not change what the metrics mean
+            if reader.agrees_with_psutil():
+                return reader
+            logging.warning(f"Reading /proc disagrees with psutil, falling back to psutil")
+            reader.close()
+    return ProcessStatsReader()
@@ -0,0 +1,124 @@
+import math
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Preallocated ring of the last capacity samples of one key (a component or an interface)
+class SampleRing:
+    def __init__(self, capacity, num_fields):
+        self.capacity = capacity
+        self.timestamps = numpy.zeros(capacity)
+        self.lags = numpy.zeros(capacity)
+        self.values = numpy.zeros((capacity, num_fields))
+        self.count = 0  # samples written over the whole run
+
+    def append(self, timestamp, lag, values):
+        i = self.count % self.capacity
+        self.timestamps[i] = timestamp
+        self.lags[i] = lag
+        self.values[i] = values
+        self.count += 1
+
+    # Copies of the retained samples with start <= timestamp < end, oldest first
+    def window(self, start, end):
+        size = min(self.count, self.capacity)
+        order = (numpy.arange(size) + (self.count - size)) % self.capacity
+        timestamps = self.timestamps[order]
+        mask = (timestamps >= start) & (timestamps < end)
+        return timestamps[mask], self.lags[order][mask], self.values[order][mask]
+
+
+# High rate mode storage of a metric collector. Samples go into one SampleRing per key, so memory stays the same
+# however long the run is, and only per second aggregates leave it: a row with the means in the metric's own table
+# and the mean, min, max and 95th percentile of every field in high_rate_metrics. The raw samples of the last
+# window seconds can be dumped to a file. Rows without a key (or child process rows) are not sampled at a high
+# rate and are passed through as is.
+class HighRateStore:
+    percentile = 95
+
+    def __init__(self, metric_name, key_field, fields: tuple, capacity):
+        self.metric_name = metric_name
+        self.key_field = key_field
+        self.fields = fields
+        self.capacity = capacity
+        self.rings = dict()  # key -> SampleRing
+        # key -> the latest row, the columns that are not aggregated are taken from it
+        self._templates = dict()
+        self._lock = threading.Lock()
+        self._latest = None
+        # Seconds before this one have been aggregated
+        self._aggregated_until = None
+
+    @staticmethod
+    def is_supported() -> bool:
+        return numpy is not None
+
+    # Keep the rows of one sample, returns the ones that are not kept
+    def add(self, rows: list[dict]) -> list[dict]:
+        rest = []
+        with self._lock:
+            for row in rows:
+                key = row.get(self.key_field)
+                if key is None or row.get('child'):
+                    rest.append(row)
+                    continue
+                ring = self.rings.get(key)
+                if ring is None:
+                    ring = self.rings[key] = SampleRing(self.capacity, len(self.fields))
+                ring.append(row['timestamp'], row['lag'], [row[field] for field in self.fields])
+                self._templates[key] = row
+                if self._aggregated_until is None:
+                    self._aggregated_until = math.floor(row['timestamp'])
+                self._latest = row['timestamp'] if self._latest is None else max(self._latest, row['timestamp'])
+        return rest
+
+    # Aggregates of every second that completed since the last call: (mean rows like the metric's own rows,
+    # high_rate_metrics rows). A second is stamped with its end. Once sampling stopped, final includes the last,
+    # incomplete second.
+    def aggregate(self, final=False):
+        with self._lock:
+            if self._latest is None:
+                return [], []
+            start, end = self._aggregated_until, math.floor(self._latest) + (1 if final else 0)
+            if end <= start:
+                return [], []
+            self._aggregated_until = end
+            windows = {key: ring.window(start, end) for key, ring in self.rings.items()}
+            templates = dict(self._templates)
+        mean_rows, summary_rows = [], []
+        for key, (timestamps, lags, values) in windows.items():
+            seconds = numpy.floor(timestamps)
+            for second in numpy.unique(seconds):
+                mask = seconds == second
+                samples = values[mask]
+                means = samples.mean(axis=0)
+                minimums = samples.min(axis=0)
+                maximums = samples.max(axis=0)
+                percentiles = numpy.percentile(samples, self.percentile, axis=0)
+                timestamp = float(second) + 1
+                row = dict(templates[key], timestamp=timestamp, lag=float(lags[mask].max()))
+                row.update(zip(self.fields, means.tolist()))
+                mean_rows.append(row)
+                for i, field in enumerate(self.fields):
+                    summary_rows.append((timestamp, self.metric_name, str(key), field, int(mask.sum()),
+                                         float(means[i]), float(minimums[i]), float(maximums[i]),
+                                         float(percentiles[i])))
+        # Rows of all keys in time order, as the metric writes them
+        mean_rows.sort(key=lambda row: row['timestamp'])
+        return mean_rows, summary_rows
+
+    # Write the raw samples with start <= timestamp < end to an .npz file, returns the number of samples
+    def dump(self, start, end, path) -> int:
+        with self._lock:
+            windows = {key: ring.window(start, end) for key, ring in self.rings.items()}
+        arrays = dict(fields=numpy.array(self.fields))
+        for key, (timestamps, lags, values) in windows.items():
+            arrays[f"{key}_timestamp"] = timestamps
+            arrays[f"{key}_lag"] = lags
+            arrays[f"{key}_values"] = values
+        numpy.savez_compressed(path, **arrays)
+        return sum(len(timestamps) for timestamps, _, _ in windows.values())
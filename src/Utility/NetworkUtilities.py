@@ -1,10 +1,17 @@
-import io
 import json
+import random
 import socket
 import logging
+import time
 import uuid
 from os.path import exists
 
+# Optional faster JSON backend
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def get_my_ip():
     hostname = socket.getfqdn()
@@ -12,23 +19,40 @@ def get_my_ip():
     return ip[2][-1]
 
 
-def wait_for_connection(ip, port, num_retries, timeout):
-    if num_retries == 0:
-        logging.error(f"Could not connect to {ip}:{port}")
-        return None
+# Seconds to wait before retry number attempt (from 0). Exponential with full jitter, so clients that lost the server
+# at the same time do not all retry in lockstep.
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
 
-    try:
+# Connect to ip:port, retrying with backoff. With num_retries None it keeps trying until termination_event is set.
+def wait_for_connection(ip, port, num_retries, timeout, termination_event=None):
+    attempt = 0
+    while num_retries is None or attempt < num_retries:
+        if attempt:
+            delay = backoff_delay(attempt - 1)
+            if termination_event is not None:
+                if termination_event.wait(delay):
+                    return None
+            else:
+                time.sleep(delay)
+        attempt += 1
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setblocking(False)
-        sock.settimeout(timeout)
-        sock.connect((ip, port))
-        return sock
-    except TimeoutError:
-        logging.debug(f"timed out connecting to {ip}:{port}, retrying...")
-    except ConnectionRefusedError:
-        logging.debug(f"connection refused to {ip}:{port}, retrying...")
+        try:
+            sock.settimeout(timeout)
+            sock.connect((ip, port))
+            return sock
+        except TimeoutError:
+            logging.debug(f"timed out connecting to {ip}:{port}, retrying...")
+        except ConnectionRefusedError:
+            logging.debug(f"connection refused to {ip}:{port}, retrying...")
+        except OSError as e:
+            # e.g. network unreachable while an interface is down
+            logging.debug(f"could not connect to {ip}:{port} ({e!r}), retrying...")
+        sock.close()
 
-    return wait_for_connection(ip, port, num_retries-1, timeout)
+    logging.error(f"Could not connect to {ip}:{port}")
+    return None
 
 
 def cached_or_new_uuid(use_cached=False, cache_file="./cached_uuid.txt"):
@@ -45,13 +69,13 @@ def cached_or_new_uuid(use_cached=False, cache_file="./cached_uuid.txt"):
 
 
 def json_encode(obj, encoding):
-    return json.dumps(obj, ensure_ascii=False).encode(encoding)
+    if orjson is not None and encoding == "utf-8":
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode(encoding)
 
 
+# Decodes from any bytes-like object, including memoryview slices of a receive buffer
 def json_decode(json_bytes, encoding):
-    tiow = io.TextIOWrapper(
-        io.BytesIO(json_bytes), encoding=encoding, newline=""
-    )
-    obj = json.load(tiow)
-    tiow.close()
-    return obj
+    if orjson is not None and encoding == "utf-8":
+        return orjson.loads(json_bytes)
+    return json.loads(str(json_bytes, encoding))
@@ -1,4 +1,5 @@
 # import src.PerformanceReport.PerformanceReport
+import asyncio
 import os
 import selectors
 import threading
@@ -6,29 +7,43 @@ import time
 from queue import Queue
 
 from src.Experiment.ExperimentList import get_experiment_by_name
+from src.NetProtocol.AsyncConnectionHandler import AsyncConnectionMonitor
 from src.NetProtocol.ConnectionHandler import ConnectionHandler, ConnectionMonitor
 from src.NetProtocol.Message import Message
 from src.NetProtocol.MessageHandler import MessageHandler
+from src.NetProtocol.Ping import LatencyMonitor
+from src.NetProtocol.SendQueue import SendQueue
 from src.NetProtocol.Request import Request, RequestType
+from src.NetworkGraph.MetricStore import NodeMetricStore
 from src.NetworkGraph.NetworkGraph import NetworkGraph, NetworkNodeType
 from src.app.Component import Component, ComponentHandler
+from src.app.DatabaseSchema import migrate
+from src.app.DatabaseWriter import DatabaseWriter
+from src.app.JobExecutor import JobExecutor
 from src.PerformanceReport.HardwareMetrics import HardwareMetrics
+from src.PerformanceReport.NetworkMetrics import NetworkMetrics
 from src.PerformanceReport.Metrics import MetricCollector, MetricCollectionMode
 from src.Utility.MetricUtilities import get_static_hardware_stats, dict_factory
 from src.Utility.NetworkUtilities import *
 import sqlite3
 import logging
 from datetime import datetime
-from os.path import exists
-import shutil
 
 
 # Entry point for resource monitoring
 class Application:
     db = None
-    _database_template = None
+    db_writer = None
     component_handler = None
     connection_monitor = None
+    message_handler = None
+    job_executor = None
+    # Most often a client stores what its metric samplers collected, in seconds
+    metric_flush_interval = 0.1
+    # Seconds the server waits for its clients to hang up after telling them the run is over
+    exit_timeout = 2.0
+    # Set once the server is shutting down, clients reconnecting from then on are told to exit
+    finished = False
     component_metric_handlers: [MetricCollector] = []
     # By default, database
     _default_metric_collection_mode = MetricCollectionMode.TO_DB
@@ -45,10 +60,12 @@ class Application:
             self.halt()
 
         self.termination_event = threading.Event()
-        self._database_template = config[self.p_name]['database_template']
         self._persist_db = config[self.p_name].getboolean('persist_db')
-        # database
-        self.db_write_cur = None
+        # database, written through db_writer and read through db
+        self._journal_mode = config['DEFAULT'].get('db_journal_mode', 'wal')
+        self._db_writer_settings = (config['DEFAULT'].get('db_synchronous', 'normal'),
+                                    config['DEFAULT'].getint('db_commit_rows', 1000),
+                                    config['DEFAULT'].getfloat('db_commit_interval', 0.5))
         date = datetime.now()
         self._db_file = f"./{date.year}{date.month}{date.day}_" \
                         f"{date.hour}{date.minute}{date.second}_{self.p_name}_metrics.db"
@@ -59,8 +76,17 @@ class Application:
         self.hardware_stats = get_static_hardware_stats()
         self.server_ip = config["ResourceClient"]['server_ip']
         self.port = int(config['DEFAULT']['port'])
-        self.sampling_frequency = int(config[self.p_name]['sampling_frequency'])
+        self.sampling_frequency = config[self.p_name].getfloat('sampling_frequency')
         self.experiment.sampling_frequency = self.sampling_frequency
+        # Experiments keep running while a peer is disconnected for up to this many seconds
+        self.experiment.reconnect_grace = config[self.p_name].getfloat('reconnect_grace', 0)
+        # Clients reconnect to the server after losing the connection and resume their session
+        self.reconnect = config[self.p_name].getboolean('reconnect', False)
+        # Stop reconnecting after the server was unreachable for this many seconds, 0 keeps trying
+        self.reconnect_timeout = config[self.p_name].getfloat('reconnect_timeout', 0)
+        self._reconnecting = False
+        self._resume_future = None
+        self._last_connected_elapsed = 0  # Samples after this were possibly never retrieved by the server
 
         # uuid
         self.uuid = cached_or_new_uuid(config[self.p_name].getboolean('use_cached_uuid'),
@@ -69,15 +95,64 @@ class Application:
         # networking
         #ip = get_my_ip()
         self.ip = "127.0.0.1"
-        self.sel = selectors.DefaultSelector()
-        self.receive_queue: "Queue[Message]" = Queue()
         # Setup network representation class
         self.net_graph = NetworkGraph(self.p_name, (self.ip, self.port),
                                       NetworkNodeType.CLIENT, self.uuid, self.hardware_stats)
 
-        # Start message monitoring/handling threads
-        self.connection_monitor = ConnectionMonitor(self.termination_event, self.sel, self.receive_queue)
-        self.message_handler = MessageHandler(self.receive_queue, self.termination_event, owner=self)
+        # Wire formats we accept in order of preference, JSON is always supported as the fallback
+        self.wire_formats = [config['DEFAULT'].get('wire_format', 'json'), 'json']
+        # Payload compression we offer and accept, payloads below the threshold (bytes) are never compressed
+        compression = config['DEFAULT'].get('compression', 'none')
+        self.compression = [] if compression == 'none' else [compression]
+        self.compression_level = config['DEFAULT'].getint('compression_level', 6)
+        self.compression_threshold = config['DEFAULT'].getint('compression_threshold', 1024)
+        # Limits of every connection's send queue and what to do with metrics once they are reached
+        SendQueue.configure(config['DEFAULT'].getint('send_queue_max_bytes', SendQueue.max_bytes),
+                            config['DEFAULT'].getint('send_queue_max_messages', SendQueue.max_messages),
+                            config['DEFAULT'].get('send_queue_policy', SendQueue.policy),
+                            config['DEFAULT'].getfloat('send_queue_block_timeout', SendQueue.block_timeout))
+        # Sample process stats straight from /proc on Linux
+        HardwareMetrics.use_procfs = config['DEFAULT'].getboolean('procfs_fast_path', True)
+        NetworkMetrics.use_procfs = HardwareMetrics.use_procfs
+        self.collect_network_metrics = config['DEFAULT'].getboolean('network_metrics', True)
+        # Metrics the server subscribes every client to after the handshake, pushed every stream_interval seconds
+        self.stream_metrics = [metric.strip() for metric in config[self.p_name].get('stream_metrics', '').split(',')
+                               if metric.strip()]
+        self.stream_interval = config[self.p_name].getfloat('stream_interval', 1.0)
+        # Samples kept in memory per component and metric of every peer
+        NodeMetricStore.capacity = config[self.p_name].getint('metric_store_capacity', NodeMetricStore.capacity)
+        # High rate mode keeps raw samples in memory and only stores per second aggregates
+        if config[self.p_name].getboolean('high_rate_mode', False):
+            self._default_metric_collection_mode += MetricCollectionMode.HIGH_RATE
+            MetricCollector.high_rate_window = config[self.p_name].getfloat('high_rate_window',
+                                                                            MetricCollector.high_rate_window)
+        # Rollup tiers as resolution:retention pairs in seconds, and how long stored rows are kept
+        rollup_tiers = config[self.p_name].get('rollup_tiers', '')
+        MetricCollector.rollup_tiers = tuple(tuple(float(value) for value in tier.split(':'))
+                                             for tier in rollup_tiers.split(',') if tier.strip())
+        MetricCollector.raw_retention = config[self.p_name].getfloat('raw_retention', MetricCollector.raw_retention)
+        # Component metrics include the processes they started, optionally stored per process as well
+        HardwareMetrics.process_tree_interval = config['DEFAULT'].getfloat('process_tree_interval',
+                                                                           HardwareMetrics.process_tree_interval)
+        HardwareMetrics.store_child_metrics = config['DEFAULT'].getboolean('store_child_metrics', False)
+        # 'selector' runs sockets on a monitor thread, 'asyncio' runs sockets and message handling on one event loop
+        self.transport = config['DEFAULT'].get('transport', 'selector')
+        if self.transport == 'asyncio':
+            self.loop = asyncio.new_event_loop()
+            self.receive_queue: "asyncio.Queue[Message]" = asyncio.Queue()
+            self.connection_monitor = AsyncConnectionMonitor(self.termination_event, self.loop, self.receive_queue)
+        else:
+            self.loop = None
+            self.sel = selectors.DefaultSelector()
+            self.receive_queue: "Queue[Message]" = Queue()
+            # Start message monitoring/handling threads
+            self.connection_monitor = ConnectionMonitor(self.termination_event, self.sel, self.receive_queue)
+        self.connection_monitor.stop_when_idle = not self.reconnect
+        self.message_handler = MessageHandler(self.receive_queue, self.termination_event, owner=self, loop=self.loop)
+        # Component actions run on this many worker threads, so slow ones don't hold up message handling
+        self.job_executor = JobExecutor(config['DEFAULT'].getint('component_workers', 4))
+        # Measures the round trip time to every connected peer
+        self.latency_monitor = LatencyMonitor(self, config['DEFAULT'].getfloat('ping_interval', 1.0))
 
         # Fill in initial components (which is this application)
         self.component_handler = ComponentHandler(self, config['DEFAULT']['components_file'])
@@ -87,21 +162,18 @@ class Application:
         logging.debug(f"Setup complete")
 
     def _initialize_sqlite_db(self):
-        if not exists(self._database_template):
-            logging.error("Database template not found! Is the resources folder where it should be?")
-            return False
-
-        # Copy the template to working directory
-        shutil.copyfile(self._database_template, self._db_file)
-
         try:
             self.db = sqlite3.connect(self._db_file)
             self.db.row_factory = dict_factory
-            self.db_write_cur = self.db.cursor()
-        except sqlite3.Error:
-            logging.error("Database connection failed.")
+            self.db.execute(f"PRAGMA journal_mode={self._journal_mode}")
+            migrate(self.db)
+        except sqlite3.Error as error:
+            logging.error(f"Database setup failed with {error}")
             return False
 
+        # From here on everything is written on the writer's thread
+        self.db_writer = DatabaseWriter(self._db_file, *self._db_writer_settings)
+        self.db_writer.start()
         return True
 
     def start(self):
@@ -114,15 +186,18 @@ class Application:
         # https://realpython.com/python-sockets/#multi-connection-server
         addr = ('', self.port)  # all interfaces with specified port
         logging.info(f"Binding to {addr[0]}:{addr[1]}")
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Avoid bind() exception: OSError: [Errno 48] Address already in use
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind(addr)
-        s.listen()
-        s.setblocking(False)
-        self.sel.register(s, selectors.EVENT_READ | selectors.EVENT_WRITE, data=None)
-        # Main connection thread, reads recv of each connection into a message queue
-        self.connection_monitor.start()
+        if self.loop is not None:
+            self.connection_monitor.start_server(addr)
+        else:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Avoid bind() exception: OSError: [Errno 48] Address already in use
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(addr)
+            s.listen()
+            s.setblocking(False)
+            self.sel.register(s, selectors.EVENT_READ, data=None)
+            # Main connection thread, reads recv of each connection into a message queue
+            self.connection_monitor.start()
         if not self.experiment.setup(self.net_graph, self.message_handler, self.termination_event):
             logging.error(f"Experiment setup failed, aborting.")
             self.halt()
@@ -135,41 +210,37 @@ class Application:
     def _start_client(self):
         logging.info(f"Connecting to {self.server_ip}:{self.port}")
         # wait to establish a server connection
-        server_connection = wait_for_connection(self.server_ip, self.port, num_retries=3, timeout=5.0)
-        if server_connection is None:
-            logging.error("Could not establish connection to server. Exiting.")
-            return
-        logging.info(f"Connected")
+        if self.loop is not None:
+            conn_handler = self.connection_monitor.connect(self.server_ip, self.port, num_retries=3, timeout=5.0)
+            if conn_handler is None:
+                logging.error("Could not establish connection to server. Exiting.")
+                return
+            logging.info(f"Connected")
+        else:
+            server_connection = wait_for_connection(self.server_ip, self.port, num_retries=3, timeout=5.0)
+            if server_connection is None:
+                logging.error("Could not establish connection to server. Exiting.")
+                return
+            logging.info(f"Connected")
 
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        conn_handler = ConnectionHandler(self.sel, server_connection,
-                                         (self.server_ip, self.port), 0, self.receive_queue)
-        self.sel.register(server_connection, events, data=conn_handler)
+            conn_handler = ConnectionHandler(self.sel, server_connection,
+                                             (self.server_ip, self.port), 0, self.receive_queue)
+            self.connection_monitor.register(server_connection, conn_handler)
 
-        # Start the connection monitor to setup/select messages from sockets
-        self.connection_monitor.start()
+            # Start the connection monitor to setup/select messages from sockets
+            self.connection_monitor.start()
 
-        handshake_dict = dict(uuid=str(self.uuid),
-                              hw_stats=self.hardware_stats.copy(),
-                              response=False)
-
-        logging.info(f"Performing handshake with own uuid: {str(self.uuid)}")
-        message = Message(content=Request(RequestType.HANDSHAKE, handshake_dict))
-        future = conn_handler.send_message_and_wait_response(message)
-        start_t = time.time()
-        while True:
-            self.message_handler.read_messages()
-            if future.is_set():
-                break
-            if time.time() - start_t > 10:
-                logging.error(f"Timeout on handshake, aborting.")
-                self.halt()
-                return
+        # The server may subscribe to metrics right after the handshake, so the collectors have to exist by then
+        self._initialize_metric_handlers()
+        future = self._send_handshake(conn_handler)
+        if not self.message_handler.wait_for_responses([future], 10):
+            logging.error(f"Timeout on handshake, aborting.")
+            self.halt()
+            return
         # After handshake established, make sure new node is marked as server
         self.net_graph.set_server(conn_handler.peer.uuid)
 
         # run metric collection
-        self._initialize_metric_handlers()
         self._exec_loop()
 
         # Send exit once finished
@@ -177,24 +248,104 @@ class Application:
         conn_handler.send_message(message)  # don't wait for a response
         self.halt()
 
+    # Our UUID identifies us, so after a reconnect the server resumes our session
+    def _send_handshake(self, conn_handler: ConnectionHandler, timeout=None):
+        handshake_dict = dict(uuid=str(self.uuid),
+                              hw_stats=self.hardware_stats.copy(),
+                              codecs=self.wire_formats,
+                              compression=self.compression,
+                              response=False)
+
+        logging.info(f"Performing handshake with own uuid: {str(self.uuid)}")
+        message = Message(content=Request(RequestType.HANDSHAKE, handshake_dict))
+        return conn_handler.send_message_and_wait_response(message, timeout=timeout)
+
+    # Reconnect once the server connection drops, and replay what was sampled in the meantime once the session is
+    # resumed. Never blocks, sampling continues while disconnected.
+    def _check_server_connection(self):
+        server = self.net_graph.get_server()
+        if server.exited or self.termination_event.is_set():
+            # The server ended the session
+            return
+        if server.is_active and self._resume_future is None:
+            self._last_connected_elapsed = self.elapsed_time
+            return
+        if self.reconnect_timeout and not server.is_active \
+                and time.monotonic() - server.inactive_since > self.reconnect_timeout:
+            logging.error(f"Server unreachable for {self.reconnect_timeout}s, giving up.")
+            self.termination_event.set()
+            return
+        if self._resume_future is not None:
+            if self._resume_future.is_set():
+                self._resume_future = None
+                self._replay_metrics(server.conn_handler, self._last_connected_elapsed)
+                return
+            if not self._resume_future.done() and not self._resume_future.expired():
+                # Handshake in flight
+                return
+            logging.warning(f"Handshake after reconnecting failed, retrying.")
+            self._resume_future.cancel()
+            self._resume_future = None
+        if not self._reconnecting:
+            logging.warning(f"Lost connection to the server, reconnecting...")
+            self._reconnecting = True
+            self.connection_monitor.reconnect(self.server_ip, self.port, 5.0, self._on_reconnected)
+
+    # Called by the connection monitor, possibly from another thread
+    def _on_reconnected(self, conn_handler: ConnectionHandler):
+        self._resume_future = self._send_handshake(conn_handler, timeout=10)
+        self._reconnecting = False
+
+    # Send the server everything sampled since time_start in bulk, in batches that fit the send queue
+    def _replay_metrics(self, conn_handler: ConnectionHandler, time_start, batch_size=1000):
+        # The latest samples may still be queued for writing
+        if not self.db_writer.flush(timeout=5.0):
+            logging.warning(f"Database writer is behind, the replay may miss the latest samples")
+        cur = self.db.cursor()
+        res = cur.execute("SELECT timestamp, cpu, memory, pid, process_name FROM hardware_metrics INNER JOIN"
+                          " components ON components.pid = hardware_metrics.component WHERE timestamp > ?",
+                          (time_start,))
+        rows = res.fetchall()
+        logging.info(f"Session resumed, replaying {len(rows)} metrics sampled while disconnected")
+        for i in range(0, len(rows), batch_size):
+            metric_dict = dict(metrics=rows[i:i + batch_size], period=self.elapsed_time - time_start, replay=True)
+            conn_handler.send_message(Message(content=Request(RequestType.METRIC, metric_dict)))
+
     def _initialize_metric_handlers(self):
         self.component_metric_handlers.append(
-            MetricCollector(HardwareMetrics, self.component_handler.components, self._default_metric_collection_mode, self.db_write_cur))
+            MetricCollector(HardwareMetrics, self.component_handler.components, self._default_metric_collection_mode, self.db_writer))
+        if self.collect_network_metrics:
+            self.component_metric_handlers.append(
+                MetricCollector(NetworkMetrics, self.component_handler.components, self._default_metric_collection_mode, self.db_writer))
 
-    # Clock that runs the local metric sampling of all components
+    # Collector writing the given metric table, None if there is none
+    def get_metric_collector(self, table) -> MetricCollector:
+        for metric_handler in self.component_metric_handlers:
+            if metric_handler.metric_type.db_table == table:
+                return metric_handler
+        return None
+
+    # Main loop, steps the experiment on the server and stores the samples of the metric samplers on a client
     def _exec_loop(self):
         sample_period = 1 / self.sampling_frequency
-        start_t = time.time()
+        # Samplers run on their own threads at the sampling rate, collected rows are stored at most this often
+        step_period = sample_period if self.is_server else max(sample_period, self.metric_flush_interval)
+        start_t = time.monotonic()
         last_t = start_t
+        if not self.is_server:
+            for metric_handler in self.component_metric_handlers:
+                metric_handler.start(sample_period, start_t, self.termination_event)
         try:
             while not self.termination_event.is_set():
-                # check messages
-                self.message_handler.read_messages()
+                # check messages until the next step or ping is due
+                self.message_handler.dispatch_for(min(step_period - (time.monotonic() - last_t),
+                                                      self.latency_monitor.time_until_next()))
+                self.latency_monitor.tick()
                 # check elapsed time
-                t = time.time()
-                if (t - last_t) > sample_period:
+                t = time.monotonic()
+                self.elapsed_time = t - start_t
+                if (t - last_t) > step_period:
                     last_t = t
-                    self.elapsed_time = (t - start_t)
 
                     if self.is_server:
                         if (t - start_t) > self.experiment.duration:
@@ -203,28 +354,50 @@ class Application:
                             break
                     else:
                         self._iter_client()
+                        if self.reconnect:
+                            self._check_server_connection()
         except KeyboardInterrupt:
             logging.debug("Caught keyboard interrupt, exiting")
 
+    # Tell every connected client the run is over, so it exits instead of reconnecting. Waits until they hung up,
+    # which also gets the EXIT frames written before the connections are torn down.
+    def _exit_clients(self):
+        self.finished = True
+        clients = [node for node in self.net_graph.get_all_connected_nodes_self() if node is not None]
+        for node in clients:
+            node.conn_handler.send_message(Message(content=Request(RequestType.EXIT)))  # don't wait for a response
+        if not self.message_handler.dispatch_until(lambda: not any(node.is_active for node in clients),
+                                                   self.exit_timeout):
+            logging.warning(f"Clients still connected {self.exit_timeout}s after being told to exit.")
+
     def _iter_client(self):
-        # Start all collectors
-        for metric_handler in self.component_metric_handlers:
-            metric_handler.collect(elapsed_time=self.elapsed_time)
-        # Process collected metrics
+        # Process collected metrics, the database writer commits them
         for metric_handler in self.component_metric_handlers:
             metric_handler.process_results()
-        # Commit any metrics logged to DB
-        self.db.commit()
+            metric_handler.flush_stream()
 
     def halt(self):
         if self.experiment is not None:
             self.experiment.end()
+        if self.is_server and self.message_handler is not None:
+            self._exit_clients()
         if self.termination_event is not None:
             self.termination_event.set()
+        if self.job_executor is not None:
+            self.job_executor.shutdown()
         if self.component_handler is not None:
             self.component_handler.stop_components()
+        for metric_handler in self.component_metric_handlers:
+            metric_handler.stop()
+        if self.db is not None and self.component_metric_handlers:
+            self._iter_client()
+        if self.db_writer is not None:
+            self.db_writer.close()
+            logging.info(f"Database writer stats: {self.db_writer.get_stats()}")
         if self.connection_monitor is not None:
             self.connection_monitor.join(timeout=1)
+        if self.message_handler is not None:
+            logging.info(f"Message handling stats: {self.message_handler.get_stats()}")
         if self.db is not None:
             self.db.close()
         if not self._persist_db:
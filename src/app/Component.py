@@ -18,6 +18,8 @@ class Component:
         self.is_active = True
         self.gpu_active = False
         self.process = process
+        # PIDs of the processes this component's process started, refreshed by the hardware metrics
+        self.children = set()
 
 
 class ComponentHandler:
@@ -32,11 +34,9 @@ class ComponentHandler:
         atexit.register(self.stop_components)
 
     def add_component(self, component: Component):
-        # Write this component into the database
-        self.owner.db_write_cur.execute("INSERT INTO components VALUES (?, ?)",
-                                        (component.name, component.pid))
-        self.owner.db.commit()
         self.components.append(component)
+        # Queued on the database writer, so this works from component jobs as well
+        self.owner.db_writer.execute("INSERT INTO components VALUES (?, ?)", (component.name, component.pid))
 
     def _get_component_by_name(self, component_name):
         for component in self.components:
@@ -0,0 +1,78 @@
+import logging
+import sqlite3
+
+
+# Add a column unless the table already has it, databases copied from the old templates may have it or not
+def add_column(table, column, column_type):
+    def migrate(db: sqlite3.Connection):
+        columns = [description[0] for description in db.execute(f"SELECT * FROM {table} LIMIT 0").description]
+        if column not in columns:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    return migrate
+
+
+# The database schema as a list of migrations, each one brings a database one version further. The version of a
+# database is kept in its user_version, a new database goes through all of them. Steps are SQL statements or
+# functions of the connection. Never change a released migration, append a new one instead.
+MIGRATIONS = [
+    # 1: the tables of the former database templates
+    ("CREATE TABLE IF NOT EXISTS components (process_name TEXT, pid INTEGER)",
+     "CREATE TABLE IF NOT EXISTS hardware_metrics (timestamp REAL, component INTEGER, cpu REAL, memory INTEGER)"),
+    # 2: samples record how late they were taken
+    (add_column('hardware_metrics', 'lag', 'REAL'),),
+    # 3: latency, process tree, network and high rate metrics
+    ("CREATE TABLE IF NOT EXISTS network_latency (timestamp REAL, peer TEXT, rtt REAL, min_rtt REAL, avg_rtt REAL,"
+     " p99_rtt REAL, jitter REAL)",
+     "CREATE TABLE IF NOT EXISTS process_tree_metrics (timestamp REAL, component INTEGER, pid INTEGER, cpu REAL,"
+     " memory INTEGER, lag REAL)",
+     "CREATE TABLE IF NOT EXISTS network_metrics (timestamp REAL, interface TEXT, component INTEGER,"
+     " bytes_sent REAL, bytes_recv REAL, packets_sent REAL, packets_recv REAL, errin REAL, errout REAL,"
+     " dropin REAL, dropout REAL, tcp_connections INTEGER, udp_sockets INTEGER, remote_hosts INTEGER, lag REAL)",
+     "CREATE TABLE IF NOT EXISTS high_rate_metrics (timestamp REAL, metric TEXT, key TEXT, field TEXT,"
+     " samples INTEGER, mean REAL, min REAL, max REAL, p95 REAL)"),
+    # 4: covering indexes for the metric queries. Time windows over all components (window queries, replays) are
+    # answered by a range scan of the timestamp index, one component's history by the component index, neither
+    # reads the table. The component lookup of every inserted row uses the pid index.
+    ("CREATE INDEX IF NOT EXISTS hardware_metrics_timestamp ON hardware_metrics (timestamp, component, cpu, memory)",
+     "CREATE INDEX IF NOT EXISTS hardware_metrics_component ON hardware_metrics (component, timestamp, cpu, memory)",
+     "CREATE INDEX IF NOT EXISTS components_pid ON components (pid, process_name)"),
+    # 5: rollup tiers of hardware_metrics, see MetricRollups. Buckets are looked up and pruned by tier and time, the
+    # other metric tables are pruned by time.
+    ("CREATE TABLE IF NOT EXISTS hardware_metrics_rollup (resolution REAL, timestamp REAL, component INTEGER,"
+     " count INTEGER, cpu_sum REAL, cpu_min REAL, cpu_max REAL, memory_sum REAL, memory_min REAL, memory_max REAL,"
+     " PRIMARY KEY (resolution, timestamp, component)) WITHOUT ROWID",
+     "CREATE INDEX IF NOT EXISTS process_tree_metrics_timestamp ON process_tree_metrics (timestamp)",
+     "CREATE INDEX IF NOT EXISTS network_metrics_timestamp ON network_metrics (timestamp)",
+     "CREATE INDEX IF NOT EXISTS high_rate_metrics_timestamp ON high_rate_metrics (timestamp)"),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(db: sqlite3.Connection) -> int:
+    # Plain tuples whatever the connection's row factory is
+    cursor = db.cursor()
+    cursor.row_factory = None
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+
+# Bring the database up to version (the latest by default), each migration is a transaction of its own
+def migrate(db: sqlite3.Connection, version=SCHEMA_VERSION):
+    current = get_schema_version(db)
+    if current > SCHEMA_VERSION:
+        raise sqlite3.DatabaseError(f"Database schema version {current} is newer than this code's {SCHEMA_VERSION}")
+    for number in range(current + 1, version + 1):
+        logging.debug(f"Migrating database schema to version {number}")
+        # Schema statements don't open a transaction on their own, a failed migration leaves nothing behind
+        db.execute("BEGIN")
+        try:
+            for step in MIGRATIONS[number - 1]:
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            db.execute(f"PRAGMA user_version = {number}")
+        except sqlite3.Error:
+            db.rollback()
+            raise
+        db.commit()
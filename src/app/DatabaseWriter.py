@@ -0,0 +1,124 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+
+# Runs every write to the database on one thread with its own connection, so sampling and message handling never
+# wait on the disk. Statements are queued from any thread and run in order. Commits are grouped: the writer commits
+# once commit_rows rows are pending or the oldest of them has waited commit_interval seconds. In WAL mode the owner's
+# connection keeps reading while the writer commits.
+class DatabaseWriter(threading.Thread):
+    # Seconds close() waits for the queued writes to be committed
+    close_timeout = 10.0
+
+    def __init__(self, db_file, synchronous='normal', commit_rows=1000, commit_interval=0.5):
+        super().__init__(name="DatabaseWriter", daemon=True)
+        self.db_file = db_file
+        self.synchronous = synchronous
+        self.commit_rows = commit_rows
+        self.commit_interval = commit_interval
+        # (query, parameters, is executemany), a threading.Event to set once everything before it is committed,
+        # or None to commit and stop
+        self._queue = queue.SimpleQueue()
+        # statistics
+        self.num_rows = 0
+        self.num_errors = 0
+        self.max_queue_depth = 0
+        self.num_commits = 0
+        self.total_commit_time = 0.0
+        self.max_commit_time = 0.0
+
+    # Queue a statement, never blocks
+    def execute(self, query, params=()):
+        self._put((query, params, False))
+
+    # Queue a statement for each of rows, never blocks
+    def executemany(self, query, rows):
+        if rows:
+            self._put((query, rows, True))
+
+    def _put(self, item):
+        self._queue.put(item)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    # Wait until everything queued so far is committed, returns False on timeout
+    def flush(self, timeout=None) -> bool:
+        if not self.is_alive():
+            return False
+        committed = threading.Event()
+        self._queue.put(committed)
+        return committed.wait(timeout)
+
+    # Commit what is queued and stop the thread
+    def close(self):
+        if not self.is_alive():
+            return
+        self._queue.put(None)
+        self.join(self.close_timeout)
+        if self.is_alive():
+            logging.error(f"Database writer did not finish within {self.close_timeout}s, "
+                          f"{self._queue.qsize()} writes are lost")
+
+    def run(self):
+        db = sqlite3.connect(self.db_file)
+        db.execute(f"PRAGMA synchronous={self.synchronous}")
+        pending = 0
+        pending_since = None
+        while True:
+            timeout = None if pending_since is None else max(pending_since + self.commit_interval - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False  # commit_interval passed
+            if isinstance(item, tuple):
+                pending += self._write(db, *item)
+                if pending_since is None and pending:
+                    pending_since = time.monotonic()
+                if pending < self.commit_rows and (pending_since is None or
+                                                   time.monotonic() - pending_since < self.commit_interval):
+                    continue
+            if pending:
+                self._commit(db)
+                pending = 0
+                pending_since = None
+            if item is None:
+                break
+            if isinstance(item, threading.Event):
+                item.set()
+        db.close()
+
+    # Run one queued statement, returns the number of rows written
+    def _write(self, db: sqlite3.Connection, query, params, many) -> int:
+        try:
+            if many:
+                db.executemany(query, params)
+            else:
+                db.execute(query, params)
+        except sqlite3.Error as error:
+            self.num_errors += 1
+            logging.error(f"Database write failed with {error}: {query}")
+            return 0
+        rows = len(params) if many else 1
+        self.num_rows += rows
+        return rows
+
+    def _commit(self, db: sqlite3.Connection):
+        start_t = time.perf_counter()
+        try:
+            db.commit()
+        except sqlite3.Error as error:
+            self.num_errors += 1
+            logging.error(f"Database commit failed with {error}")
+            db.rollback()
+        commit_time = time.perf_counter() - start_t
+        self.num_commits += 1
+        self.total_commit_time += commit_time
+        self.max_commit_time = max(self.max_commit_time, commit_time)
+
+    def get_stats(self) -> dict:
+        return dict(rows=self.num_rows, errors=self.num_errors, queue_depth=self._queue.qsize(),
+                    max_queue_depth=self.max_queue_depth, commits=self.num_commits,
+                    avg_commit_ms=self.total_commit_time / self.num_commits * 1000 if self.num_commits else 0.0,
+                    max_commit_ms=self.max_commit_time * 1000)
@@ -0,0 +1,26 @@
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Bounded pool of worker threads for jobs that would otherwise stall the message loop, e.g. component actions that
+# wait minutes for a process to come up. Jobs send their own responses, sending is thread safe, and write to the
+# database through the database writer.
+class JobExecutor:
+    def __init__(self, max_workers):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ComponentJob")
+
+    def submit(self, fn, *args):
+        future = self._pool.submit(fn, *args)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            exc = future.exception()
+            logging.error(f"Job failed: {''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))}")
+
+    # Jobs still running are abandoned, queued jobs are cancelled
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)